@@ -4,6 +4,7 @@ import typer
 
 from fmrai import fmrai
 from fmrai.agent.agents.transformers import TransformersAgentAPI
+from fmrai.storage import set_tensor_cache_size
 
 run_app = typer.Typer()
 
@@ -18,7 +19,11 @@ def run_text(
         host: Optional[str] = typer.Option('127.0.0.1', '--host', '-h'),
         port: Optional[int] = typer.Option(8001, '--port', '-p'),
         cpu: bool = typer.Option(False, '--cpu', '-c'),
+        tensor_cache_mb: Optional[int] = typer.Option(None, '--tensor-cache-mb', envvar='FMRAI_TENSOR_CACHE_MB'),
 ):
+    if tensor_cache_mb is not None:
+        set_tensor_cache_size(tensor_cache_mb << 20)
+
     with fmrai():
         try:
             api = TransformersAgentAPI(model, use_cuda=not cpu)
@@ -31,6 +31,9 @@ class TransformersAgentAPI(AgentAPI):
             )
         ]
 
+    def get_model(self):
+        return self.model
+
     def predict_zero(self):
         return self.model(
             input_ids=torch.full((1, 64), 0, dtype=torch.long).to(self.model.device),
@@ -16,6 +16,13 @@ class AgentDatasetList(BaseModel):
 
 
 class AgentAPI:
+    def get_model(self):
+        """
+        Returns the model served by the agent, or None if unknown.
+        Structure detection results are only cached when the model is known.
+        """
+        return None
+
     def predict_zero(self):
         """
         Perform a prediction on a zero tensor.
@@ -11,9 +11,10 @@ from fmrai.agent.api import TokenizedText
 from fmrai.analysis.attention import AttentionHeadClusteringResult, extract_attention_values
 from fmrai.analysis.attention import compute_attention_head_clustering
 from fmrai.analysis.structure import find_multi_head_attention
+from fmrai.analysis.structure_cache import StructureCache, probe_model_structure
 from fmrai.fmrai import get_fmrai
 from fmrai.logging import get_attention_head_plots_dir, get_computation_graph_dir, get_computation_map_dir
-from fmrai.tracker import NiceComputationGraph, LazyComputationMap, OrdinalTensorId
+from fmrai.tracker import NiceComputationGraph, LazyComputationMap, parse_tensor_id
 
 
 @dataclass
@@ -74,8 +75,7 @@ def do_extract_attention(
 ):
     cmap = LazyComputationMap.load_from(get_computation_map_dir(key, root_dir=root_dir))
 
-    assert tensor_id.startswith('#')
-    tensor_id = OrdinalTensorId(ordinal=int(tensor_id[1:]))
+    tensor_id = parse_tensor_id(tensor_id)
 
     attention_batch = extract_attention_values(cmap, tensor_id)
     return models.AnalyzeTextExtractAttentionOut(
@@ -91,7 +91,7 @@ def do_predict_text(
 ) -> TextPredictionResult:
     fmr = get_fmrai()
 
-    with fmr.track() as tracker:
+    with fmr.track(graph=False) as tracker:
         with torch.no_grad():
             result = agent_state.api.predict_text_one(text)
         mp = tracker.build_map()
@@ -126,13 +126,14 @@ def do_compute_attention_head_plot(
 
     fmr = get_fmrai()
 
-    # find attention heads first
-    with fmr.track() as tracker:
-        y = agent_state.api.predict_zero()
-        g = tracker.build_graph(y).make_nice()
-
-    heads = list(find_multi_head_attention(g))
-    attention_tensor_ids = [h.softmax_value.tensor_id for h in heads]
+    # find attention heads first (cached per model)
+    structure = probe_model_structure(
+        agent_state.api.predict_zero,
+        model=agent_state.api.get_model(),
+        cache=StructureCache(root_dir=root_dir),
+        attention=True,
+    )
+    attention_tensor_ids = [h.softmax_value.tensor_id for h in structure.attention]
 
     with fmr.track(track_tensors=attention_tensor_ids) as tracker:
         with torch.no_grad():
@@ -1,6 +1,6 @@
 import os
 import time
-from typing import List, Optional, Iterable
+from typing import List, Optional, Iterable, Dict
 
 import numpy as np
 import torch
@@ -9,9 +9,12 @@ from torch import Tensor
 from tqdm import tqdm
 
 from fmrai.analysis.common import DatasetInfo, AnalysisTracker, Analyzer, AnalysisAccumulator
-from fmrai.analysis.structure import find_multi_head_attention
+from fmrai.analysis.structure import find_multi_head_attention, MultiHeadAttentionInstance
+from fmrai.analysis.structure_cache import StructureCache, ModelStructure, current_model_fingerprint, \
+    get_structural_ids, with_structural_ids
 from fmrai.fmrai import get_fmrai
 from fmrai.instrument import unwrap_proxy
+from fmrai.storage import StoragePolicy, MemoryBudget
 from fmrai.tracker import ComputationMap, TensorId, LazyComputationMap, OrdinalTensorId, BatchedComputationMap, \
     SingleComputationTracker
 
@@ -30,26 +33,32 @@ def extract_attention_values(
         head_index: Optional[int] = None,
         instance_range=None,
 ) -> List[AttentionExtraction]:
-    tensor = cmap.get_cat(tensor_id)
-
-    assert len(tensor.size()) == 4
-    batch_size, num_heads, query_len, key_len = tensor.size()
+    shapes = cmap.get_shapes(tensor_id)
+    assert all(len(shape) == 4 for shape in shapes)
+    batch_size = sum(shape[0] for shape in shapes)
 
     extractions = []
 
     if instance_range is None:
         instance_range = range(batch_size)
 
+    instances = []
     for i in instance_range:
         if i >= batch_size:
             break
+        instances.append(i)
 
-        heads = []
-        for j in range(num_heads):
-            if head_index is not None and head_index != j:
-                continue
+    if not instances:
+        return extractions
+
+    # read only the requested instances and heads
+    first_instance = min(instances)
+    heads_index = slice(head_index, head_index + 1) if head_index is not None else slice(None)
+    tensor = cmap.get_cat(tensor_id, index=(slice(first_instance, max(instances) + 1), heads_index))
 
-            head_tensor = tensor[i, j, :, :]
+    for i in instances:
+        heads = []
+        for head_tensor in tensor[i - first_instance]:
             heads.append(AttentionHeadExtraction(
                 matrix=head_tensor.cpu().tolist(),
             ))
@@ -163,7 +172,7 @@ class AttentionHeadClusteringAccumulator(AnalysisAccumulator):
 
         # figure out instance count by looking at batch size in some tensor
         some_tensor_id = next(iter(cmap))
-        instance_count = cmap.get(some_tensor_id)[0].size(0)
+        instance_count = cmap.get_shapes(some_tensor_id)[0][0]
 
         # combine with previous batches
         if self._accumulated_result is None:
@@ -200,7 +209,7 @@ def _compute_attention_plot_coords_from_distance_matrix(
         if heads_in_tensor == 0:
             head_index = 0
             tensor_index += 1
-            heads_in_tensor = ref_batch.get(attention_tensors[tensor_index])[0].size(1)
+            heads_in_tensor = ref_batch.get_shapes(attention_tensors[tensor_index])[0][1]
 
         heads.append(AttentionHeadPoint(
             tensor_id=str(attention_tensors[tensor_index]),
@@ -225,11 +234,14 @@ def compute_attention_head_clustering(
 ) -> AttentionHeadClusteringResult:
     if isinstance(cmap, BatchedComputationMap):
         batches = list(cmap)
+        # the attention tensors of the next batches are read while one is processed
+        loaded_batches = cmap.iter_batches(attention_tensors)
     else:
         batches = [cmap]
+        loaded_batches = batches
 
     # process all batches
-    batches_iter = tqdm(batches, desc='computing attention head divergence matrix')
+    batches_iter = tqdm(loaded_batches, total=len(batches), desc='computing attention head divergence matrix')
     accumulator = AttentionHeadClusteringAccumulator(attention_tensors)
     for batch in batches_iter:
         accumulator.process_batch(batch)
@@ -243,48 +255,109 @@ def compute_attention_head_clustering(
 
 
 class AttentionTracker(AnalysisTracker):
-    def __init__(self):
-        super().__init__()
+    def __init__(
+            self,
+            *,
+            cache: Optional[StructureCache] = None,
+            storage: StoragePolicy = StoragePolicy.FULL,
+            budget: Optional[MemoryBudget] = None,
+    ):
+        super().__init__(storage=storage, budget=budget)
         self._attention_tensor_ids: Optional[List[TensorId]] = None
-        self._expected_cmap_size: Optional[int] = None
+        self._expected_signature: Optional[int] = None
+        self._cache = cache
+        self._cached_structures: Dict[Optional[int], ModelStructure] = {}
 
     def _process_batch(self, cmap: ComputationMap, tracker: SingleComputationTracker):
-        if self._attention_tensor_ids is None:
-            self._find_attention_tensors(tracker)
-
-        if self._expected_cmap_size is not None:
-            if self._expected_cmap_size != tracker.num_seen_tensors:
-                raise Exception(f'Expected {self._expected_cmap_size} tensors, got {tracker.num_seen_tensors} tensors.')
-        else:
-            self._expected_cmap_size = tracker.num_seen_tensors
+        if self._attention_tensor_ids is None and self._cached_structures:
+            # the first batch was tracked with the attention tensors of every cached trace, keep those of its own
+            structure = self._cached_structures.get(tracker.trace_signature)
+            if structure is None:
+                raise Exception('Batch traced different operations than the batches the attention tensors were cached for.')
+            self._cached_structures = {}
+            self._set_attention_instances(structure.attention)
+            self._expected_signature = structure.trace_signature
             filter_set = set(self._attention_tensor_ids)
             cmap = cmap.filter_ids(lambda x: x in filter_set)
+        elif self._attention_tensor_ids is None:
+            # the first batch was tracked in full, keep only the attention tensors under their structural ids
+            structural_ids = self._find_attention_tensors(tracker)
+            filter_set = set(self._attention_tensor_ids)
+            cmap = cmap.rename_ids(structural_ids).filter_ids(lambda x: x in filter_set)
+        elif self._expected_signature != tracker.trace_signature:
+            raise Exception('Batch traced different operations than the batch the attention tensors were found in.')
 
         return cmap
 
     def _get_tracked_tensors(self) -> Optional[Iterable[TensorId]]:
+        if self._attention_tensor_ids is None and self._cache is not None:
+            return self._load_cached_attention_tensors()
         return self.attention_tensor_ids
 
     @property
     def attention_tensor_ids(self) -> Optional[List[TensorId]]:
         return self._attention_tensor_ids
 
-    def _find_attention_tensors(self, tracker: SingleComputationTracker):
+    def _set_attention_instances(self, instances: List[MultiHeadAttentionInstance]):
+        self._attention_tensor_ids = [
+            instance.softmax_value.tensor_id
+            for instance in instances
+        ]
+
+    def _load_cached_attention_tensors(self) -> Optional[List[TensorId]]:
+        """ Returns the attention tensors of every trace cached for the model, or None if there are none. """
+        fingerprint = current_model_fingerprint()
+        structures = self._cache.load_all(fingerprint) if fingerprint is not None else {}
+        self._cached_structures = {
+            trace_signature: structure
+            for trace_signature, structure in structures.items()
+            if structure.attention is not None
+        }
+        if not self._cached_structures:
+            return None
+        return list(dict.fromkeys(
+            instance.softmax_value.tensor_id
+            for structure in self._cached_structures.values()
+            for instance in structure.attention
+        ))
+
+    def _find_attention_tensors(self, tracker: SingleComputationTracker) -> Dict[TensorId, TensorId]:
         """
         Called after processing the first batch to find the ids of the attention tensors.
+        Returns the mapping of the ids the batch was tracked with to structural ids.
         """
         cg = tracker.build_graph()
         result = list(find_multi_head_attention(cg))
+        structure = ModelStructure(
+            num_tensors=tracker.num_seen_tensors,
+            trace_signature=tracker.trace_signature,
+            attention=with_structural_ids(result, tracker),
+        )
+        self._set_attention_instances(structure.attention)
+        self._expected_signature = structure.trace_signature
 
-        self._attention_tensor_ids = [
-            instance.softmax_value.tensor_id
-            for instance in result
-        ]
+        fingerprint = current_model_fingerprint() if self._cache is not None else None
+        if fingerprint is not None:
+            self._cache.update(fingerprint, structure)
+
+        return get_structural_ids(tracker, (instance.softmax_value.tensor_id for instance in result))
 
 
 class AttentionHeadClusterAnalyzer(Analyzer):
+    def __init__(
+            self,
+            *,
+            cache: Optional[StructureCache] = None,
+            storage: StoragePolicy = StoragePolicy.FULL,
+            budget: Optional[MemoryBudget] = None,
+    ):
+        super().__init__()
+        self._cache = cache
+        self._storage = storage
+        self._budget = budget
+
     def _create_tracker(self) -> AnalysisTracker:
-        return AttentionTracker()
+        return AttentionTracker(cache=self._cache, storage=self._storage, budget=self._budget)
 
     def _create_accumulator(self) -> AnalysisAccumulator:
         return AttentionHeadClusteringAccumulator(self.tracker.attention_tensor_ids)
@@ -1,14 +1,18 @@
 import collections
 import contextlib
+import weakref
 from abc import ABC, abstractmethod
 from dataclasses import dataclass
-from typing import Optional, Deque, Iterable, List, Dict
+from typing import Optional, Deque, Iterable, List, Dict, Union, Tuple
 
 import networkx as nx
+import numpy as np
 from pydantic import BaseModel
 
 from fmrai.fmrai import get_fmrai
-from fmrai.tracker import ComputationMap, SingleComputationTracker, TensorId
+from fmrai.storage import StoragePolicy, MemoryBudget
+from fmrai.tracker import ComputationMap, SingleComputationTracker, CompactGraph, NodeKind, TensorOp, \
+    TrackedTensors
 
 
 @dataclass
@@ -27,8 +31,13 @@ class AnalysisAccumulator(ABC):
 
 
 class AnalysisTracker:
-    def __init__(self):
+    def __init__(self, *, storage: StoragePolicy = StoragePolicy.FULL, budget: Optional[MemoryBudget] = None):
+        """
+        budget limits the memory used by batches waiting to be consumed, older ones are spilled to disk.
+        """
         self._cmaps: Deque[ComputationMap] = collections.deque()
+        self._storage = storage
+        self._budget = budget
 
     def _process_batch(self, cmap: ComputationMap, tracker: SingleComputationTracker) -> ComputationMap:
         """
@@ -37,9 +46,10 @@ class AnalysisTracker:
         """
         return cmap
 
-    def _get_tracked_tensors(self) -> Optional[Iterable[TensorId]]:
+    def _get_tracked_tensors(self) -> Optional[TrackedTensors]:
         """
-        Returns a list of tensors that should be included in resulting computation maps.
+        Returns a list of tensors that should be included in resulting computation maps,
+        or a dict of tensor ids to reducers that are applied at capture time (see Reducer).
         If None is returned, tracks all tensors.
         """
         return None
@@ -51,7 +61,11 @@ class AnalysisTracker:
         """
         fmr = get_fmrai()
 
-        with fmr.track(track_tensors=self._get_tracked_tensors()) as tracker:
+        with fmr.track(
+                track_tensors=self._get_tracked_tensors(),
+                storage=self._storage,
+                budget=self._budget,
+        ) as tracker:
             tracker: SingleComputationTracker
 
             # pass control back and wait for computation
@@ -60,6 +74,9 @@ class AnalysisTracker:
             cmap = tracker.build_map()
             cmap = self._process_batch(cmap, tracker)
             assert isinstance(cmap, ComputationMap)
+            if self._budget is not None:
+                # processing may have replaced the map built under the budget
+                cmap.set_memory_budget(self._budget)
             self._cmaps.append(cmap)
 
     def __bool__(self):
@@ -120,10 +137,215 @@ class Analyzer(ABC):
         raise NotImplementedError()
 
 
-def weak_topological_sort(g: nx.DiGraph, nodes):
+class GraphIndex:
+    """
+    Lookup structures of a CompactGraph that are shared by all pattern finders searching it:
+    a topological order, the op nodes grouped by op, and interval labels for reachability queries.
+    Use get_graph_index() to get the (cached) index of a graph.
+    """
+
+    def __init__(self, g: CompactGraph, *, num_labelings=2):
+        self.g = g
+        self.order = g.topological_order()
+        self.position = np.empty(len(g), dtype=np.int64)
+        self.position[self.order] = np.arange(len(g), dtype=np.int64)
+
+        # op nodes, each group in topological order
+        ordered_ops = g.ops[self.order]
+        is_op = g.kinds[self.order] == NodeKind.OP
+        self._op_nodes: Dict[TensorOp, np.ndarray] = {
+            TensorOp(int(op)): self.order[is_op & (ordered_ops == op)]
+            for op in np.unique(ordered_ops[is_op]).tolist()
+        }
+
+        self._num_labelings = num_labelings
+        self._labels: Optional[List[Tuple[np.ndarray, np.ndarray]]] = None
+        self._extents: Dict[Tuple[Optional[int], Optional[int]], np.ndarray] = {}
+        # (node, reverse) -> which nodes the node reaches (or, if reverse, which reach it)
+        self._reach_masks: Dict[Tuple[int, bool], np.ndarray] = {}
+
+        # memoized chain pattern walks, see fmrai.analysis.structure
+        self.chain_walks: Dict[tuple, Optional[int]] = {}
+
+    def nodes_with_op(self, *ops: TensorOp) -> np.ndarray:
+        """ Returns all op nodes with one of the given ops, in topological order. """
+        groups = [self._op_nodes[op] for op in ops if op in self._op_nodes]
+        if not groups:
+            return np.zeros(0, dtype=np.int64)
+        if len(groups) == 1:
+            return groups[0]
+
+        nodes = np.concatenate(groups)
+        return nodes[np.argsort(self.position[nodes], kind='stable')]
+
+    def sort(self, nodes) -> list:
+        """ Sorts nodes (node ids or node objects) topologically. """
+        return sorted(nodes, key=lambda node: self.position[self.g.index_of(node)])
+
+    def _compute_labels(self):
+        """
+        Computes GRAIL style interval labels: every node gets its post-order rank in a depth first
+        traversal, and the lowest rank among its descendants. If u reaches v, the interval of v is
+        contained in the interval of u, for every traversal. Traversals differ by the order in which
+        roots and successors are visited.
+        """
+        g = self.g
+        n = len(g)
+        offsets = g.succ_offsets
+        row = np.repeat(np.arange(n, dtype=np.int64), np.diff(offsets))
+        edge = np.arange(len(g.succ_indices), dtype=np.int64)
+        reversed_indices = g.succ_indices[offsets[row] + offsets[row + 1] - 1 - edge]
+
+        roots = self.order[np.diff(g.pred_offsets)[self.order] == 0].tolist()
+        offsets = offsets.tolist()
+
+        labels = []
+        for i in range(self._num_labelings):
+            if i % 2 == 0:
+                succ, root_order = g.succ_indices.tolist(), roots
+            else:
+                succ, root_order = reversed_indices.tolist(), roots[::-1]
+
+            post = [-1] * n
+            low = [0] * n
+            next_edge = offsets[:-1]
+            visited = [False] * n
+            rank = 0
+
+            for root in root_order:
+                if visited[root]:
+                    continue
+                visited[root] = True
+                stack = [root]
+                while stack:
+                    u = stack[-1]
+                    e = next_edge[u]
+                    if e < offsets[u + 1]:
+                        next_edge[u] = e + 1
+                        v = succ[e]
+                        if not visited[v]:
+                            visited[v] = True
+                            stack.append(v)
+                    else:
+                        stack.pop()
+                        u_low = rank
+                        for e in range(offsets[u], offsets[u + 1]):
+                            u_low = min(u_low, low[succ[e]])
+                        low[u] = u_low
+                        post[u] = rank
+                        rank += 1
+
+            labels.append((np.array(low, dtype=np.int64), np.array(post, dtype=np.int64)))
+
+        self._labels = labels
+
+    def _may_reach(self, u, v):
+        """ Returns false if u definitely does not reach v (vectorized over u or v). """
+        if self._labels is None:
+            self._compute_labels()
+
+        result = self.position[u] <= self.position[v]
+        for low, post in self._labels:
+            result = result & (low[u] <= low[v]) & (post[v] <= post[u])
+        return result
+
+    def reaches(self, u: int, v: int) -> bool:
+        """ Returns true if there is a path from u to v. """
+        if u == v:
+            return True
+        if not self._may_reach(u, v):
+            return False
+
+        # exact search, pruned by the labels
+        g = self.g
+        seen = {u}
+        stack = [u]
+        while stack:
+            w = stack.pop()
+            succs = np.asarray(g.successors(w), dtype=np.int64)
+            if len(succs) == 0:
+                continue
+            if v in succs:
+                return True
+            for x in succs[self._may_reach(succs, v)].tolist():
+                if x not in seen:
+                    seen.add(x)
+                    stack.append(x)
+
+        return False
+
+    def filter_extent(self, nodes: np.ndarray, start: Optional[int] = None, end: Optional[int] = None) -> np.ndarray:
+        """ Returns the nodes reachable from start (if given) that reach end (if given). """
+        nodes = np.asarray(nodes, dtype=np.int64)
+        if start is None and end is None:
+            return nodes
+
+        if (start, end) in self._extents:
+            extent = self._extents[start, end]
+            return nodes[np.isin(nodes, extent)]
+
+        mask = np.ones(len(nodes), dtype=bool)
+        if start is not None:
+            mask &= self._may_reach(start, nodes)
+        if end is not None:
+            mask &= self._may_reach(nodes, end)
+        nodes = nodes[mask]
+
+        # the labels only rule pairs out, the remaining candidates are looked up in
+        # reachability that is computed once per start and end
+        if len(nodes) > 0 and start is not None:
+            nodes = nodes[self._reach_mask(start)[nodes]]
+        if len(nodes) > 0 and end is not None:
+            nodes = nodes[self._reach_mask(end, reverse=True)[nodes]]
+        return nodes
+
+    def _reach_mask(self, node: int, *, reverse: bool = False) -> np.ndarray:
+        """ Returns which nodes node reaches (or, if reverse, which nodes reach it), as a boolean mask. """
+        mask = self._reach_masks.get((node, reverse))
+        if mask is None:
+            mask = self.g.multi_source_bfs([node], reverse=reverse)[0] >= 0
+            self._reach_masks[node, reverse] = mask
+        return mask
+
+    def extent_nodes(self, start: Optional[int] = None, end: Optional[int] = None) -> np.ndarray:
+        """ Returns all nodes reachable from start (if given) that reach end (if given), in topological order. """
+        if start is None and end is None:
+            return self.order
+
+        extent = self._extents.get((start, end))
+        if extent is None:
+            mask = np.ones(len(self.g), dtype=bool)
+            if start is not None:
+                mask &= self._reach_mask(start)
+            if end is not None:
+                mask &= self._reach_mask(end, reverse=True)
+
+            extent = self.order[mask[self.order]]
+            self._extents[start, end] = extent
+
+        return extent
+
+
+_GRAPH_INDICES: 'weakref.WeakKeyDictionary[CompactGraph, GraphIndex]' = weakref.WeakKeyDictionary()
+
+
+def get_graph_index(g: CompactGraph) -> GraphIndex:
+    """ Returns the index of a graph, building it on first use. """
+    index = _GRAPH_INDICES.get(g)
+    if index is None:
+        index = GraphIndex(g)
+        _GRAPH_INDICES[g] = index
+    return index
+
+
+def weak_topological_sort(g: Union[nx.DiGraph, CompactGraph], nodes):
     if not isinstance(nodes, set):
         nodes = set(nodes)
 
+    if isinstance(g, CompactGraph):
+        # nodes may be node ids or node objects
+        return get_graph_index(g).sort(nodes)
+
     sccs = list(nx.strongly_connected_components(g))
     condensed = nx.condensation(g, scc=sccs)
 
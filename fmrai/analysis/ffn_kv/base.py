@@ -14,8 +14,11 @@ from torch import Tensor
 from fmrai.analysis.common import AnalysisTracker, Analyzer, AnalysisAccumulator, Batch, TokenizationHelper, \
     DatapointTokenization
 from fmrai.analysis.structure import FindTransformerFFN, TransformerFFNInstance
+from fmrai.analysis.structure_cache import StructureCache, ModelStructure, current_model_fingerprint, \
+    get_structural_ids, with_structural_ids
 from fmrai.fmrai import get_fmrai
 from fmrai.instrument import unwrap_proxy
+from fmrai.storage import StoragePolicy, MemoryBudget
 from fmrai.tracker import ComputationMap, SingleComputationTracker, TensorId
 
 
@@ -225,11 +228,20 @@ class KeyValueAnalysisAccumulator(AnalysisAccumulator):
 
 
 class KeyValueAnalysisTracker(AnalysisTracker):
-    def __init__(self):
-        super().__init__()
+    def __init__(
+            self,
+            *,
+            cache: Optional[StructureCache] = None,
+            storage: StoragePolicy = StoragePolicy.FULL,
+            budget: Optional[MemoryBudget] = None,
+    ):
+        super().__init__(storage=storage, budget=budget)
 
         self._ffns: Optional[List[TransformerFFNInstance]] = None
         self._relevant_ids: Optional[Set[TensorId]] = None
+        self._expected_signature: Optional[int] = None
+        self._cache = cache
+        self._cached_structures: Dict[Optional[int], ModelStructure] = {}
 
         self._attention_masks: Deque[Tensor] = collections.deque()
 
@@ -237,19 +249,70 @@ class KeyValueAnalysisTracker(AnalysisTracker):
     def ffns(self) -> Optional[List[TransformerFFNInstance]]:
         return self._ffns
 
+    def _set_ffns(self, ffns: List[TransformerFFNInstance]):
+        self._ffns = ffns
+        self._relevant_ids = functools.reduce(
+            operator.or_,
+            ({ffn.act.tensor_id, ffn.linear_bottom.tensor_id} for ffn in self._ffns),
+            set(),
+        )
+
+    def _load_cached_ffns(self) -> Optional[Set[TensorId]]:
+        """ Returns the FFN tensors of every trace cached for the model, or None if there are none. """
+        fingerprint = current_model_fingerprint()
+        structures = self._cache.load_all(fingerprint) if fingerprint is not None else {}
+        self._cached_structures = {
+            trace_signature: structure
+            for trace_signature, structure in structures.items()
+            if structure.ffns is not None
+        }
+        if not self._cached_structures:
+            return None
+        return {
+            tensor_id
+            for structure in self._cached_structures.values()
+            for ffn in structure.ffns
+            for tensor_id in (ffn.act.tensor_id, ffn.linear_bottom.tensor_id)
+        }
+
     def _get_tracked_tensors(self) -> Optional[Iterable[TensorId]]:
+        if self._relevant_ids is None and self._cache is not None:
+            return self._load_cached_ffns()
         return self._relevant_ids
 
     def _process_batch(self, cmap: ComputationMap, tracker: SingleComputationTracker) -> ComputationMap:
-        if self._relevant_ids is None:
+        if self._relevant_ids is None and self._cached_structures:
+            # the first batch was tracked with the FFN tensors of every cached trace, keep those of its own
+            structure = self._cached_structures.get(tracker.trace_signature)
+            if structure is None:
+                raise Exception('Batch traced different operations than the batches the FFNs were cached for.')
+            self._cached_structures = {}
+            self._set_ffns(structure.ffns)
+            self._expected_signature = structure.trace_signature
+
+        elif self._relevant_ids is None:
+            # the first batch was tracked in full, relabel its tensors with structural ids
             cg = tracker.build_graph()
-            self._ffns = list(FindTransformerFFN(cg.g).search())
-
-            self._relevant_ids = functools.reduce(
-                operator.or_,
-                ({ffn.act.tensor_id, ffn.linear_bottom.tensor_id} for ffn in self._ffns),
-                set(),
+            ffns = list(FindTransformerFFN(cg.g).search())
+            structure = ModelStructure(
+                num_tensors=tracker.num_seen_tensors,
+                trace_signature=tracker.trace_signature,
+                ffns=with_structural_ids(ffns, tracker),
             )
+            self._set_ffns(structure.ffns)
+            self._expected_signature = structure.trace_signature
+
+            fingerprint = current_model_fingerprint() if self._cache is not None else None
+            if fingerprint is not None:
+                self._cache.update(fingerprint, structure)
+
+            cmap = cmap.rename_ids(get_structural_ids(
+                tracker,
+                (tensor_id for ffn in ffns for tensor_id in (ffn.act.tensor_id, ffn.linear_bottom.tensor_id)),
+            ))
+
+        elif self._expected_signature != tracker.trace_signature:
+            raise Exception('Batch traced different operations than the batch the FFNs were found in.')
 
         cmap = cmap.filter_ids(lambda x: x in self._relevant_ids)
         return cmap
@@ -275,9 +338,20 @@ class KeyValueAnalysisTracker(AnalysisTracker):
 
 
 class KeyValueAnalyzer(Analyzer):
-    def __init__(self, strategy: KeyValueMaxSearchStrategy, *, max_entries: int = 10):
+    def __init__(
+            self,
+            strategy: KeyValueMaxSearchStrategy,
+            *,
+            max_entries: int = 10,
+            cache: Optional[StructureCache] = None,
+            storage: StoragePolicy = StoragePolicy.FULL,
+            budget: Optional[MemoryBudget] = None,
+    ):
         super().__init__()
         self.strategy = strategy
+        self._cache = cache
+        self._storage = storage
+        self._budget = budget
 
         self._start_index = 0
         self._max_entries = max_entries
@@ -292,7 +366,7 @@ class KeyValueAnalyzer(Analyzer):
         self._start_index = value
 
     def _create_tracker(self) -> AnalysisTracker:
-        return KeyValueAnalysisTracker()
+        return KeyValueAnalysisTracker(cache=self._cache, storage=self._storage, budget=self._budget)
 
     def _create_accumulator(self) -> AnalysisAccumulator:
         assert self._tracker is not None
@@ -1,66 +1,310 @@
+import collections
+import dataclasses
 from dataclasses import dataclass
 from enum import Enum, auto
-from typing import Generator, Iterable, Tuple, Optional, Any, Union
-import networkx as nx
-from tqdm import tqdm
+from typing import Generator, Iterable, Tuple, Optional, Any, Union, Dict, Callable, List
 
-from fmrai.analysis.common import weak_topological_sort
-from fmrai.tracker import NiceComputationGraph, RawOpNode, TensorStubNode, TensorOp, OpNode, ConstantNode, GraphNode, \
-    TensorNode, BaseTensorNode
+import numpy as np
+
+from fmrai.analysis.common import weak_topological_sort, get_graph_index
+from fmrai.tracker import NiceComputationGraph, TensorStubNode, TensorOp, GraphNode, BaseTensorNode, CompactGraph, \
+    NodeKind, TensorId, OrdinalTensorId
+
+
+def _compile_chain_pattern(p):
+    """ Converts a chain pattern into nested tuples, so that patterns can be used as memo keys. """
+    if isinstance(p, (int, float)):
+        return p
+    return tuple(
+        (top[0],) + tuple(_compile_chain_pattern(p_pred) for p_pred in top[1:])
+        for top in p
+    )
+
+
+def _walk_chain(g: CompactGraph, node: int, p, memo: Dict, offset=0) -> Optional[int]:
+    """
+    Matches the suffix p[offset:] of a compiled chain pattern starting at a node.
+    Returns the node at which the match ends, or None if there is no match.
+    Results are memoized per (node, pattern, offset).
+    """
+    key = (node, p, offset)
+    if key in memo:
+        return memo[key]
+
+    result = _match_chain(g, node, p, memo, offset)
+    memo[key] = result
+    return result
+
+
+def _match_chain(g: CompactGraph, node: int, p, memo: Dict, offset: int) -> Optional[int]:
+    # match against constant
+    if isinstance(p, (int, float)):
+        if g.kinds[node] == NodeKind.CONSTANT and abs(g.constant(node) - p) < 1e-6:
+            return node
+        return None
+
+    # empty pattern, empty match
+    if offset == len(p):
+        return node
+
+    top = p[offset]
+    op = top[0]
+    p_preds = top[1:]
+
+    if g.op(node) == op:
+        node_preds = set(g.predecessors(node))
+        used_preds = set()
+
+        for p_pred in p_preds:
+            for pred in node_preds - used_preds:
+                if _walk_chain(g, pred, p_pred, memo) is not None:
+                    # found a match
+                    used_preds.add(pred)
+                    break
+            else:
+                # no match for predecessor
+                return None
+
+        # passed predecessor checks
+
+        # skip tensor node below op node
+        succs = g.successors(node)
+        if len(succs) != 1 or g.kinds[succs[0]] != NodeKind.TENSOR:
+            return None
+        node = succs[0]
+
+        # continue down successor line
+        for succ in g.successors(node):
+            m = _walk_chain(g, succ, p, memo, offset + 1)
+            if m is not None:
+                return m
+
+    return None
 
 
 def _find_simple_chain_pattern(cg: NiceComputationGraph, pattern) -> Iterable[Tuple[GraphNode, GraphNode]]:
-    def walk(start, node, p):
-        # empty pattern, empty match
-        if not p:
-            return start, node
-
-        # match against constant
-        if isinstance(p, (int, float)):
-            if isinstance(node, ConstantNode) and abs(node.value - p) < 1e-6:
-                return start, node
+    for start, end in BasicChainFinder(cg.g, pattern).search():
+        yield cg.g.node(start), cg.g.node(end)
+
+
+@dataclass(frozen=True)
+class RepeatedBlockLayout:
+    """
+    A run of structurally identical blocks (e.g. transformer layers) in the tensor ordinals of a graph.
+    Block k holds the ordinals start + k * period up to (but excluding) start + (k + 1) * period.
+    """
+    start: int
+    period: int
+    count: int
+
+    @property
+    def end(self) -> int:
+        return self.start + self.period * self.count
+
+    def locate(self, tensor_id: TensorId) -> Optional[Tuple[int, int]]:
+        """ Returns the block of a tensor and its offset within the block, or None if outside the blocks. """
+        if not isinstance(tensor_id, OrdinalTensorId) or not self.start <= tensor_id.ordinal < self.end:
             return None
+        return divmod(tensor_id.ordinal - self.start, self.period)
+
+    def project(self, tensor_id: TensorId, block: int) -> Optional[OrdinalTensorId]:
+        """ Returns the id of the same tensor in another block. """
+        location = self.locate(tensor_id)
+        if location is None or not 0 <= block < self.count:
+            return None
+        return OrdinalTensorId(ordinal=self.start + block * self.period + location[1])
+
+    def block_tensor_ids(self, block: int) -> List[OrdinalTensorId]:
+        """ Returns the ids of all tensors in a block. """
+        first = self.start + block * self.period
+        return [OrdinalTensorId(ordinal=i) for i in range(first, first + self.period)]
+
+
+def _mix(x: np.ndarray) -> np.ndarray:
+    """ splitmix64 finalizer, used to hash uint64 arrays. """
+    x = x + np.uint64(0x9e3779b97f4a7c15)
+    x = (x ^ (x >> np.uint64(30))) * np.uint64(0xbf58476d1ce4e5b9)
+    x = (x ^ (x >> np.uint64(27))) * np.uint64(0x94d049bb133111eb)
+    return x ^ (x >> np.uint64(31))
+
+
+def _structural_labels(g: CompactGraph) -> np.ndarray:
+    """
+    Returns a structural label for every tensor ordinal of a graph (ordinals not in the graph get a unique
+    negative label). The label of a tensor hashes its shape and producing op, along with the ops, shapes and
+    constants that op consumes.
+    """
+    n = len(g)
+
+    # node labels: shapes of tensors, op names of ops, values of constants
+    dims = g.shape_dims.astype(np.uint64)
+    dim_positions = np.arange(len(dims), dtype=np.int64) - np.repeat(g.shape_offsets[:-1], np.diff(g.shape_offsets))
+    dim_hashes = np.concatenate([
+        np.zeros(1, dtype=np.uint64),
+        np.cumsum(_mix(dims + _mix(dim_positions.astype(np.uint64))), dtype=np.uint64),
+    ])
+    shape_hashes = dim_hashes[g.shape_offsets[1:]] - dim_hashes[g.shape_offsets[:-1]]
+
+    op_names = np.fromiter(
+        (origin.op_id if origin is not None else -1 for origin in g.origins),
+        dtype=np.int64,
+        count=n,
+    )
+    constants = np.zeros(n, dtype=np.uint64)
+    for node, value in g.constants.items():
+        constants[node] = hash(value) & 0xffffffffffffffff
+
+    node_labels = _mix(
+        _mix(g.kinds.astype(np.uint64)) ^ _mix(shape_hashes) ^
+        _mix(g.ops.astype(np.uint64) + (op_names.astype(np.uint64) << np.uint64(16))) ^ _mix(constants)
+    )
+
+    # combine each node with the (unordered) labels of its predecessors, twice,
+    # so that a tensor covers its producing op and that op's arguments
+    src = np.repeat(np.arange(n, dtype=np.int64), np.diff(g.succ_offsets))
+    labels = node_labels
+    for _ in range(2):
+        pred_sums = np.zeros(n, dtype=np.uint64)
+        np.add.at(pred_sums, g.succ_indices, _mix(labels[src]))
+        labels = _mix(node_labels ^ _mix(pred_sums))
+
+    tensor_nodes = np.nonzero(g.kinds == NodeKind.TENSOR)[0]
+    num_ordinals = int(g.ordinals[tensor_nodes].max()) + 1 if len(tensor_nodes) > 0 else 0
+    result = -1 - np.arange(num_ordinals, dtype=np.int64)
+    result[g.ordinals[tensor_nodes]] = (labels[tensor_nodes] >> np.uint64(1)).astype(np.int64)
+    return result
+
+
+def _candidate_periods(labels: np.ndarray, max_candidates=8) -> List[int]:
+    """ Returns likely block lengths: the most common distances between repeated occurrences of a label. """
+    order = np.lexsort((np.arange(len(labels)), labels))
+    sorted_labels = labels[order]
+
+    distances = collections.Counter()
+    for skip in (1, 2, 3):
+        same = sorted_labels[skip:] == sorted_labels[:-skip]
+        distances.update((order[skip:][same] - order[:-skip][same]).tolist())
+
+    return [d for d, _ in distances.most_common(max_candidates) if d > 0]
+
+
+def find_repeated_blocks(g: CompactGraph, *, min_count=2) -> Optional[RepeatedBlockLayout]:
+    """
+    Detects the longest run of structurally identical blocks in the tensor ordinals of a graph.
+    Returns None if the graph has no repeated structure.
+    """
+    return _find_repeated_blocks(_structural_labels(g), min_count=min_count)
+
+
+def _find_repeated_blocks(labels: np.ndarray, *, min_count: int) -> Optional[RepeatedBlockLayout]:
+    best = None
+    for period in sorted(_candidate_periods(labels)):
+        if period >= len(labels):
+            continue
+
+        # longest run of ordinals whose label equals the label one period later
+        same = np.concatenate([[False], labels[:-period] == labels[period:], [False]])
+        edges = np.flatnonzero(np.diff(same.astype(np.int8)))
+        if len(edges) == 0:
+            continue
+        run_starts, run_ends = edges[0::2], edges[1::2]
+        longest = int(np.argmax(run_ends - run_starts))
+        start, end = int(run_starts[longest]), int(run_ends[longest]) + period
+
+        count = (end - start) // period
+        if count >= min_count and (best is None or count * period > best.count * best.period):
+            best = RepeatedBlockLayout(start=start, period=period, count=count)
+
+    return best
+
 
-        assert isinstance(p, list)
-        assert isinstance(p[0], tuple)
-        top = p[0]
-        op = top[0]
-        p_preds = top[1:]
-
-        if isinstance(node, OpNode) and node.op == op:
-            node_preds = set(cg.g.predecessors(node))
-            used_preds = set()
-
-            for p_pred in p_preds:
-                for pred in node_preds - used_preds:
-                    if walk(start, pred, p_pred) is not None:
-                        # found a match
-                        used_preds.add(pred)
-                        break
-                else:
-                    # no match for predecessor
-                    return None
-
-            # passed predecessor checks
-
-            # skip tensor node below op node
-            succs = list(cg.g.successors(node))
-            if len(succs) != 1 or not isinstance(succs[0], (TensorNode, TensorStubNode)):
+def _instance_tensor_ids(instance) -> List[TensorId]:
+    return [
+        value.tensor_id
+        for value in (getattr(instance, field.name) for field in dataclasses.fields(instance))
+        if isinstance(value, BaseTensorNode)
+    ]
+
+
+def _relocate_instance(instance, g: CompactGraph, delta: int):
+    """ Returns a copy of an instance with all tensor nodes replaced by the nodes of g, shifted by delta ordinals. """
+    changes = {}
+    for field in dataclasses.fields(instance):
+        value = getattr(instance, field.name)
+        if isinstance(value, BaseTensorNode):
+            node = g.tensor_node_index(OrdinalTensorId(ordinal=value.tensor_id.ordinal + delta))
+            if node is None:
                 return None
-            node = succs[0]
+            changes[field.name] = g.node(node)
+    return dataclasses.replace(instance, **changes)
+
+
+def search_repeated_blocks(g: CompactGraph, search: Callable[[CompactGraph], Iterable], *, min_count=3) -> list:
+    """
+    Runs a structure search once per block template instead of on the whole graph.
+
+    If the graph consists of repeated blocks (see find_repeated_blocks), search() only sees a window of
+    the graph made of everything before the blocks, the first two blocks, the last block and everything
+    after it. Instances starting in the first block (they may reach into the second one) are projected to
+    every block. Other instances are only kept if they lie before or after the blocks, or reach from before
+    them into the first two. Instances in later blocks are dropped, as their context is cut off in the window.
+    Instances must be dataclasses whose tensor nodes are BaseTensorNode fields. Results are ordered by
+    tensor ordinal.
+    """
+    labels = _structural_labels(g)
+    layout = _find_repeated_blocks(labels, min_count=min_count)
+    if layout is None:
+        return list(search(g))
+
+    # non-tensor nodes belong to the ordinal of the tensor they (eventually) produce
+    node_ordinals = np.where(g.kinds == NodeKind.TENSOR, g.ordinals, np.iinfo(np.int64).max)
+    for _ in range(2):
+        src = np.repeat(np.arange(len(g), dtype=np.int64), np.diff(g.succ_offsets))
+        np.minimum.at(node_ordinals, src, node_ordinals[g.succ_indices])
+
+    in_window = (
+        (node_ordinals < layout.start + 2 * layout.period) |
+        (node_ordinals >= layout.end - layout.period)
+    )
+    window = g.subgraph(np.nonzero(in_window)[0])
+
+    results = {}
+    for instance in search(window):
+        tensor_ids = _instance_tensor_ids(instance)
+        locations = [layout.locate(tensor_id) for tensor_id in tensor_ids]
+
+        blocks = [location[0] for location in locations if location is not None]
+        if not blocks:
+            # wholly outside the blocks
+            deltas = [0]
+        elif len(blocks) == len(locations) and min(blocks) == 0:
+            deltas = [k * layout.period for k in range(layout.count)]
+        elif max(blocks) <= 1 and min(tensor_id.ordinal for tensor_id in tensor_ids) < layout.start:
+            # reaches from before the blocks into them, the window holds all of its context
+            deltas = [0]
+        else:
+            # anchored in block 1 (where it may be cut off by the window) or in the last block,
+            # the projections of block 0 cover it
+            continue
 
-            # continue down successor line
-            for succ in list(cg.g.successors(node)):
-                m = walk(start, succ, p[1:])
-                if m is not None:
-                    return m
+        for delta in deltas:
+            # projections are only kept where the structure of every tensor matches
+            ordinals = [tensor_id.ordinal + delta for tensor_id in tensor_ids]
+            if any(
+                    not 0 <= ordinal < len(labels) or labels[ordinal] != labels[tensor_id.ordinal]
+                    for ordinal, tensor_id in zip(ordinals, tensor_ids)
+            ):
+                continue
 
-        return None
+            relocated = _relocate_instance(instance, g, delta)
+            if relocated is not None:
+                key = (tuple(ordinals), tuple(
+                    getattr(instance, field.name) for field in dataclasses.fields(instance)
+                    if not isinstance(getattr(instance, field.name), GraphNode)
+                ))
+                results.setdefault(key, relocated)
 
-    for node in cg.g.nodes:
-        match = walk(node, node, pattern)
-        if match is not None:
-            yield match
+    return [results[key] for key in sorted(results, key=lambda key: key[0])]
 
 
 @dataclass
@@ -69,20 +313,35 @@ class MultiHeadAttentionInstance:
     num_heads: int
 
 
-def find_multi_head_attention(cg: NiceComputationGraph) -> Generator[MultiHeadAttentionInstance, None, None]:
-    results = _find_simple_chain_pattern(cg, [
+def find_multi_head_attention(
+        cg: NiceComputationGraph,
+        *,
+        repeated_blocks=False,
+) -> Iterable[MultiHeadAttentionInstance]:
+    """
+    Finds multi head attention by its softmax. With repeated_blocks, the search only runs on one block
+    template of the graph (see search_repeated_blocks), which is faster on deep models, but misses
+    instances in blocks that differ from the template.
+    """
+    if repeated_blocks:
+        return search_repeated_blocks(cg.g, _find_multi_head_attention)
+    return _find_multi_head_attention(cg.g)
+
+
+def _find_multi_head_attention(g: CompactGraph) -> Generator[MultiHeadAttentionInstance, None, None]:
+    results = BasicChainFinder(g, [
         (TensorOp.SOFTMAX,),
-    ])
+    ]).search()
 
     softmax = [start for start, _ in results]
-    softmax = weak_topological_sort(cg.g, softmax)
+    softmax = weak_topological_sort(g, softmax)
 
     for softmax_node in softmax:
-        succs = list(cg.g.successors(softmax_node))
+        succs = g.successors(softmax_node)
         if len(succs) != 1:
             continue
 
-        succ = succs[0]
+        succ = g.node(succs[0])
         if not isinstance(succ, TensorStubNode):
             continue
 
@@ -111,32 +370,35 @@ class SearchExtent:
 
 
 class GraphPatternFinder:
-    def __init__(self, g: nx.DiGraph):
+    def __init__(self, g: CompactGraph):
         self.g = g
+        self.index = get_graph_index(g)
 
     def search(self, extent: Optional[SearchExtent] = None) -> Iterable:
         raise NotImplementedError()
 
 
 class BasicGraphPatternFinder(GraphPatternFinder):
-    def check_node(self, node):
+    candidate_ops: Optional[Tuple[TensorOp, ...]] = None
+    """ If set, only op nodes with one of these ops are checked. """
+
+    def check_node(self, node: int):
         raise NotImplementedError()
 
     def _iter_searchable_nodes(self, rng: Optional[SearchExtent]):
-        # TODO: this is an expensive function that should be cached
-        #       for nested finders, this will be called a lot in a redundant manner.
-        nodes = set(self.g.nodes)
-
+        start = end = None
         if rng is not None:
             if rng.start is not None:
-                # include only nodes reachable from start
-                nodes = nodes & ({rng.start} | set(nx.descendants(self.g, rng.start)))
-
+                start = self.g.index_of(rng.start)
             if rng.end is not None:
-                # include only nodes that reach end
-                nodes = nodes & ({rng.end} | set(nx.ancestors(self.g, rng.end)))
+                end = self.g.index_of(rng.end)
 
-        yield from weak_topological_sort(self.g, nodes)
+        if self.candidate_ops is None:
+            nodes = self.index.extent_nodes(start, end)
+        else:
+            nodes = self.index.filter_extent(self.index.nodes_with_op(*self.candidate_ops), start, end)
+
+        yield from nodes.tolist()
 
     def search(self, rng: Optional[SearchExtent] = None):
         for node in self._iter_searchable_nodes(rng):
@@ -146,60 +408,24 @@ class BasicGraphPatternFinder(GraphPatternFinder):
 
 
 class BasicChainFinder(BasicGraphPatternFinder):
-    def __init__(self, g: nx.DiGraph, pattern):
-        super().__init__(g)
-        self.pattern = pattern
-
-    def _walk(self, start, node, p):
-        # empty pattern, empty match
-        if not p:
-            return start, node
+    """
+    Finds chains of ops. Matches are (start, end) node id pairs.
+    """
 
-        # match against constant
-        if isinstance(p, (int, float)):
-            if isinstance(node, ConstantNode) and abs(node.value - p) < 1e-6:
-                return start, node
-            return None
-
-        assert isinstance(p, list)
-        assert isinstance(p[0], tuple)
-        top = p[0]
-        op = top[0]
-        p_preds = top[1:]
-
-        if isinstance(node, OpNode) and node.op == op:
-            node_preds = set(self.g.predecessors(node))
-            used_preds = set()
-
-            for p_pred in p_preds:
-                for pred in node_preds - used_preds:
-                    if self._walk(start, pred, p_pred) is not None:
-                        # found a match
-                        used_preds.add(pred)
-                        break
-                else:
-                    # no match for predecessor
-                    return None
-
-            # passed predecessor checks
-
-            # skip tensor node below op node
-            succs = list(self.g.successors(node))
-            if len(succs) != 1 or not isinstance(succs[0], (TensorNode, TensorStubNode)):
-                return None
-            node = succs[0]
+    def __init__(self, g: CompactGraph, pattern):
+        super().__init__(g)
+        self.pattern = _compile_chain_pattern(pattern)
 
-            # continue down successor line
-            for succ in list(self.g.successors(node)):
-                m = self._walk(start, succ, p[1:])
-                if m is not None:
-                    return m
+        # only nodes with the op of the pattern head can start a match
+        if self.pattern:
+            self.candidate_ops = (self.pattern[0][0],)
 
+    def check_node(self, node: int):
+        end = _walk_chain(self.g, node, self.pattern, self.index.chain_walks)
+        if end is not None:
+            return node, end
         return None
 
-    def check_node(self, node: GraphNode):
-        return self._walk(node, node, self.pattern)
-
 
 class ActivationKind(int, Enum):
     GELU = auto()
@@ -213,18 +439,20 @@ class ActivationInstance:
 
 
 class FindGELU(BasicGraphPatternFinder):
+    candidate_ops = (TensorOp.GELU,)
+
     def check_node(self, node):
-        if isinstance(node, OpNode) and node.op == TensorOp.GELU:
-            succs = list(self.g.successors(node))
-            if len(succs) == 1 and isinstance(succs[0], BaseTensorNode):
+        if self.g.op(node) == TensorOp.GELU:
+            succs = self.g.successors(node)
+            if len(succs) == 1 and self.g.kinds[succs[0]] == NodeKind.TENSOR:
                 return ActivationInstance(
                     kind=ActivationKind.GELU,
-                    result_node=succs[0],
+                    result_node=self.g.node(succs[0]),
                 )
 
 
 class FindNewGELU(BasicChainFinder):
-    def __init__(self, g: nx.DiGraph):
+    def __init__(self, g: CompactGraph):
         super().__init__(g, _NEW_GELU_PATTERN)
 
     def search(self, rng: Optional[SearchExtent] = None):
@@ -232,13 +460,13 @@ class FindNewGELU(BasicChainFinder):
 
         for _, end_node in matches:
             # go up one node to get the resulting tensor
-            preds = list(self.g.predecessors(end_node))
+            preds = self.g.predecessors(end_node)
             assert len(preds) == 1
             result_node = preds[0]
 
             yield ActivationInstance(
                 kind=ActivationKind.NEW_GELU,
-                result_node=result_node,
+                result_node=self.g.node(result_node),
             )
 
 
@@ -256,32 +484,36 @@ class FindActivation(GraphPatternFinder):
 
 
 class FindLinear(BasicGraphPatternFinder):
+    candidate_ops = (TensorOp.ADDMM, TensorOp.LINEAR)
+
     def check_node(self, node):
-        if isinstance(node, OpNode):
-            if node.op in (TensorOp.ADDMM, TensorOp.LINEAR):
-                succs = list(self.g.successors(node))
-                if len(succs) == 1 and isinstance(succs[0], BaseTensorNode):
-                    return succs[0]
+        if self.g.op(node) in (TensorOp.ADDMM, TensorOp.LINEAR):
+            succs = self.g.successors(node)
+            if len(succs) == 1 and self.g.kinds[succs[0]] == NodeKind.TENSOR:
+                return self.g.node(succs[0])
 
 
 def pair_closest_descendants(
-        g: nx.DiGraph,
+        g: CompactGraph,
         src_set,
         dst_set,
         *,
         max_dist_error=0,
 ):
-    closest = {}
-    for src in tqdm(src_set):
-        candidates = [
-            (dst, nx.shortest_path_length(g, src, dst))
-            for dst in dst_set
-            if nx.has_path(g, src, dst)
-        ]
+    """
+    Pairs each source with its closest descendant among the destinations.
+    Only pairs within max_dist_error of the closest pair overall are returned.
+    """
+    dst_set = list(dst_set)
 
-        candidates.sort(key=lambda p: p[1])
-        if candidates:
-            closest[src] = candidates[0]
+    # a single reverse search from all destinations finds the closest one of every node
+    dist, nearest = g.multi_source_bfs([g.index_of(dst) for dst in dst_set], reverse=True)
+
+    closest = {}
+    for src in src_set:
+        src_index = g.index_of(src)
+        if nearest[src_index] >= 0:
+            closest[src] = (dst_set[nearest[src_index]], int(dist[src_index]))
 
     if not closest:
         return {}
@@ -304,12 +536,23 @@ class TransformerFFNInstance:
 
 
 class FindTransformerFFN(GraphPatternFinder):
-    def __init__(self, g: nx.DiGraph):
+    def __init__(self, g: CompactGraph, *, repeated_blocks=False):
+        """ See find_multi_head_attention for repeated_blocks. """
         super().__init__(g)
         self._find_linear = FindLinear(g)
         self._find_act = FindActivation(g)
+        self._repeated_blocks = repeated_blocks
 
     def search(self, extent: Optional[SearchExtent] = None):
+        if extent is None and self._repeated_blocks:
+            # search a single block template and project it to every block
+            return iter(search_repeated_blocks(
+                self.g,
+                lambda window: FindTransformerFFN(window, repeated_blocks=False).search(),
+            ))
+        return self._search(extent)
+
+    def _search(self, extent: Optional[SearchExtent]):
         linears = list(self._find_linear.search(extent))
         activations = list(self._find_act.search(extent))
 
@@ -340,4 +583,3 @@ class FindTransformerFFN(GraphPatternFinder):
                 act=act_node,
                 linear_bottom=linear_bottom,
             )
-
@@ -0,0 +1,214 @@
+import dataclasses
+import hashlib
+import json
+import os
+import pickle
+from dataclasses import dataclass
+from typing import Optional, List, Callable, Dict
+
+from fmrai.analysis.structure import MultiHeadAttentionInstance, TransformerFFNInstance, find_multi_head_attention, \
+    FindTransformerFFN
+from fmrai.fmrai import get_fmrai
+from fmrai.instrument import InstrumentationBackend, get_current_instrumentation_state
+from fmrai.logging import get_structure_cache_dir
+from fmrai.tracker import NiceComputationGraph, SingleComputationTracker, BaseTensorNode, TensorId
+
+
+def _get_model_config(model) -> Optional[dict]:
+    config = getattr(model, 'config', None)
+    if config is None:
+        return None
+    if hasattr(config, 'to_dict'):
+        return config.to_dict()
+    if isinstance(config, dict):
+        return config
+    return None
+
+
+_KEY_SCHEME_VERSION = 2
+""" Bump whenever tensor ids (or the cached results) change meaning, so stale cache entries are never hit. """
+
+
+def model_fingerprint(model, backend: InstrumentationBackend) -> str:
+    """
+    Returns a fingerprint of a model's structure: its class, config and parameter/buffer shapes.
+    Tensor ids depend on the instrumentation backend and on the key scheme version, so both are part of
+    the fingerprint too.
+    """
+    h = hashlib.sha256()
+    h.update(f'version={_KEY_SCHEME_VERSION}\n'.encode())
+    h.update(f'{type(model).__module__}.{type(model).__qualname__}\n'.encode())
+    h.update(f'backend={backend.name}\n'.encode())
+    h.update(json.dumps(_get_model_config(model), sort_keys=True, default=str).encode())
+
+    for kind, named_tensors in (('parameter', model.named_parameters()), ('buffer', model.named_buffers())):
+        for name, tensor in named_tensors:
+            h.update(f'\n{kind} {name} {tuple(tensor.shape)} {tensor.dtype}'.encode())
+
+    return h.hexdigest()
+
+
+def current_model_fingerprint() -> Optional[str]:
+    """ Returns the fingerprint of the model added to the current fmrai instance, if there is one. """
+    model = get_fmrai().root_model
+    if model is None:
+        return None
+    return model_fingerprint(model, get_current_instrumentation_state().backend)
+
+
+@dataclass
+class ModelStructure:
+    """
+    Structure detection results of a model. Parts that were not searched for yet are None.
+    """
+    num_tensors: Optional[int] = None
+    """ Number of tensors seen in the probe the results were found in. """
+
+    trace_signature: Optional[int] = None
+    """ Trace signature of the probe, see SingleComputationTracker.trace_signature. """
+
+    attention: Optional[List[MultiHeadAttentionInstance]] = None
+    ffns: Optional[List[TransformerFFNInstance]] = None
+
+
+class StructureCache:
+    """
+    Persistent cache of ModelStructure results, keyed by model fingerprint and trace signature.
+    Inputs that run different operations (e.g. a probe and a real batch) get entries of their own,
+    up to max_signatures per model (the least recently stored ones are dropped).
+    """
+
+    def __init__(self, *, root_dir: Optional[str] = None, max_signatures: int = 8):
+        self.dir_path = get_structure_cache_dir(root_dir=root_dir)
+        self.max_signatures = max_signatures
+
+    def _get_path(self, fingerprint: str):
+        return os.path.join(self.dir_path, f'{fingerprint}.pickle')
+
+    def load_all(self, fingerprint: str) -> Dict[Optional[int], ModelStructure]:
+        """ Returns the cached structures of a model by trace signature, least recently stored first. """
+        try:
+            with open(self._get_path(fingerprint), 'rb') as f:
+                structures = pickle.load(f)
+        except (OSError, EOFError, pickle.UnpicklingError, AttributeError):
+            # missing, partially written or stale entries count as misses
+            return {}
+
+        if not isinstance(structures, dict):
+            return {}
+        return {
+            trace_signature: structure
+            for trace_signature, structure in structures.items()
+            if isinstance(structure, ModelStructure)
+        }
+
+    def load(self, fingerprint: str, trace_signature: Optional[int] = None) -> Optional[ModelStructure]:
+        """ Returns the structure cached for a trace signature, or the most recently stored one if it is None. """
+        structures = self.load_all(fingerprint)
+        if trace_signature is not None:
+            return structures.get(trace_signature)
+        return next(reversed(structures.values()), None)
+
+    def save(self, fingerprint: str, structures: Dict[Optional[int], ModelStructure]):
+        os.makedirs(self.dir_path, exist_ok=True)
+
+        # write atomically, concurrent readers see either the old or the new entry
+        path = self._get_path(fingerprint)
+        tmp_path = f'{path}.{os.getpid()}.tmp'
+        with open(tmp_path, 'wb') as f:
+            pickle.dump(structures, f)
+        os.replace(tmp_path, path)
+
+    def update(self, fingerprint: str, structure: ModelStructure):
+        """ Stores the parts of a structure that are set, keeping parts previously cached for its trace signature. """
+        structures = self.load_all(fingerprint)
+        cached = structures.pop(structure.trace_signature, None)
+        if cached is not None:
+            for name in ('attention', 'ffns'):
+                if getattr(structure, name) is None:
+                    setattr(structure, name, getattr(cached, name))
+
+        structures[structure.trace_signature] = structure
+        while len(structures) > self.max_signatures:
+            del structures[next(iter(structures))]
+        self.save(fingerprint, structures)
+
+
+def get_structural_ids(tracker: SingleComputationTracker, tensor_ids) -> Dict[TensorId, TensorId]:
+    """ Maps tensor ids to their structural ids (ids without one are kept). """
+    result = {}
+    for tensor_id in tensor_ids:
+        structural_id = tracker.structural_id(tensor_id)
+        result[tensor_id] = structural_id if structural_id is not None else tensor_id
+    return result
+
+
+def with_structural_ids(instances: Optional[list], tracker: SingleComputationTracker) -> Optional[list]:
+    """ Replaces the tensor ids of all tensor nodes in structure instances with structural ids. """
+    if instances is None:
+        return None
+
+    def convert(instance):
+        changes = {}
+        for field in dataclasses.fields(instance):
+            value = getattr(instance, field.name)
+            if isinstance(value, BaseTensorNode):
+                structural_id = tracker.structural_id(value.tensor_id)
+                if structural_id is not None:
+                    changes[field.name] = dataclasses.replace(value, tensor_id=structural_id)
+        return dataclasses.replace(instance, **changes)
+
+    return [convert(instance) for instance in instances]
+
+
+def find_structure(
+        cg: NiceComputationGraph,
+        tracker: SingleComputationTracker,
+        *,
+        attention=False,
+        ffns=False,
+) -> ModelStructure:
+    """
+    Runs the requested structure searches on the graph of a tracker.
+    Tensors in the results are identified by structural ids, so they can be tracked for inputs of any shape.
+    """
+    return ModelStructure(
+        num_tensors=tracker.num_seen_tensors,
+        trace_signature=tracker.trace_signature,
+        attention=with_structural_ids(list(find_multi_head_attention(cg)) if attention else None, tracker),
+        ffns=with_structural_ids(list(FindTransformerFFN(cg.g).search()) if ffns else None, tracker),
+    )
+
+
+def probe_model_structure(
+        probe: Callable[[], None],
+        *,
+        model=None,
+        cache: Optional[StructureCache] = None,
+        attention=False,
+        ffns=False,
+) -> ModelStructure:
+    """
+    Returns the structure of a model, running probe() under a graph building tracker only if
+    the requested parts are not cached yet. model defaults to the model added to fmrai.
+    """
+    fmr = get_fmrai()
+    if model is None:
+        model = fmr.root_model
+
+    fingerprint = None
+    if cache is not None and model is not None:
+        fingerprint = model_fingerprint(model, get_current_instrumentation_state().backend)
+        for structure in reversed(cache.load_all(fingerprint).values()):
+            if (not attention or structure.attention is not None) and (not ffns or structure.ffns is not None):
+                return structure
+
+    with fmr.track(graph=True) as tracker:
+        probe()
+        cg = tracker.build_graph()
+
+    structure = find_structure(cg, tracker, attention=attention, ffns=ffns)
+    if fingerprint is not None:
+        cache.update(fingerprint, structure)
+
+    return structure
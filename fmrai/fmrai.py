@@ -1,9 +1,51 @@
 import contextlib
+import random
 from typing import Optional, Generator, Union, Iterable
 
-from fmrai.instrument import instrumentation_scope, get_current_instrumentation_state, pause_instrumentation
+from fmrai.instrument import instrumentation_scope, get_current_instrumentation_state, pause_instrumentation, \
+    suspend_instrumentation, InstrumentationBackend
 from fmrai.logging import log_model, log_model_parameters
-from fmrai.tracker import SingleComputationTracker, BatchedComputationTracker, TensorId
+from fmrai.storage import StoragePolicy, MemoryBudget
+from fmrai.tracker import SingleComputationTracker, BatchedComputationTracker, TrackedTensors
+
+
+class Sampler:
+    """
+    Decides which steps (e.g. forward passes of a training loop) are instrumented.
+    Instrumentation is suspended during other steps, so they run at native speed.
+    """
+
+    def __init__(self, *, every: Optional[int] = None, probability: Optional[float] = None, seed=None):
+        if (every is None) == (probability is None):
+            raise Exception('Either every or probability must be given')
+        if every is not None and every < 1:
+            raise Exception(f'Cannot sample every {every} steps')
+        if probability is not None and not 0 <= probability <= 1:
+            raise Exception(f'Cannot sample with probability {probability}')
+
+        self.every = every
+        self.probability = probability
+        self._random = random.Random(seed)
+        self._current_step = 0
+        self.sampled_steps = 0
+
+    def _is_sampled(self) -> bool:
+        if self.every is not None:
+            return self._current_step % self.every == 0
+        return self._random.random() < self.probability
+
+    @contextlib.contextmanager
+    def step(self) -> Generator[bool, None, None]:
+        """ Runs a single step, yields whether it is sampled (i.e. instrumented). """
+        sampled = self._is_sampled()
+        self._current_step += 1
+
+        if sampled:
+            self.sampled_steps += 1
+            yield True
+        else:
+            with suspend_instrumentation():
+                yield False
 
 
 class Fmrai:
@@ -17,22 +59,71 @@ class Fmrai:
         if log_parameters:
             log_model_parameters(model, time_step=0)
 
+    @property
+    def root_model(self):
+        """ The added model, if exactly one model was added. """
+        if len(self._models) == 1:
+            return self._models[0]
+        return None
+
     def track(
             self,
             *,
             batched=False,
-            track_tensors: Optional[Iterable[TensorId]] = None,
+            track_tensors: Optional[TrackedTensors] = None,
+            graph: Optional[bool] = None,
+            include_modules: Optional[Iterable[str]] = None,
+            elide_views: bool = False,
+            storage: StoragePolicy = StoragePolicy.FULL,
+            budget: Optional[MemoryBudget] = None,
     ) -> Union[SingleComputationTracker, BatchedComputationTracker]:
+        """
+        Creates a new tracker.
+        By default, a computation graph is built only by non-batched trackers
+        that don't limit the tracked tensors (probe runs).
+        track_tensors may map tensor ids to reducers, e.g. {tensor_id: Reducer.max(dim=1)}.
+        include_modules limits tracking to modules whose path matches one of the given globs
+        (e.g. '*.attention.*'), operations elsewhere run without any instrumentation overhead.
+        elide_views records views of captured tensors as aliases instead of copying them.
+        storage sets the precision captured tensors are kept in (e.g. StoragePolicy.FLOAT16).
+        budget (e.g. MemoryBudget(4 << 30)) spills the oldest captured tensors to disk once exceeded.
+        """
         if batched:
-            tracker = BatchedComputationTracker(track_tensors=track_tensors)
+            tracker = BatchedComputationTracker(
+                track_tensors=track_tensors,
+                graph=bool(graph),
+                include_modules=include_modules,
+                elide_views=elide_views,
+                storage=storage,
+                budget=budget,
+            )
         else:
-            tracker = SingleComputationTracker(track_tensors=track_tensors)
+            tracker = SingleComputationTracker(
+                track_tensors=track_tensors,
+                graph=graph,
+                include_modules=include_modules,
+                elide_views=elide_views,
+                storage=storage,
+                budget=budget,
+            )
 
-        if len(self._models) == 1:
-            tracker.set_root_model(self._models[0])
+        if self.root_model is not None:
+            tracker.set_root_model(self.root_model)
 
         return tracker
 
+    def sample(self, *, every: Optional[int] = None, probability: Optional[float] = None, seed=None) -> Sampler:
+        """
+        Returns a sampler that instruments only every n-th step (or steps with the given probability),
+        so fmrai can stay attached to a loop, e.g.:
+
+            sampler = fmr.sample(every=100)
+            for batch in loader:
+                with sampler.step() as sampled:
+                    ...
+        """
+        return Sampler(every=every, probability=probability, seed=seed)
+
     @contextlib.contextmanager
     def pause(self):
         with pause_instrumentation():
@@ -40,11 +131,11 @@ class Fmrai:
 
 
 @contextlib.contextmanager
-def fmrai() -> Generator[Fmrai, None, None]:
+def fmrai(*, backend=InstrumentationBackend.PROXY) -> Generator[Fmrai, None, None]:
     fmr = Fmrai()
 
     try:
-        with instrumentation_scope() as state:
+        with instrumentation_scope(backend=backend) as state:
             state.fmr = fmr
             yield fmr
     finally:
@@ -1,28 +1,62 @@
 import contextlib
+import fnmatch
 import functools
 import inspect
 import types
-from dataclasses import dataclass
+import zlib
+from array import array
+from dataclasses import dataclass, field
+from enum import Enum, auto
 from functools import wraps
-from typing import Union, Any, Dict, Callable, Optional, List, Tuple, FrozenSet
+from typing import Union, Any, Dict, Callable, Optional, List, Tuple, FrozenSet, Iterable, Set
 
+import numpy as np
 import torch
 from torch import Tensor, nn
+from torch.overrides import TorchFunctionMode, _get_current_function_mode, _pop_mode_temporarily
 
 import bitsandbytes
 
 
+class InstrumentationBackend(int, Enum):
+    PROXY = auto()
+    """ Swaps the functions in _INSTRUMENTABLE_FUNCTIONS and wraps every tensor in a TensorProxy. """
+
+    FUNCTION_MODE = auto()
+    """ Intercepts every torch function via a TorchFunctionMode and tags the resulting tensors in place. """
+
+
 @dataclass
 class InstrumentationState:
     original_functions: Dict[str, Callable]
-    new_tensor_callbacks: List[Callable[['TensorProxy'], None]]
+    new_tensor_callbacks: List[Callable[[Union['TensorProxy', Tensor]], None]]
     seen_modules: List[nn.Module]
     param_to_name: Dict[nn.Parameter, str]
     track_origin: bool = True
     fmr: Optional['Fmrai'] = None
     disabled: int = 0
     origin_counter: int = 0
+    origins: 'OriginTable' = field(default_factory=lambda: OriginTable(base_index=0))
+    origin_generation: int = 0
+    """ Bumped with every new origin table, tensors tagged in earlier generations are tagged again (see _is_tagged). """
     call_depth: int = 0
+    backend: InstrumentationBackend = InstrumentationBackend.PROXY
+    function_mode: Optional[TorchFunctionMode] = None
+    hook_handles: List[Any] = field(default_factory=list)
+    hooked_modules: Set[nn.Module] = field(default_factory=set)
+    """ Modules that already have the function mode hooks, so instrumenting a model twice does not stack them. """
+    module_paths: Dict[nn.Module, str] = field(default_factory=dict)
+    module_id: int = -1
+    """ Interned path of the module currently running, or -1 outside of any (known) module. """
+    module_stack: List[Tuple[int, bool]] = field(default_factory=list)
+    include_modules: Optional[Tuple[str, ...]] = None
+    module_included: bool = True
+    """ Whether operations of the current module are instrumented (see set_module_filter). """
+    inplace_op_callbacks: List[Callable[[], None]] = field(default_factory=list)
+    """ Called before every in-place operation, see add_inplace_op_callback. """
+    suspended: bool = False
+    """ Whether native torch functions are swapped back in, see suspend_instrumentation. """
+    suspended_functions: Dict[str, Callable] = field(default_factory=dict)
 
 
 _CURRENT_INSTRUMENTATION_STATE: Optional[InstrumentationState] = None
@@ -45,6 +79,79 @@ def remove_new_tensor_callback(fn):
         state.new_tensor_callbacks.remove(fn)
 
 
+def add_inplace_op_callback(fn):
+    """
+    Registers a function that is called before every in-place operation (add_, __setitem__, ...)
+    is executed, e.g. to order it after pending asynchronous reads of the tensors it modifies.
+    """
+    get_current_instrumentation_state().inplace_op_callbacks.append(fn)
+
+
+def remove_inplace_op_callback(fn):
+    state = get_current_instrumentation_state()
+    if fn in state.inplace_op_callbacks:
+        state.inplace_op_callbacks.remove(fn)
+
+
+_INPLACE_DUNDER_OPS = frozenset([
+    '__setitem__', '__iadd__', '__isub__', '__imul__', '__itruediv__', '__ifloordiv__', '__imod__',
+    '__ipow__', '__imatmul__', '__iand__', '__ior__', '__ixor__', '__ilshift__', '__irshift__',
+])
+
+
+def _is_inplace_op(name: str) -> bool:
+    return (name.endswith('_') and not name.endswith('__')) or name in _INPLACE_DUNDER_OPS
+
+
+def _notify_inplace_op(state: InstrumentationState):
+    state.disabled += 1
+    try:
+        for callback in state.inplace_op_callbacks:
+            callback()
+    finally:
+        state.disabled -= 1
+
+
+@functools.lru_cache(maxsize=None)
+def _matches_module_filter(path: str, include_modules: Tuple[str, ...]) -> bool:
+    return any(fnmatch.fnmatchcase(path, pattern) for pattern in include_modules)
+
+
+def set_module_filter(include_modules: Optional[Iterable[str]]):
+    """
+    Limits instrumentation to modules whose path (e.g. encoder.layer.3.attention.self) matches one
+    of the given globs, and to their submodules. Operations outside of them are neither tagged nor
+    passed to new tensor callbacks. None instruments everything again.
+    """
+    state = get_current_instrumentation_state()
+    state.include_modules = tuple(include_modules) if include_modules is not None else None
+    state.module_included = state.include_modules is None or (
+        state.module_id != -1 and _matches_module_filter(_INTERNED_NAMES[state.module_id], state.include_modules)
+    )
+
+
+def _enter_module(state: InstrumentationState, module: nn.Module):
+    state.module_stack.append((state.module_id, state.module_included))
+
+    path = state.module_paths.get(module)
+    if path is None:
+        # modules that are not part of an instrumented model keep the path of their caller
+        return
+
+    state.module_id = intern_name(path)
+    if not state.module_included:
+        state.module_included = _matches_module_filter(path, state.include_modules)
+
+
+def _exit_module(state: InstrumentationState):
+    state.module_id, state.module_included = state.module_stack.pop()
+
+
+def _register_module_paths(model: nn.Module, state: InstrumentationState):
+    for name, module in model.named_modules():
+        state.module_paths[module] = name
+
+
 _SHOULD_NOT_WRAP = [
     '__new__',
     '__init__',
@@ -91,6 +198,16 @@ def unwrap_proxy(t: Union['TensorProxy', Any], recursive=True):
     return t._wrapped if type(t) is TensorProxy else t
 
 
+def _notify_new_tensor(t: Union['TensorProxy', Tensor], state: InstrumentationState):
+    # callbacks may perform torch operations of their own, these should not be captured.
+    state.disabled += 1
+    try:
+        for callback in state.new_tensor_callbacks:
+            callback(t)
+    finally:
+        state.disabled -= 1
+
+
 def _wrap_in_proxy(t: Tensor, *, origin: Optional['TensorOrigin'] = None):
     assert type(t) is Tensor or isinstance(t, nn.Parameter)
 
@@ -100,8 +217,7 @@ def _wrap_in_proxy(t: Tensor, *, origin: Optional['TensorOrigin'] = None):
     proxy = TensorProxy(t, origin=origin)
 
     # call callbacks
-    for callback in state.new_tensor_callbacks:
-        callback(proxy)
+    _notify_new_tensor(proxy, state)
 
     return proxy
 
@@ -163,20 +279,30 @@ def _make_tensor_origin(
     if not state.track_origin:
         return None
 
-    origin_args = tuple(get_proxy_origin(a) for a in args)
-    origin_kwargs = frozenset((k, get_proxy_origin(v)) for k, v in kwargs.items())
-    origin = TensorOrigin(
-        index=state.origin_counter,
-        op=op,
-        args=origin_args,
-        kwargs=origin_kwargs
+    origin = state.origins.add(
+        op,
+        [get_proxy_origin(a) for a in args],
+        [(k, get_proxy_origin(v)) for k, v in kwargs.items()],
+        module_id=state.module_id,
     )
 
     state.origin_counter += 1
     return origin
 
 
+def new_origin_table():
+    """
+    Starts a new origin table for origins created from now on.
+    Origins in previous tables stay valid for as long as they are referenced.
+    """
+    state = get_current_instrumentation_state()
+    state.origins = OriginTable(base_index=state.origin_counter)
+    state.origin_generation += 1
+
+
 def make_proxy_function(fn, *, unwrap_args=True):
+    is_inplace = _is_inplace_op(getattr(fn, '__name__', ''))
+
     @wraps(fn)
     def wrapper(*args, **kwargs):
         # print('pf', fn.__name__)
@@ -184,10 +310,13 @@ def make_proxy_function(fn, *, unwrap_args=True):
         # print('  kwargs', {k: type(v) for k, v in kwargs.items()})
 
         state = get_current_instrumentation_state()
-        if state.disabled > 0:
+        if state.disabled > 0 or state.suspended:
             # if disabled, do nothing
             return fn(*args, **kwargs)
 
+        if is_inplace and state.inplace_op_callbacks:
+            _notify_inplace_op(state)
+
         # increase depth only when entering pure torch functions.
         # we do this to properly handle nested torch functions properly.
         # for example, when torch.nn.functional.embedding calls torch.embedding.
@@ -205,7 +334,7 @@ def make_proxy_function(fn, *, unwrap_args=True):
         finally:
             state.call_depth -= depth_delta
 
-        if state.call_depth == 0:
+        if state.call_depth == 0 and state.module_included:
             return _wrap_ret_val_in_proxy(result, fn.__name__, args, kwargs, state)
 
         return result
@@ -216,12 +345,250 @@ def make_proxy_function(fn, *, unwrap_args=True):
 TensorOriginArg = Union[int, float, 'TensorOrigin', None]
 
 
-@dataclass(frozen=True)
+# op names and keyword names are interned process-wide.
+# their crc32 is kept as well, since unlike hash() it is the same in every process.
+_INTERNED_NAMES: List[Optional[str]] = []
+_INTERNED_NAME_CRCS: List[int] = []
+_INTERNED_NAME_IDS: Dict[Optional[str], int] = {}
+
+
+def intern_name(name: Optional[str]) -> int:
+    name_id = _INTERNED_NAME_IDS.get(name)
+    if name_id is None:
+        name_id = len(_INTERNED_NAMES)
+        _INTERNED_NAMES.append(name)
+        _INTERNED_NAME_CRCS.append(zlib.crc32(name.encode()) if name is not None else 0)
+        _INTERNED_NAME_IDS[name] = name_id
+    return name_id
+
+
+def get_interned_name(name_id: int) -> Optional[str]:
+    return _INTERNED_NAMES[name_id]
+
+
+_NO_KEY = -1
+_NONE_ARG = -1
+
+_STRUCTURAL_KEY_MASK = (1 << 63) - 1
+
+
+def _structural_arg_key(arg: TensorOriginArg) -> Optional[int]:
+    """
+    Returns the part of a structural key contributed by an argument.
+    Ints (and None) are left out, since they are mostly sizes that change with the input shape.
+    """
+    if type(arg) is TensorOrigin:
+        return arg.structural_key
+    if isinstance(arg, float):
+        return hash(arg)
+    return None
+
+
+class OriginTable:
+    """
+    Struct-of-arrays storage of tensor origins.
+
+    Row i holds the interned op of an origin, and its arguments are stored in
+    arg_values[arg_offsets[i]:arg_offsets[i + 1]]. An argument is either the row of
+    a parent origin (>= 0), None (-1), or an index into a side table holding constants
+    and origins from other tables (<= -2). Keyword arguments have their interned name
+    in arg_keys, positional arguments have -1.
+
+    module_ids holds the interned path of the module that was running when a row was
+    added (-1 if none).
+
+    Every row also gets a structural key, which hashes the op, the module path, the structural
+    keys of its parents and the number of earlier rows with the same op, module and parents.
+    Unlike the index, it does not depend on the position of the origin in the trace, nor on input shapes.
+    """
+
+    def __init__(self, base_index: int):
+        self.base_index = base_index
+        self.op_ids = array('i')
+        self.module_ids = array('i')
+        self.arg_offsets = array('q', [0])
+        self.arg_values = array('q')
+        self.arg_keys = array('i')
+        self.side: List[Union[int, float, 'TensorOrigin']] = []
+        self.structural_keys = array('q')
+        self._occurrences: Dict[int, int] = {}
+
+    def __len__(self):
+        return len(self.op_ids)
+
+    def _encode(self, value: TensorOriginArg) -> int:
+        if value is None:
+            return _NONE_ARG
+        if type(value) is TensorOrigin and value._table is self:
+            return value._row
+
+        self.side.append(value)
+        return -1 - len(self.side)
+
+    def _decode(self, value: int) -> TensorOriginArg:
+        if value >= 0:
+            return TensorOrigin(self, value)
+        if value == _NONE_ARG:
+            return None
+        return self.side[-value - 2]
+
+    def add(
+            self,
+            op: Optional[str],
+            args: List[TensorOriginArg],
+            kwargs: List[Tuple[str, TensorOriginArg]],
+            *,
+            module_id: int = -1,
+    ):
+        row = len(self.op_ids)
+        op_id = intern_name(op)
+        self.op_ids.append(op_id)
+        self.module_ids.append(module_id)
+        key_parts = [_INTERNED_NAME_CRCS[op_id], _INTERNED_NAME_CRCS[module_id] if module_id != -1 else 0]
+
+        for arg in args:
+            self.arg_keys.append(_NO_KEY)
+            self.arg_values.append(self._encode(arg))
+            arg_key = _structural_arg_key(arg)
+            if arg_key is not None:
+                key_parts.append(arg_key)
+
+        for key, arg in kwargs:
+            key_id = intern_name(key)
+            self.arg_keys.append(key_id)
+            self.arg_values.append(self._encode(arg))
+            arg_key = _structural_arg_key(arg)
+            key_parts.append((_INTERNED_NAME_CRCS[key_id], arg_key if arg_key is not None else 0))
+
+        self.arg_offsets.append(len(self.arg_values))
+
+        # repeated ops on the same parents (e.g. parameters, which have none) are told apart by occurrence
+        base_key = hash(tuple(key_parts))
+        occurrence = self._occurrences.get(base_key, 0)
+        self._occurrences[base_key] = occurrence + 1
+        self.structural_keys.append(hash((base_key, occurrence)) & _STRUCTURAL_KEY_MASK)
+
+        return TensorOrigin(self, row)
+
+    def parent_indices(self, row: int) -> List[int]:
+        """ Returns the (global) indices of all origins used as arguments of a row. """
+        result = []
+        for i in range(self.arg_offsets[row], self.arg_offsets[row + 1]):
+            value = self.arg_values[i]
+            if value >= 0:
+                result.append(self.base_index + value)
+            elif value != _NONE_ARG:
+                side = self.side[-value - 2]
+                if type(side) is TensorOrigin:
+                    result.append(side.index)
+        return result
+
+    def decode_arg(self, value: int) -> TensorOriginArg:
+        return self._decode(value)
+
+    def positional_arg_arrays(self) -> Tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+        """
+        Returns the positional arguments of all rows as numpy arrays: the row of each argument,
+        its encoded value (see decode_arg), whether it is a tensor origin and whether it is a number.
+        """
+        offsets = np.array(self.arg_offsets, dtype=np.int64)
+        values = np.array(self.arg_values, dtype=np.int64)
+        rows = np.repeat(np.arange(len(self.op_ids), dtype=np.int64), np.diff(offsets))
+
+        positional = np.array(self.arg_keys, dtype=np.int64) == _NO_KEY
+        rows, values = rows[positional], values[positional]
+
+        # padded by one entry, so that non-side arguments can be looked up at index 0
+        side_is_tensor = np.array([type(x) is TensorOrigin for x in self.side] + [False], dtype=bool)
+        side_is_number = np.array([isinstance(x, (int, float)) for x in self.side] + [False], dtype=bool)
+
+        is_side = values <= -2
+        side_index = np.where(is_side, -values - 2, len(self.side))
+        is_tensor = (values >= 0) | side_is_tensor[side_index]
+        is_number = side_is_number[side_index]
+        return rows, values, is_tensor, is_number
+
+    def __getstate__(self):
+        # interned ids are only meaningful within this process, so ship the names with the table
+        state = self.__dict__.copy()
+        used = set(self.op_ids) | set(k for k in (*self.arg_keys, *self.module_ids) if k != _NO_KEY)
+        state['names'] = {name_id: _INTERNED_NAMES[name_id] for name_id in used}
+        return state
+
+    def __setstate__(self, state):
+        names = state.pop('names')
+        remap = {name_id: intern_name(name) for name_id, name in names.items()}
+        remap[_NO_KEY] = _NO_KEY
+
+        state['op_ids'] = array('i', (remap[i] for i in state['op_ids']))
+        state['arg_keys'] = array('i', (remap[k] for k in state['arg_keys']))
+        state['module_ids'] = array('i', (remap[k] for k in state['module_ids']))
+        self.__dict__.update(state)
+
+
 class TensorOrigin:
-    index: Optional[int]
-    op: str
-    args: Tuple[TensorOriginArg]
-    kwargs: FrozenSet[Tuple[str, TensorOriginArg]]
+    """
+    A view of a single row in an OriginTable.
+    """
+    __slots__ = ('_table', '_row')
+
+    def __init__(self, table: OriginTable, row: int):
+        self._table = table
+        self._row = row
+
+    @property
+    def table(self) -> OriginTable:
+        return self._table
+
+    @property
+    def row(self) -> int:
+        return self._row
+
+    @property
+    def index(self) -> int:
+        return self._table.base_index + self._row
+
+    @property
+    def op_id(self) -> int:
+        return self._table.op_ids[self._row]
+
+    @property
+    def structural_key(self) -> int:
+        return self._table.structural_keys[self._row]
+
+    @property
+    def module_id(self) -> int:
+        return self._table.module_ids[self._row]
+
+    @property
+    def module(self) -> Optional[str]:
+        """ Path of the module the origin was created in, e.g. encoder.layer.3.attention.self. """
+        module_id = self._table.module_ids[self._row]
+        return _INTERNED_NAMES[module_id] if module_id != -1 else None
+
+    @property
+    def op(self) -> Optional[str]:
+        return _INTERNED_NAMES[self._table.op_ids[self._row]]
+
+    def _iter_args(self):
+        table = self._table
+        for i in range(table.arg_offsets[self._row], table.arg_offsets[self._row + 1]):
+            yield table.arg_keys[i], table._decode(table.arg_values[i])
+
+    @property
+    def args(self) -> Tuple[TensorOriginArg, ...]:
+        return tuple(arg for key, arg in self._iter_args() if key == _NO_KEY)
+
+    @property
+    def kwargs(self) -> FrozenSet[Tuple[str, TensorOriginArg]]:
+        return frozenset(
+            (_INTERNED_NAMES[key], arg)
+            for key, arg in self._iter_args()
+            if key != _NO_KEY
+        )
+
+    def parent_indices(self) -> List[int]:
+        return self._table.parent_indices(self._row)
 
     def __hash__(self):
         return hash((self.index, self.op))
@@ -233,11 +600,18 @@ class TensorOrigin:
             self.op == other.op
         )
 
+    def __repr__(self):
+        return f'TensorOrigin(index={self.index}, op={self.op!r})'
+
 
 def get_proxy_origin(t: Union['TensorProxy', Any]) -> Optional[TensorOrigin]:
     if type(t) is TensorProxy:
         return t._origin
 
+    if isinstance(t, Tensor):
+        # tagged by the function mode backend
+        return getattr(t, _ORIGIN_ATTR, None)
+
     if isinstance(t, (int, float)):
         return t
 
@@ -389,8 +763,171 @@ def deinstrument_pytorch(originals: Dict[str, Callable]):
         setattr(mod, fn_name, fn)
 
 
+_ORIGIN_ATTR = '_fmrai_origin'
+""" Attribute in which the function mode backend stores the origin of a tensor. """
+
+_GENERATION_ATTR = '_fmrai_origin_generation'
+""" Attribute in which the function mode backend stores the origin generation a tensor was tagged in. """
+
+
+def _get_function_name(func) -> str:
+    name = getattr(func, '__name__', None)
+    if name == '__get__':
+        # property access (e.g. Tensor.T), use the name of the property instead
+        name = getattr(getattr(func, '__self__', None), '__name__', name)
+
+    return name or repr(func)
+
+
+def _tag_tensor(t: Tensor, origin: Optional['TensorOrigin'], state: InstrumentationState):
+    setattr(t, _ORIGIN_ATTR, origin)
+    setattr(t, _GENERATION_ATTR, state.origin_generation)
+    _notify_new_tensor(t, state)
+
+
+def _is_tagged(t: Tensor, state: InstrumentationState) -> bool:
+    """
+    Whether a tensor was tagged since the current origin table was started. Tags of earlier
+    trackers (or batches) are stale, like proxies of earlier calls in the proxy backend.
+    """
+    return getattr(t, _GENERATION_ATTR, None) == state.origin_generation
+
+
+def _untag_tensor(t: Tensor):
+    for attr in (_ORIGIN_ATTR, _GENERATION_ATTR):
+        if hasattr(t, attr):
+            delattr(t, attr)
+
+
+def _tag_untracked_args(args, kwargs, state: InstrumentationState):
+    """
+    Tags parameters and buffers the first time they are used by an operation of a trace.
+    This mirrors the proxy backend, which wraps them whenever they are accessed.
+    """
+    for arg in (*args, *kwargs.values()):
+        if isinstance(arg, Tensor) and not _is_tagged(arg, state):
+            name = state.param_to_name.get(arg)
+            if name is not None:
+                origin = _make_tensor_origin(f'parameter={name}', args=(), kwargs={}, state=state)
+                _tag_tensor(arg, origin, state)
+
+
+def _tag_ret_val(value, fn_name, args, kwargs, state: InstrumentationState):
+    if isinstance(value, Tensor):
+        origin = _make_tensor_origin(fn_name, args, kwargs, state=state)
+        _tag_tensor(value, origin, state)
+        return value
+
+    if isinstance(value, tuple):
+        for i, v in enumerate(value):
+            _tag_ret_val(v, fn_name + f'.{i}', args, kwargs, state)
+
+    return value
+
+
+class _CaptureFunctionMode(TorchFunctionMode):
+    """
+    Captures the results of every torch function without allocating proxies.
+    The mode is disabled while its handler runs, so functions called from within
+    other torch functions are not captured (same as call_depth in the proxy backend).
+    """
+
+    def __torch_function__(self, func, types, args=(), kwargs=None):
+        if kwargs is None:
+            kwargs = {}
+
+        state = _CURRENT_INSTRUMENTATION_STATE
+        if state is not None and state.suspended:
+            return func(*args, **kwargs)
+
+        if (
+                state is not None and state.inplace_op_callbacks and state.disabled == 0 and
+                _is_inplace_op(_get_function_name(func))
+        ):
+            _notify_inplace_op(state)
+
+        result = func(*args, **kwargs)
+
+        if state is None or state.disabled > 0 or not state.module_included:
+            return result
+
+        _tag_untracked_args(args, kwargs, state)
+        return _tag_ret_val(result, _get_function_name(func), args, kwargs, state)
+
+
+def _make_input_tagging_hook(op_base: str):
+    def hook(module, args, kwargs):
+        state = _CURRENT_INSTRUMENTATION_STATE
+        if state is None:
+            return None
+
+        if state.suspended:
+            return None
+
+        _enter_module(state, module)
+        if state.disabled > 0 or not state.module_included:
+            return None
+
+        state.disabled += 1
+        try:
+            inputs = [(f'.{i}', a) for i, a in enumerate(args)] + list(kwargs.items())
+            for key, value in inputs:
+                values = value.values() if isinstance(value, dict) else [value]
+                for v in values:
+                    if isinstance(v, Tensor) and not _is_tagged(v, state):
+                        origin = _make_tensor_origin(f'wrap${op_base}({key}=X)', args=(), kwargs={}, state=state)
+                        _tag_tensor(v, origin, state)
+        finally:
+            state.disabled -= 1
+
+        return None
+
+    return hook
+
+
+def _module_exit_hook(_module, _args, _result):
+    state = _CURRENT_INSTRUMENTATION_STATE
+    if state is not None and state.module_stack and not state.suspended:
+        _exit_module(state)
+    return None
+
+
+def _function_mode_instrument_model(model: nn.Module, state: InstrumentationState):
+    _register_module_paths(model, state)
+    for module in model.modules():
+        if module in state.hooked_modules:
+            # instrumented before (or a submodule of an instrumented model), hooks are already in place
+            continue
+        state.hooked_modules.add(module)
+
+        handle = module.register_forward_pre_hook(
+            _make_input_tagging_hook(type(module).__name__),
+            with_kwargs=True,
+        )
+        state.hook_handles.append(handle)
+        state.hook_handles.append(module.register_forward_hook(_module_exit_hook, always_call=True))
+
+    tensors = list(model.named_parameters()) + list(model.named_buffers())
+    for name, t in tensors:
+        _untag_tensor(t)
+        state.param_to_name[t] = name.split('.')[-1]
+
+    return model
+
+
+def _function_mode_cleanup(state: InstrumentationState):
+    for handle in state.hook_handles:
+        handle.remove()
+    state.hook_handles.clear()
+    state.hooked_modules.clear()
+
+    for t in state.param_to_name:
+        _untag_tensor(t)
+    state.param_to_name.clear()
+
+
 @contextlib.contextmanager
-def instrumentation_scope(*, track_origin=True):
+def instrumentation_scope(*, track_origin=True, backend=InstrumentationBackend.PROXY):
     global _CURRENT_INSTRUMENTATION_STATE
 
     if _CURRENT_INSTRUMENTATION_STATE is not None:
@@ -402,17 +939,67 @@ def instrumentation_scope(*, track_origin=True):
         seen_modules=[],
         param_to_name={},
         track_origin=track_origin,
+        backend=backend,
     )
-    state.original_functions = instrument_pytorch()
+
+    if backend == InstrumentationBackend.PROXY:
+        state.original_functions = instrument_pytorch()
+    elif backend == InstrumentationBackend.FUNCTION_MODE:
+        state.original_functions = {
+            **instrument_pytorch_module(),
+            **instrument_pytorch_parameter(),
+        }
+        state.function_mode = _CaptureFunctionMode()
+        state.function_mode.__enter__()
+    else:
+        raise ValueError(f'Unknown instrumentation backend: {backend}')
 
     _CURRENT_INSTRUMENTATION_STATE = state
     try:
         yield state
     finally:
+        if state.function_mode is not None:
+            state.function_mode.__exit__(None, None, None)
+            _function_mode_cleanup(state)
         deinstrument_pytorch(state.original_functions)
         _CURRENT_INSTRUMENTATION_STATE = None
 
 
+@contextlib.contextmanager
+def suspend_instrumentation():
+    """
+    Swaps the native torch functions back in within its scope (or leaves the function mode),
+    so instrumented models run at native speed and no tensors are seen by trackers.
+    Unlike pause_instrumentation, this also skips the proxies of instrumented models.
+    """
+    state = get_current_instrumentation_state()
+    if state.suspended:
+        yield
+        return
+
+    with contextlib.ExitStack() as stack:
+        if state.function_mode is not None:
+            # modes entered after ours stay in place, in which case ours only passes functions through
+            if _get_current_function_mode() is state.function_mode:
+                stack.enter_context(_pop_mode_temporarily())
+        else:
+            state.suspended_functions = {
+                value: _resolve_module_and_fn(value)[1]
+                for value in _INSTRUMENTABLE_FUNCTIONS
+                if value in state.original_functions
+            }
+            deinstrument_pytorch({value: state.original_functions[value] for value in state.suspended_functions})
+
+        state.suspended = True
+        try:
+            yield
+        finally:
+            state.suspended = False
+            if state.function_mode is None:
+                deinstrument_pytorch(state.suspended_functions)
+                state.suspended_functions = {}
+
+
 @contextlib.contextmanager
 def pause_instrumentation():
     state = get_current_instrumentation_state()
@@ -470,7 +1057,7 @@ class PostInstrumentationProxy(metaclass=PostInstrumentationProxyMeta):
 
         if _is_wrappable_object(value) and type(value) is not PostInstrumentationProxy:
             value = _post_instrument_wrappable_object(value, key=key)
-            if key:
+            if key and (type(value) is PostInstrumentationProxy or type(value) is TensorProxy):
                 self._wrapped_attrs[key] = value
             return value
 
@@ -511,13 +1098,29 @@ class PostInstrumentationProxy(metaclass=PostInstrumentationProxyMeta):
 
     def __call__(self, *args, **kwargs):
         # print('__call__', type(self._wrapped).__name__)
-        if isinstance(self._wrapped, nn.Module):
-            args, kwargs = _wrap_args_in_proxy(args, kwargs, op_base=type(self._wrapped).__name__)
+        if not isinstance(self._wrapped, nn.Module):
+            return self.__instrument(
+                None,
+                type(self._wrapped).__call__(self, *args, **kwargs)
+            )
 
-        return self.__instrument(
-            None,
-            type(self._wrapped).__call__(self, *args, **kwargs)
-        )
+        state = get_current_instrumentation_state()
+        if state.suspended:
+            # none of the proxies of submodules and parameters are involved
+            return self._wrapped(*args, **kwargs)
+
+        _enter_module(state, self._wrapped)
+        try:
+            if not state.module_included:
+                return type(self._wrapped).__call__(self, *args, **kwargs)
+
+            args, kwargs = _wrap_args_in_proxy(args, kwargs, op_base=type(self._wrapped).__name__)
+            return self.__instrument(
+                None,
+                type(self._wrapped).__call__(self, *args, **kwargs)
+            )
+        finally:
+            _exit_module(state)
 
     def __getitem__(self, item):
         # value = type(self._wrapped).__getitem__(self, item)
@@ -547,6 +1150,10 @@ def _post_instrument_wrappable_object(obj, *, key: Optional[str] = None):
         return obj
 
     if isinstance(obj, (Tensor, nn.Parameter)):
+        if not get_current_instrumentation_state().module_included:
+            # not wrapped (nor cached) until it is used from an instrumented module
+            return obj
+
         origin = _make_tensor_origin(f'parameter={key}', args=(), kwargs={})
         return _wrap_in_proxy(obj, origin=origin)
 
@@ -560,4 +1167,14 @@ def instrument_model(model):
     """
     if not _is_wrappable_object(model):
         return model
+
+    state = get_current_instrumentation_state()
+    if state.backend == InstrumentationBackend.FUNCTION_MODE:
+        # no proxies needed, the function mode already sees every operation
+        if isinstance(model, nn.Module):
+            return _function_mode_instrument_model(model, state)
+        return model
+
+    if isinstance(model, nn.Module):
+        _register_module_paths(model, state)
     return _post_instrument_wrappable_object(model)
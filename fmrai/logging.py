@@ -8,6 +8,7 @@ import torch.nn.functional
 from torch import Tensor
 
 from fmrai.instrument import unwrap_proxy
+from fmrai.storage import QuantizedTensor
 
 
 def get_log_dir():
@@ -46,6 +47,13 @@ def get_computation_map_dir(name: str, *, root_dir: Optional[str] = None):
     return p
 
 
+def get_structure_cache_dir(*, root_dir: Optional[str] = None):
+    p = 'structure_cache'
+    if root_dir:
+        p = os.path.join(root_dir, p)
+    return p
+
+
 def get_attention_head_plots_dir(key: Optional[str] = None, *, root_dir: Optional[str] = None):
     if key is None:
         p = 'attention_head_plots'
@@ -156,6 +164,12 @@ def log_tensor(
 
     tensor = unwrap_proxy(tensor)
 
+    # reduced precision tensors are saved as they are, other formats use the dequantized values
+    stored = tensor
+    if isinstance(tensor, QuantizedTensor):
+        stored = tensor.to_dict()
+        tensor = tensor.dequantize()
+
     if root_dir is None:
         tensor_dir = get_tensor_dir(name)
     else:
@@ -173,7 +187,7 @@ def log_tensor(
         used_formats.append('torch')
         tensor_path = os.path.join(tensor_dir, f't{time_step}.pt')
         out_data['torch'] = tensor_path
-        torch.save(tensor, tensor_path)
+        torch.save(stored, tensor_path)
 
     if 'image' in formats:
         img = tensor_to_image(tensor)
@@ -0,0 +1,573 @@
+import collections
+import json
+import math
+import mmap
+import os
+import tempfile
+import threading
+import weakref
+from dataclasses import dataclass
+from enum import Enum, auto
+from typing import Optional, Union, Callable, Any, Tuple, Deque, Hashable, Dict, List
+
+import torch
+from torch import Tensor
+
+
+class StoragePolicy(int, Enum):
+    FULL = auto()
+    """ Captured tensors are kept as they are. """
+
+    FLOAT16 = auto()
+    """ Floating point tensors are kept in half precision. """
+
+    BFLOAT16 = auto()
+    """ Floating point tensors are kept in bfloat16. """
+
+    INT8 = auto()
+    """ Floating point tensors are quantized to int8, with one scale per channel (last dimension). """
+
+
+def dtype_name(dtype: torch.dtype) -> str:
+    return str(dtype).replace('torch.', '')
+
+
+@dataclass
+class QuantizedTensor:
+    """
+    A tensor stored in reduced precision. scale is None for plain casts (fp16/bf16),
+    otherwise values are data * scale.
+    """
+    data: Tensor
+    scale: Optional[Tensor]
+    dtype: torch.dtype
+
+    def size(self, dim: Optional[int] = None):
+        return self.data.size() if dim is None else self.data.size(dim)
+
+    @property
+    def shape(self):
+        return self.data.shape
+
+    def dequantize(self) -> Tensor:
+        if self.scale is None:
+            return self.data.to(self.dtype)
+        return (self.data.to(self.scale.dtype) * self.scale).to(self.dtype)
+
+    def map(self, fn: Callable[[Tensor], Tensor]) -> 'QuantizedTensor':
+        """ Applies fn to the stored tensors, e.g. to copy them to another device. """
+        return QuantizedTensor(
+            data=fn(self.data),
+            scale=fn(self.scale) if self.scale is not None else None,
+            dtype=self.dtype,
+        )
+
+    def to_dict(self) -> dict:
+        """ Returns a representation that can be saved and loaded with torch.save/torch.load(weights_only=True). """
+        return {
+            'quantized': True,
+            'data': self.data,
+            'scale': self.scale,
+            'dtype': dtype_name(self.dtype),
+        }
+
+    @staticmethod
+    def from_dict(value: dict) -> 'QuantizedTensor':
+        return QuantizedTensor(
+            data=value['data'],
+            scale=value['scale'],
+            dtype=getattr(torch, value['dtype']),
+        )
+
+
+StoredTensor = Union[Tensor, QuantizedTensor]
+
+TensorIndex = Union[int, slice, Tuple[Union[int, slice], ...]]
+""" Index into the leading dimensions of a tensor, e.g. (slice(0, 8), 3) for a head of the first 8 instances. """
+
+
+_CAST_DTYPES = {
+    StoragePolicy.FLOAT16: torch.float16,
+    StoragePolicy.BFLOAT16: torch.bfloat16,
+}
+
+
+def _quantize_int8(tensor: Tensor) -> QuantizedTensor:
+    if tensor.dim() < 2:
+        # a scale per element would not save anything
+        amax = tensor.abs().amax()
+    else:
+        amax = tensor.abs().amax(dim=tuple(range(tensor.dim() - 1)), keepdim=True)
+
+    scale = amax.float() / 127
+    scale = torch.where(scale > 0, scale, torch.ones_like(scale))
+    data = torch.round(tensor.float() / scale).clamp(-127, 127).to(torch.int8)
+    return QuantizedTensor(data=data, scale=scale, dtype=tensor.dtype)
+
+
+def apply_storage_policy(tensor: Tensor, policy: StoragePolicy) -> StoredTensor:
+    """ Converts a tensor to the representation it is stored in under a policy. Non-float tensors are kept. """
+    if policy == StoragePolicy.FULL or not tensor.is_floating_point():
+        return tensor
+
+    if policy == StoragePolicy.INT8:
+        return _quantize_int8(tensor)
+
+    dtype = _CAST_DTYPES[policy]
+    if tensor.dtype == dtype:
+        return tensor
+    return QuantizedTensor(data=tensor.to(dtype), scale=None, dtype=tensor.dtype)
+
+
+def _align(offset: int, alignment: int) -> int:
+    return -(-offset // alignment) * alignment
+
+
+def _tensor_bytes(tensor: Tensor):
+    """ Returns the raw bytes of a tensor (as a numpy array, which is a view if the tensor is contiguous). """
+    return tensor.detach().cpu().contiguous().reshape(-1).view(torch.uint8).numpy()
+
+
+def _read_tensor(buffer, offset: int, dtype: torch.dtype, shape: Tuple[int, ...]) -> Tensor:
+    """ Returns a tensor that views raw bytes written at offset of buffer (without copying them). """
+    numel = 1
+    for d in shape:
+        numel *= d
+    if numel == 0:
+        return torch.empty(shape, dtype=dtype)
+    return torch.frombuffer(buffer, dtype=dtype, count=numel, offset=offset).view(shape)
+
+
+class TensorArena:
+    """
+    Append-only temporary file that spilled tensors are written to and memory-mapped back from.
+    """
+
+    def __init__(self, directory: Optional[str] = None, *, alignment: int = 64):
+        self._file = tempfile.TemporaryFile(dir=directory)
+        self._alignment = alignment
+        self._size = 0
+        self._mmap: Optional[mmap.mmap] = None
+        self._mapped_size = 0
+
+    @property
+    def size(self) -> int:
+        return self._size
+
+    def write(self, tensor: Tensor) -> 'SpilledTensor':
+        offset = _align(self._size, self._alignment)
+        data = _tensor_bytes(tensor)
+        if data.nbytes > 0:
+            self._file.seek(offset)
+            self._file.write(memoryview(data))
+            self._size = offset + data.nbytes
+
+        return SpilledTensor(arena=self, offset=offset, dtype=tensor.dtype, shape=tuple(tensor.shape))
+
+    def read(self, offset: int, dtype: torch.dtype, shape: Tuple[int, ...]) -> Tensor:
+        if self._mapped_size < self._size:
+            # tensors read from a previous mapping keep it alive, so it is only replaced
+            self._file.flush()
+            self._mmap = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_COPY)
+            self._mapped_size = self._size
+
+        # pages are only read from disk once the tensor is accessed
+        return _read_tensor(self._mmap, offset, dtype, shape)
+
+
+@dataclass
+class SpilledTensor:
+    """ A stored tensor that was moved to a TensorArena. """
+    arena: TensorArena
+    offset: int
+    dtype: torch.dtype
+    shape: Tuple[int, ...]
+
+    def load(self) -> Tensor:
+        return self.arena.read(self.offset, self.dtype, self.shape)
+
+
+def _is_spilled(value) -> bool:
+    if isinstance(value, QuantizedTensor):
+        return isinstance(value.data, SpilledTensor)
+    return isinstance(value, SpilledTensor)
+
+
+def _load_spilled(value):
+    return value.load() if isinstance(value, SpilledTensor) else value
+
+
+def _stored_nbytes(value) -> int:
+    if isinstance(value, QuantizedTensor):
+        return sum(_stored_nbytes(x) for x in (value.data, value.scale) if x is not None)
+    if isinstance(value, Tensor):
+        return value.numel() * value.element_size()
+    return 0
+
+
+def load_resident(value: Any) -> Any:
+    """ Pages a stored value back in if it was spilled, without dequantizing it. """
+    if isinstance(value, QuantizedTensor):
+        return value.map(_load_spilled)
+    return _load_spilled(value)
+
+
+def index_stored_tensor(value: StoredTensor, index: TensorIndex) -> StoredTensor:
+    """ Indexes a stored tensor without dequantizing it, so only the selected values are read and converted. """
+    if not isinstance(index, tuple):
+        index = (index,)
+    if not isinstance(value, QuantizedTensor):
+        return value[index]
+
+    scale = value.scale
+    if scale is not None and scale.dim() > 0:
+        # per channel scales have size 1 in all but the last dimension
+        scale = scale[tuple(
+            i if scale.size(d) > 1 else (0 if isinstance(i, int) else slice(None))
+            for d, i in enumerate(index)
+        )]
+    return QuantizedTensor(data=value.data[index], scale=scale, dtype=value.dtype)
+
+
+def load_stored_tensor(value: Any, index: Optional[TensorIndex] = None) -> Tensor:
+    """ Returns the full precision tensor of a stored (or loaded) value, or just the part selected by index. """
+    value = load_resident(value)
+    if isinstance(value, dict) and value.get('quantized'):
+        value = QuantizedTensor.from_dict(value)
+    if index is not None:
+        value = index_stored_tensor(value, index)
+    if isinstance(value, QuantizedTensor):
+        return value.dequantize()
+    return value
+
+
+class TensorStore(dict):
+    """
+    A dict of stored tensors whose values a MemoryBudget may spill to disk.
+    Values are added with put(), so they are accounted for by the budget.
+    """
+
+    def __init__(
+            self,
+            *args,
+            budget: Optional['MemoryBudget'] = None,
+            before_spill: Optional[Callable[[], None]] = None,
+            **kwargs,
+    ):
+        super().__init__(*args, **kwargs)
+        self.budget = budget
+        self.before_spill = before_spill
+        """ Called before values are spilled, e.g. to wait for pending copies into them. """
+
+    def put(self, key: Hashable, value: StoredTensor):
+        self[key] = value
+        if self.budget is not None:
+            self.budget.register(self, key)
+
+
+@dataclass
+class MemoryBudgetStats:
+    hits: int = 0
+    """ Number of stored tensors that were read while resident in memory. """
+
+    misses: int = 0
+    """ Number of stored tensors that were read back from disk. """
+
+    spills: int = 0
+    spilled_bytes: int = 0
+    resident_bytes: int = 0
+
+
+class MemoryBudget:
+    """
+    Limits the host memory used by captured tensors. Once more than max_bytes are stored,
+    the oldest tensors are spilled to a memory-mapped TensorArena, from which they are paged
+    back lazily when read.
+    """
+
+    def __init__(self, max_bytes: int, *, spill_dir: Optional[str] = None):
+        self.max_bytes = max_bytes
+        self.spill_dir = spill_dir
+        self.stats = MemoryBudgetStats()
+        self._arena: Optional[TensorArena] = None
+        # oldest first: (store, key, id of the registered value, bytes)
+        self._entries: Deque[Tuple[weakref.ref, Hashable, int, int]] = collections.deque()
+
+    @property
+    def arena(self) -> TensorArena:
+        if self._arena is None:
+            self._arena = TensorArena(self.spill_dir)
+        return self._arena
+
+    def manage(self, data: dict) -> TensorStore:
+        """ Returns a store with the values of data, accounted for by this budget. """
+        store = TensorStore(budget=self)
+        for key, value in data.items():
+            store.put(key, value)
+        return store
+
+    def release(self, store: TensorStore):
+        """ Stops managing a store, e.g. because its values were handed over to another store. """
+        store.budget = None
+
+    def register(self, store: TensorStore, key: Hashable):
+        value = store[key]
+        nbytes = _stored_nbytes(value)
+        if nbytes == 0:
+            return
+
+        self._entries.append((weakref.ref(store), key, id(value), nbytes))
+        self.stats.resident_bytes += nbytes
+        self._enforce()
+
+    def record_access(self, value):
+        if _is_spilled(value):
+            self.stats.misses += 1
+        else:
+            self.stats.hits += 1
+
+    def _enforce(self):
+        while self.stats.resident_bytes > self.max_bytes and self._entries:
+            store_ref, key, value_id, nbytes = self._entries.popleft()
+            self.stats.resident_bytes -= nbytes
+
+            # entries of dropped stores, released stores and replaced values are just forgotten
+            store = store_ref()
+            if store is None or store.budget is not self:
+                continue
+            value = store.get(key)
+            if value is None or id(value) != value_id:
+                continue
+
+            if store.before_spill is not None:
+                store.before_spill()
+
+            if isinstance(value, QuantizedTensor):
+                store[key] = value.map(self.arena.write)
+            else:
+                store[key] = self.arena.write(value)
+
+            self.stats.spills += 1
+            self.stats.spilled_bytes += nbytes
+
+
+_CONTAINER_MAGIC = b'FMRMAP01'
+_CONTAINER_ALIGNMENT = 64
+
+
+def write_tensor_container(
+        path: str,
+        tensors: Dict[str, StoredTensor],
+        *,
+        aliases: Optional[Dict[str, dict]] = None,
+):
+    """
+    Writes tensors into a single file: a header with an index of name -> dtype/shape/offset
+    (and aliases, which are stored as they are), followed by the raw, aligned tensor data.
+    Reduced precision tensors are written as they are stored. See TensorContainer.
+    """
+    entries = {}
+    blobs: List[Tuple[int, Any]] = []
+    size = 0
+
+    def add_blob(tensor: Tensor) -> dict:
+        nonlocal size
+        offset = _align(size, _CONTAINER_ALIGNMENT)
+        data = _tensor_bytes(tensor)
+        blobs.append((offset, data))
+        size = offset + data.nbytes
+        return {'dtype': dtype_name(tensor.dtype), 'shape': list(tensor.shape), 'offset': offset}
+
+    for name, value in tensors.items():
+        value = load_resident(value)
+        if isinstance(value, QuantizedTensor):
+            entry = add_blob(value.data)
+            entry['quantized'] = {
+                'dtype': dtype_name(value.dtype),
+                'scale': add_blob(value.scale) if value.scale is not None else None,
+            }
+        else:
+            entry = add_blob(value)
+        entries[name] = entry
+
+    header = json.dumps({'tensors': entries, 'aliases': aliases or {}}).encode()
+    data_offset = _align(len(_CONTAINER_MAGIC) + 8 + len(header), _CONTAINER_ALIGNMENT)
+
+    # readers never see a partially written file
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        f.write(_CONTAINER_MAGIC)
+        f.write(len(header).to_bytes(8, 'little'))
+        f.write(header)
+        for offset, data in blobs:
+            f.seek(data_offset + offset)
+            f.write(memoryview(data))
+        f.truncate(data_offset + size)
+    os.replace(tmp_path, path)
+
+
+class TensorContainer:
+    """
+    Reads files written by write_tensor_container. The file is memory-mapped, tensors are views of it
+    and only read from disk once accessed.
+    """
+
+    def __init__(self, path: str):
+        with open(path, 'rb') as f:
+            self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_COPY)
+
+        magic_size = len(_CONTAINER_MAGIC)
+        if self._mmap[:magic_size] != _CONTAINER_MAGIC:
+            raise Exception(f'Not a tensor container: {path}')
+
+        header_size = int.from_bytes(self._mmap[magic_size:magic_size + 8], 'little')
+        header = json.loads(self._mmap[magic_size + 8:magic_size + 8 + header_size])
+        self._entries: Dict[str, dict] = header['tensors']
+        self._aliases: Dict[str, dict] = header['aliases']
+        self._data_offset = _align(magic_size + 8 + header_size, _CONTAINER_ALIGNMENT)
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, name: str):
+        return name in self._entries
+
+    def keys(self):
+        return self._entries.keys()
+
+    def is_quantized(self, name: str) -> bool:
+        entry = self._entries.get(name)
+        return entry is not None and 'quantized' in entry
+
+    def shape(self, name: str) -> Optional[Tuple[int, ...]]:
+        entry = self._entries.get(name)
+        if entry is None:
+            return None
+        return tuple(entry['shape'])
+
+    def dtype(self, name: str) -> Optional[str]:
+        """ The dtype the tensor is returned in (quantized tensors are stored in another one). """
+        entry = self._entries.get(name)
+        if entry is None:
+            return None
+        return entry.get('quantized', entry)['dtype']
+
+    def nbytes(self, name: str) -> int:
+        """ Number of bytes the tensor is stored in, including the scale of quantized tensors. """
+        entry = self._entries.get(name)
+        if entry is None:
+            return 0
+        blobs = [entry]
+        if entry.get('quantized', {}).get('scale') is not None:
+            blobs.append(entry['quantized']['scale'])
+        return sum(
+            math.prod(blob['shape']) * torch.empty((), dtype=getattr(torch, blob['dtype'])).element_size()
+            for blob in blobs
+        )
+
+    @property
+    def aliases(self) -> Dict[str, dict]:
+        return self._aliases
+
+    def _read(self, entry: dict) -> Tensor:
+        return _read_tensor(
+            self._mmap,
+            self._data_offset + entry['offset'],
+            getattr(torch, entry['dtype']),
+            tuple(entry['shape']),
+        )
+
+    def get(self, name: str) -> Optional[StoredTensor]:
+        entry = self._entries.get(name)
+        if entry is None:
+            return None
+
+        data = self._read(entry)
+        quantized = entry.get('quantized')
+        if quantized is None:
+            return data
+        return QuantizedTensor(
+            data=data,
+            scale=self._read(quantized['scale']) if quantized['scale'] is not None else None,
+            dtype=getattr(torch, quantized['dtype']),
+        )
+
+
+@dataclass
+class TensorCacheStats:
+    hits: int = 0
+    misses: int = 0
+    evictions: int = 0
+    cached_bytes: int = 0
+
+
+class TensorCache:
+    """
+    LRU cache of tensors loaded from disk, limited by their total size in bytes.
+    One cache is shared by all lazy computation maps of a process, see get_tensor_cache.
+    """
+
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self.stats = TensorCacheStats()
+        self._entries: 'collections.OrderedDict[Hashable, Tensor]' = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: Hashable) -> Optional[Tensor]:
+        with self._lock:
+            tensor = self._entries.get(key)
+            if tensor is None:
+                self.stats.misses += 1
+                return None
+
+            self._entries.move_to_end(key)
+            self.stats.hits += 1
+            return tensor
+
+    def put(self, key: Hashable, tensor: Tensor):
+        nbytes = _stored_nbytes(tensor)
+        if nbytes > self.max_bytes:
+            return
+
+        with self._lock:
+            existing = self._entries.pop(key, None)
+            if existing is not None:
+                self.stats.cached_bytes -= _stored_nbytes(existing)
+
+            self._entries[key] = tensor
+            self.stats.cached_bytes += nbytes
+            self._evict()
+
+    def resize(self, max_bytes: int):
+        with self._lock:
+            self.max_bytes = max_bytes
+            self._evict()
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.stats.cached_bytes = 0
+
+    def invalidate(self, fn: Callable[[Hashable], bool]):
+        """ Drops the entries whose keys fn returns True for, e.g. because their files were rewritten. """
+        with self._lock:
+            for key in [key for key in self._entries if fn(key)]:
+                self.stats.cached_bytes -= _stored_nbytes(self._entries.pop(key))
+
+    def _evict(self):
+        while self.stats.cached_bytes > self.max_bytes:
+            _, tensor = self._entries.popitem(last=False)
+            self.stats.cached_bytes -= _stored_nbytes(tensor)
+            self.stats.evictions += 1
+
+
+_TENSOR_CACHE = TensorCache(1 << 30)
+
+
+def get_tensor_cache() -> TensorCache:
+    return _TENSOR_CACHE
+
+
+def set_tensor_cache_size(max_bytes: int):
+    """ Sets the size of the tensor cache shared by lazy computation maps (1 GiB by default). """
+    _TENSOR_CACHE.resize(max_bytes)
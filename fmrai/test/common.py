@@ -0,0 +1,51 @@
+import contextlib
+
+import torch
+from torch import nn
+
+from fmrai import fmrai
+from fmrai.instrument import InstrumentationBackend, instrument_model
+
+
+class TinyAttention(nn.Module):
+    def __init__(self):
+        super().__init__()
+        self.query = nn.Linear(8, 8)
+
+    def forward(self, x):
+        q = self.query(x).view(1, 4, 2, 4).transpose(1, 2)
+        return torch.softmax(q @ q.transpose(-1, -2), dim=-1)
+
+
+class TinyEncoder(nn.Module):
+    def __init__(self):
+        super().__init__()
+        self.attention = TinyAttention()
+        self.output = nn.Linear(8, 8)
+
+    def forward(self, x):
+        return self.attention(self.output(x))
+
+
+@contextlib.contextmanager
+def instrumented(model: nn.Module, backend=InstrumentationBackend.FUNCTION_MODE):
+    """ Yields an fmrai scope of the backend and the model instrumented in it. """
+    with fmrai(backend=backend) as fmr:
+        yield fmr, instrument_model(model)
+
+
+def track(fmr, m, inputs, **track_kwargs):
+    """ Runs m on each input under one tracker and returns the built map (a batch per input if batched). """
+    with fmr.track(**track_kwargs) as tracker:
+        with torch.no_grad():
+            for x in inputs:
+                m(x)
+                if track_kwargs.get('batched'):
+                    tracker.end_batch()
+        return tracker.build_map()
+
+
+def track_tiny_attention(num_inputs=1, **track_kwargs):
+    """ Tracks a new TinyAttention on random inputs, in a scope of its own. """
+    with instrumented(TinyAttention()) as (fmr, m):
+        return track(fmr, m, [torch.randn(1, 4, 8) for _ in range(num_inputs)], **track_kwargs)
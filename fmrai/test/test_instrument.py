@@ -0,0 +1,237 @@
+import pytest
+import torch
+from torch import nn
+from torch.overrides import TorchFunctionMode, _get_current_function_mode
+
+from fmrai.fmrai import Sampler
+from fmrai.analysis.structure import find_multi_head_attention
+from fmrai.instrument import InstrumentationBackend, instrument_model
+from fmrai.storage import StoragePolicy
+from fmrai.test.common import TinyAttention, TinyEncoder, instrumented, track
+from fmrai.tracker import OrdinalTensorId, NamedTensorId, StructuralTensorId, Reducer, parse_tensor_id
+
+
+def test_instrument_model_twice():
+    with instrumented(TinyAttention()) as (fmr, m):
+        x = torch.randn(1, 4, 8)
+
+        seen = []
+        for _ in range(2):
+            with fmr.track() as tracker:
+                with torch.no_grad():
+                    m(x)
+                seen.append(tracker.num_seen_tensors)
+            m = instrument_model(m)
+
+    assert seen[0] == seen[1]
+
+
+@pytest.mark.parametrize('backend', list(InstrumentationBackend))
+def test_reused_input_across_trackers(backend):
+    with instrumented(TinyAttention(), backend) as (fmr, m):
+        x = torch.randn(1, 4, 8)
+
+        # inputs and parameters are seen again by every tracker
+        first, second = (track(fmr, m, [x]) for _ in range(2))
+
+    assert set(first) == set(second)
+    assert torch.equal(second.get(OrdinalTensorId(ordinal=0))[0], x)
+
+
+def test_track_empty_tensor_list():
+    with instrumented(TinyAttention()) as (fmr, m):
+        x = torch.randn(1, 4, 8)
+        full, empty = (track(fmr, m, [x], track_tensors=track_tensors) for track_tensors in (None, []))
+
+    assert len(full) > 0
+    assert set(empty) == set(full)
+    for tensor_id in full:
+        assert torch.equal(empty.get(tensor_id)[0], full.get(tensor_id)[0])
+
+
+@pytest.mark.parametrize('backend', list(InstrumentationBackend))
+def test_include_modules_with_backend(backend):
+    with instrumented(TinyEncoder(), backend) as (fmr, m):
+        with fmr.track(include_modules=['attention*']) as tracker:
+            with torch.no_grad():
+                m(torch.randn(1, 4, 8))
+            g = tracker.build_graph()
+
+        paths = {tracker.module_path(OrdinalTensorId(ordinal=i)) for i in range(tracker.num_seen_tensors)}
+        assert paths == {'attention', 'attention.query'}
+        assert len(list(find_multi_head_attention(g))) == 1
+
+
+@pytest.mark.parametrize('backend', list(InstrumentationBackend))
+def test_elide_views_with_backend(backend):
+    with instrumented(TinyAttention(), backend) as (fmr, m):
+        x = torch.randn(1, 4, 8)
+        full, elided = (track(fmr, m, [x], elide_views=elide_views) for elide_views in (False, True))
+
+    assert elided.aliases
+    assert len(elided) < len(full)
+    for tensor_id in full:
+        assert torch.equal(full.get(tensor_id)[0], elided.get(tensor_id)[0])
+
+
+class _InplaceBeforeView(nn.Module):
+    def forward(self, x):
+        y = x * 2
+        y[0].zero_()
+        return y.view(4, 8)
+
+
+def test_elide_views_after_inplace_op():
+    with instrumented(_InplaceBeforeView()) as (fmr, m):
+        # float16 storage copies the base on capture, so it keeps the values from before zero_()
+        cmap = track(fmr, m, [torch.arange(32.0).view(1, 4, 8)], elide_views=True, storage=StoragePolicy.FLOAT16)
+
+    view = max(list(cmap) + list(cmap.aliases), key=lambda tensor_id: tensor_id.ordinal)
+    assert view not in cmap.aliases
+    assert cmap.get(view)[0].shape == (4, 8)
+    assert not cmap.get(view)[0].any()
+
+
+class _InplaceAfterCapture(nn.Module):
+    def forward(self, x):
+        y = x * 2
+        y.add_(1)
+        return y
+
+
+@pytest.mark.skipif(not torch.cuda.is_available(), reason='requires CUDA')
+def test_async_capture_with_inplace_op():
+    with instrumented(_InplaceAfterCapture()) as (fmr, m):
+        x = torch.randn(1024, 1024, device='cuda')
+        cmap = track(fmr, m, [x])
+
+    # the copy of x * 2 is queued before add_() runs and must not see its result
+    before, after = cmap.get(OrdinalTensorId(ordinal=1))[0], cmap.get(OrdinalTensorId(ordinal=2))[0]
+    assert before.device.type == 'cpu'
+    assert torch.equal(before, (x * 2).cpu())
+    assert torch.equal(after, (x * 2 + 1).cpu())
+
+
+def test_track_with_reducer():
+    with instrumented(TinyAttention()) as (fmr, m):
+        x = torch.randn(1, 4, 8)
+        full = track(fmr, m, [x])
+        last = max(full, key=lambda tensor_id: tensor_id.ordinal)
+        reduced = track(fmr, m, [x], track_tensors={last: Reducer.max(dim=-1)})
+
+    assert torch.equal(reduced.get(last)[0], full.get(last)[0].amax(dim=-1))
+
+
+class _ShapeFreeAttention(nn.Module):
+    """ Like TinyAttention, for inputs of any batch size and sequence length. """
+
+    def __init__(self):
+        super().__init__()
+        self.query = nn.Linear(8, 8)
+
+    def forward(self, x):
+        batch_size, seq_len, _ = x.shape
+        q = self.query(x).view(batch_size, seq_len, 2, 4).transpose(1, 2)
+        return torch.softmax(q @ q.transpose(-1, -2), dim=-1)
+
+
+@pytest.mark.parametrize('backend', list(InstrumentationBackend))
+def test_structural_ids_across_shapes(backend):
+    with instrumented(_ShapeFreeAttention(), backend) as (fmr, m):
+        runs = []
+        for batch_size, seq_len in ((1, 4), (3, 4), (2, 7)):
+            with fmr.track() as tracker:
+                with torch.no_grad():
+                    m(torch.randn(batch_size, seq_len, 8))
+                structural_ids = [
+                    tracker.structural_id(OrdinalTensorId(ordinal=i)) for i in range(tracker.num_seen_tensors)
+                ]
+                runs.append((structural_ids, tracker.trace_signature))
+
+    structural_ids, _ = runs[0]
+    assert structural_ids and None not in structural_ids
+    assert len(set(structural_ids)) == len(structural_ids)
+    assert all(run == runs[0] for run in runs)
+
+
+def test_parse_tensor_id():
+    for tensor_id in (
+            OrdinalTensorId(ordinal=12),
+            NamedTensorId(name='encoder.layer.0.output'),
+            StructuralTensorId(key=(1 << 63) - 1),
+    ):
+        assert parse_tensor_id(repr(tensor_id)) == tensor_id
+
+    with pytest.raises(ValueError):
+        parse_tensor_id('12')
+
+
+def test_track_by_structural_id():
+    with instrumented(_ShapeFreeAttention()) as (fmr, m):
+        with fmr.track() as tracker:
+            with torch.no_grad():
+                m(torch.randn(1, 4, 8))
+            last = OrdinalTensorId(ordinal=tracker.num_seen_tensors - 1)
+            structural_id = tracker.structural_id(last)
+            cmap = tracker.build_map()
+
+        renamed = cmap.rename_ids({last: structural_id})
+        assert structural_id in renamed and last not in renamed
+        assert torch.equal(renamed.get(structural_id)[0], cmap.get(last)[0])
+
+        # tracked by structural id, the same tensor is captured for inputs of another shape
+        with fmr.track(track_tensors=[structural_id]) as tracker:
+            with torch.no_grad():
+                expected = m(torch.randn(2, 7, 8))
+            captured = tracker.build_map().get(structural_id)
+
+    assert len(captured) == 1
+    assert torch.equal(captured[0], expected)
+
+
+@pytest.mark.parametrize('backend', list(InstrumentationBackend))
+def test_sample_every_nth_step(backend):
+    with instrumented(TinyAttention(), backend) as (fmr, m):
+        x = torch.randn(1, 4, 8)
+        expected = m(x)
+
+        sampler = fmr.sample(every=2)
+        with fmr.track(batched=True) as tracker:
+            for _ in range(4):
+                with sampler.step():
+                    y = m(x)
+                tracker.end_batch()
+                assert torch.allclose(y, expected)
+            cmap = tracker.build_map()
+
+    assert sampler.sampled_steps == 2
+    assert [len(batch) > 0 for batch in cmap] == [True, False, True, False]
+
+
+class _PassThroughMode(TorchFunctionMode):
+    def __torch_function__(self, func, types, args=(), kwargs=None):
+        return func(*args, **(kwargs or {}))
+
+
+def test_sample_inside_other_function_mode():
+    with instrumented(TinyAttention()) as (fmr, m):
+        x = torch.randn(1, 4, 8)
+
+        # suspending must not take the mode entered last off the stack
+        sampler = fmr.sample(every=2)
+        with fmr.track(batched=True) as tracker:
+            with _PassThroughMode() as mode:
+                for _ in range(2):
+                    with sampler.step():
+                        m(x)
+                    assert _get_current_function_mode() is mode
+                    tracker.end_batch()
+            cmap = tracker.build_map()
+
+    assert [len(batch) > 0 for batch in cmap] == [True, False]
+
+
+@pytest.mark.parametrize('kwargs', [{}, {'every': 0}, {'probability': -0.1}, {'probability': 1.5}])
+def test_sampler_arguments(kwargs):
+    with pytest.raises(Exception):
+        Sampler(**kwargs)
@@ -0,0 +1,205 @@
+import os
+import threading
+import time
+
+import pytest
+import torch
+
+from fmrai.storage import StoragePolicy, MemoryBudget, get_tensor_cache
+from fmrai.test.common import TinyAttention, instrumented, track, track_tiny_attention
+from fmrai.tracker import OrdinalTensorId, NamedTensorId, StructuralTensorId, LazyComputationMap, \
+    BatchedComputationMap, EagerComputationMap, MapNotFoundError
+
+
+def _last_tensor(cmap) -> OrdinalTensorId:
+    return max(cmap, key=lambda tensor_id: tensor_id.ordinal)
+
+
+@pytest.mark.parametrize('storage', [StoragePolicy.FLOAT16, StoragePolicy.BFLOAT16, StoragePolicy.INT8])
+def test_track_with_storage_policy(storage):
+    with instrumented(TinyAttention()) as (fmr, m):
+        x = torch.randn(1, 4, 8)
+        full, reduced = (track(fmr, m, [x], storage=policy) for policy in (StoragePolicy.FULL, storage))
+
+    for tensor_id in full:
+        expected = full.get(tensor_id)[0]
+        actual = reduced.get(tensor_id)[0]
+        assert actual.dtype == expected.dtype
+        assert torch.allclose(actual, expected, rtol=0.05, atol=0.05 * expected.abs().max().item())
+
+
+def test_track_with_memory_budget(tmp_path):
+    budget = MemoryBudget(256, spill_dir=str(tmp_path))
+    with instrumented(TinyAttention()) as (fmr, m):
+        x = torch.randn(1, 4, 8)
+        full, spilled = (track(fmr, m, [x] * 3, batched=True, budget=b) for b in (None, budget))
+
+        assert budget.stats.spills > 0
+        assert budget.stats.resident_bytes <= 256
+        for full_batch, spilled_batch in zip(full, spilled):
+            for tensor_id in full_batch:
+                assert torch.equal(spilled_batch.get(tensor_id)[0], full_batch.get(tensor_id)[0])
+        assert budget.stats.misses > 0
+
+
+@pytest.mark.parametrize('container', [True, False])
+def test_save_and_load_map(tmp_path, container):
+    cmap = track_tiny_attention(elide_views=True, storage=StoragePolicy.FLOAT16)
+
+    cmap.save_to_dir(str(tmp_path), container=container)
+    loaded = LazyComputationMap.load_from(str(tmp_path))
+    assert (tmp_path / 't0.fmrmap').is_file() == container
+
+    for tensor_id in list(cmap) + list(cmap.aliases):
+        assert torch.equal(loaded.get(tensor_id)[0], cmap.get(tensor_id)[0])
+
+
+def test_container_reads_are_zero_copy(tmp_path):
+    cmap = track_tiny_attention()
+    cmap.save_to_dir(str(tmp_path))
+    loaded = LazyComputationMap.load_from(str(tmp_path))
+    tensor_id = next(iter(cmap))
+
+    cache = get_tensor_cache()
+    cache.clear()
+    first, second = loaded.get(tensor_id)[0], loaded.get(tensor_id)[0]
+
+    # both are views of the memory map (and so not cached either)
+    assert first.data_ptr() == second.data_ptr()
+    assert cache.stats.cached_bytes == 0
+
+    copied = loaded.load([tensor_id]).get(tensor_id)[0]
+    assert copied.data_ptr() != first.data_ptr()
+    assert torch.equal(copied, first)
+
+
+def test_get_cat_with_index(tmp_path):
+    cmap = track_tiny_attention(3, batched=True, storage=StoragePolicy.INT8)
+
+    cmap.save_to_dir(str(tmp_path))
+    loaded = BatchedComputationMap.load_from(str(tmp_path))
+
+    for tensor_id in cmap.batches[0]:
+        full = cmap.get_cat(tensor_id)
+        assert sum(shape[0] for shape in loaded.get_shapes(tensor_id)) == full.size(0)
+        # indices other than ints and slices are applied to the full concatenation
+        for index in [(slice(1, 3),), (2,), (slice(0, 3, 2), 1), (torch.tensor(1),), (), (..., 0), ([0, 2],)]:
+            if len(index) > full.dim():
+                continue
+            assert torch.allclose(cmap.get_cat(tensor_id, index=index), full[index])
+            assert torch.allclose(loaded.get_cat(tensor_id, index=index), full[index])
+
+    # the attention weights have one row per batch, so the slice must not read the first batch
+    last = _last_tensor(cmap.batches[0])
+    os.remove(tmp_path / 'batch_0' / 't0.fmrmap')
+    loaded = BatchedComputationMap.load_from(str(tmp_path))
+    assert torch.allclose(loaded.get_cat(last, index=(slice(1, 3),)), cmap.get_cat(last)[1:3])
+
+
+@pytest.mark.parametrize('container', [True, False])
+def test_tensor_cache(tmp_path, container):
+    # quantized tensors are cached when read from containers too
+    old, new = (track_tiny_attention(storage=StoragePolicy.INT8) for _ in range(2))
+    tensor_id = _last_tensor(old)
+
+    # lazy maps of the same directory share the cache
+    old.save_to_dir(str(tmp_path), container=container)
+    cache = get_tensor_cache()
+    cache.clear()
+    hits = cache.stats.hits
+    for _ in range(2):
+        assert torch.equal(LazyComputationMap.load_from(str(tmp_path)).get(tensor_id)[0], old.get(tensor_id)[0])
+    assert cache.stats.hits == hits + 1
+    assert cache.stats.cached_bytes <= cache.max_bytes
+
+    # rewritten tensors are read again
+    new.save_to_dir(str(tmp_path), container=container)
+    assert torch.equal(LazyComputationMap.load_from(str(tmp_path)).get(tensor_id)[0], new.get(tensor_id)[0])
+
+
+def test_iter_batches_with_prefetch(tmp_path, monkeypatch):
+    cmap = track_tiny_attention(5, batched=True)
+
+    cmap.save_to_dir(str(tmp_path))
+    loaded = BatchedComputationMap.load_from(str(tmp_path))
+    tensor_ids = list(cmap.batches[0])
+
+    # slowed down, so that reads only overlap if they are issued ahead of the consumer
+    lock = threading.Lock()
+    reads = {'pending': 0, 'max_pending': 0}
+    load = LazyComputationMap.load
+
+    def slow_load(self, *args, **kwargs):
+        with lock:
+            reads['pending'] += 1
+            reads['max_pending'] = max(reads['max_pending'], reads['pending'])
+        try:
+            time.sleep(0.05)
+            return load(self, *args, **kwargs)
+        finally:
+            with lock:
+                reads['pending'] -= 1
+
+    monkeypatch.setattr(LazyComputationMap, 'load', slow_load)
+
+    batches = list(loaded.iter_batches(tensor_ids, prefetch=2))
+    assert reads['max_pending'] > 1
+    assert len(batches) == len(cmap)
+    for tensor_id in tensor_ids:
+        expected = cmap.get(tensor_id)
+        assert all(torch.equal(batch.get(tensor_id)[0], b) for batch, b in zip(batches, expected))
+
+
+def test_saved_map_manifest(tmp_path):
+    cmap = track_tiny_attention(elide_views=True)
+
+    cmap.save_to_dir(str(tmp_path))
+    loaded = LazyComputationMap.load_from(str(tmp_path))
+
+    assert set(loaded) == set(cmap) | set(cmap.aliases)
+    assert loaded.get_nbytes() == cmap.get_nbytes()
+    for tensor_id in loaded:
+        assert loaded.get_shapes(tensor_id) == [tuple(cmap.get(tensor_id)[0].shape)]
+
+    filtered = loaded.filter_ids(lambda tensor_id: tensor_id in cmap.aliases)
+    assert set(filtered) == set(cmap.aliases)
+
+
+@pytest.mark.parametrize('container', [True, False])
+def test_saved_map_without_manifest(tmp_path, container):
+    cmap = track_tiny_attention(elide_views=True, storage=StoragePolicy.INT8)
+    cmap.save_to_dir(str(tmp_path), container=container)
+    cmap.save_to_dir(str(tmp_path), time_step=2, container=container)
+
+    loaded = LazyComputationMap.load_from(str(tmp_path))
+    expected = {tensor_id: loaded.get_info(tensor_id) for tensor_id in loaded}
+
+    # the same is listed from the container, or from the tensors in their directories
+    os.remove(tmp_path / 'manifest.json')
+    assert LazyComputationMap.get_time_steps(str(tmp_path)) == [0, 2]
+    scanned = LazyComputationMap.load_from(str(tmp_path))
+    assert repr(scanned) == f'<lazy map: {len(expected)} tensors>'
+    assert {tensor_id: scanned.get_info(tensor_id) for tensor_id in scanned} == expected
+
+    with pytest.raises(MapNotFoundError):
+        len(LazyComputationMap.load_from(str(tmp_path), time_step=1))
+
+
+@pytest.mark.parametrize('container', [True, False])
+def test_saved_map_tensor_names(tmp_path, container):
+    # named ids that look like ordinals or structural keys must not be read back as such
+    tensor_ids = [
+        OrdinalTensorId(ordinal=123),
+        NamedTensorId(name='123'),
+        StructuralTensorId(key=0xdeadbeefdeadbeef),
+        NamedTensorId(name='deadbeefdeadbeef'),
+        NamedTensorId(name='#123'),
+    ]
+    cmap = EagerComputationMap(data={tensor_id: torch.full((2,), float(i)) for i, tensor_id in enumerate(tensor_ids)})
+    cmap.save_to_dir(str(tmp_path), container=container)
+    os.remove(tmp_path / 'manifest.json')
+
+    loaded = LazyComputationMap.load_from(str(tmp_path))
+    assert set(loaded) == set(tensor_ids)
+    for tensor_id in tensor_ids:
+        assert torch.equal(loaded.get(tensor_id)[0], cmap.get(tensor_id)[0])
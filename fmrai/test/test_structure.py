@@ -0,0 +1,117 @@
+import pytest
+import torch
+from torch import nn
+
+from fmrai.analysis.structure import find_multi_head_attention, find_repeated_blocks, FindTransformerFFN
+from fmrai.analysis.structure_cache import StructureCache, ModelStructure, model_fingerprint, probe_model_structure
+from fmrai.instrument import InstrumentationBackend
+from fmrai.test.common import TinyAttention, TinyEncoder, instrumented
+from fmrai.tracker import BaseTensorNode
+
+
+def _track_graph(model: nn.Module, backend=InstrumentationBackend.FUNCTION_MODE):
+    with instrumented(model, backend) as (fmr, m):
+        with fmr.track() as tracker:
+            with torch.no_grad():
+                m(torch.randn(1, 4, 8))
+            return tracker.build_graph()
+
+
+@pytest.mark.parametrize('backend', list(InstrumentationBackend))
+def test_find_attention_with_backend(backend):
+    heads = list(find_multi_head_attention(_track_graph(TinyAttention(), backend)))
+    assert len(heads) == 1
+    assert heads[0].num_heads == 2
+
+
+class _TinyLayer(nn.Module):
+    def __init__(self, activation=nn.GELU):
+        super().__init__()
+        self.attention = TinyAttention()
+        self.up = nn.Linear(8, 16)
+        self.activation = activation()
+        self.down = nn.Linear(16, 8)
+
+    def forward(self, x):
+        values = x.view(1, 4, 2, 4).transpose(1, 2)
+        x = x + (self.attention(x) @ values).transpose(1, 2).reshape(1, 4, 8)
+        return x + self.down(self.activation(self.up(x)))
+
+
+class _TinyStack(nn.Module):
+    def __init__(self, num_layers=6, odd_layer=None):
+        super().__init__()
+        self.layers = nn.ModuleList([_TinyLayer(nn.Tanh if i == odd_layer else nn.GELU) for i in range(num_layers)])
+
+    def forward(self, x):
+        for layer in self.layers:
+            x = layer(x)
+        return x
+
+
+def _instance_ordinals(instances):
+    return sorted((
+        tuple(value.tensor_id.ordinal if isinstance(value, BaseTensorNode) else value for value in vars(instance).values())
+        for instance in instances
+    ), key=repr)
+
+
+@pytest.mark.parametrize('odd_layer', [None, 2])
+def test_repeated_block_search(odd_layer):
+    g = _track_graph(_TinyStack(odd_layer=odd_layer))
+    assert find_repeated_blocks(g.g, min_count=3) is not None
+
+    heads = _instance_ordinals(find_multi_head_attention(g, repeated_blocks=True))
+    assert heads == _instance_ordinals(find_multi_head_attention(g))
+    assert len(heads) == 6
+
+    ffns = _instance_ordinals(FindTransformerFFN(g.g, repeated_blocks=True).search())
+    assert ffns == _instance_ordinals(FindTransformerFFN(g.g).search())
+    assert len(ffns) == (6 if odd_layer is None else 5)
+
+
+def test_structure_cache(tmp_path):
+    cache = StructureCache(root_dir=str(tmp_path))
+    with instrumented(TinyEncoder()) as (fmr, m):
+        x = torch.randn(1, 4, 8)
+        probes = []
+
+        def probe():
+            probes.append(x)
+            with torch.no_grad():
+                m(x)
+
+        # miss, then hit
+        structure = probe_model_structure(probe, model=m, cache=cache, attention=True)
+        assert len(structure.attention) == 1
+        assert probe_model_structure(probe, model=m, cache=cache, attention=True).attention == structure.attention
+        assert len(probes) == 1
+
+        # new parts are merged with the cached ones
+        merged = probe_model_structure(probe, model=m, cache=cache, ffns=True)
+        assert len(probes) == 2
+        assert merged.ffns is not None
+        assert merged.attention == structure.attention
+
+        # other models (or backends) miss
+        assert cache.load(model_fingerprint(m, InstrumentationBackend.PROXY)) is None
+        assert cache.load(model_fingerprint(TinyAttention(), InstrumentationBackend.FUNCTION_MODE)) is None
+
+
+def test_structure_cache_signatures(tmp_path):
+    cache = StructureCache(root_dir=str(tmp_path), max_signatures=2)
+
+    # a probe and a batch that trace different ops get entries of their own
+    probe = ModelStructure(trace_signature=1, attention=[])
+    batch = ModelStructure(trace_signature=2, attention=[], ffns=[])
+    cache.update('model', probe)
+    cache.update('model', batch)
+    assert cache.load('model', 1) == probe
+    assert cache.load('model', 2) == batch
+    assert cache.load('model') == batch
+
+    # parts are merged per signature, the oldest signature is dropped once there are too many
+    cache.update('model', ModelStructure(trace_signature=1, ffns=[]))
+    assert cache.load('model', 1) == ModelStructure(trace_signature=1, attention=[], ffns=[])
+    cache.update('model', ModelStructure(trace_signature=3))
+    assert list(cache.load_all('model')) == [1, 3]
@@ -1,9 +1,19 @@
+import networkx as nx
+import pytest
+import torch
+from torch import nn
+
 from fmrai import fmrai
 from fmrai.agent import AgentAPI
 from fmrai.agent.agents.transformers import TransformersAgentAPI
+from fmrai.analysis.common import get_graph_index
+from fmrai.analysis.structure import find_multi_head_attention, FindLinear
 from fmrai.fmrai import Fmrai
+from fmrai.instrument import InstrumentationBackend, instrument_model, TensorOrigin
 from fmrai.logging import get_computation_map_dir
-from fmrai.tracker import OrdinalTensorId, BatchedComputationMap
+from fmrai.tracker import OrdinalTensorId, BatchedComputationMap, RawComputationGraph, NiceComputationGraph, \
+    HostStorageCache, PinnedBufferPool, BaseTensorNode, TensorStubNode, RawOpNode, OpNode, ConstantNode, TensorOp, _ONE_ARG_OPS, _TWO_ARG_OPS, \
+    _TWO_ARG_ONE_CONST_OPS, _ANY_OPS
 
 
 def _create_batch(fmr: Fmrai, agent: AgentAPI):
@@ -38,3 +48,201 @@ def test_load_batch_map():
         assert isinstance(loaded, BatchedComputationMap)
         assert len(loaded) == 2
         assert len(loaded.get(OrdinalTensorId(ordinal=21))) == 2
+
+
+class _TinyFFN(nn.Module):
+    def __init__(self):
+        super().__init__()
+        self.up = nn.Linear(8, 16)
+        self.down = nn.Linear(16, 8)
+
+    def forward(self, x):
+        h = self.up(x)
+        h = 0.5 * h * (1.0 + torch.tanh(0.79788456 * (h + 0.044715 * torch.pow(h, 3.0))))
+        return torch.softmax(self.down(h), dim=-1)
+
+
+def _reference_op(origin: TensorOrigin):
+    """ Classifies a raw op one node at a time, the way from_raw did on networkx graphs. """
+    tensors = [arg for arg in origin.args if isinstance(arg, TensorOrigin)]
+    numbers = [arg for arg in origin.args if isinstance(arg, (int, float))]
+
+    if origin.op in _ONE_ARG_OPS and len(origin.args) == 1 and len(tensors) == 1:
+        return _ONE_ARG_OPS[origin.op], None
+    if origin.op in _TWO_ARG_OPS and len(origin.args) == 2 and len(tensors) == 2:
+        return _TWO_ARG_OPS[origin.op], None
+    if origin.op in _TWO_ARG_ONE_CONST_OPS and len(numbers) == 1:
+        return _TWO_ARG_ONE_CONST_OPS[origin.op], numbers[0]
+    if origin.op in _ANY_OPS:
+        return _ANY_OPS[origin.op], None
+    return TensorOp.OTHER, None
+
+
+def _reference_from_raw(raw: RawComputationGraph) -> nx.DiGraph:
+    g = raw.to_networkx()
+
+    nice = nx.DiGraph()
+    replaced = {}
+    for node in g.nodes:
+        if isinstance(node, RawOpNode):
+            op, constant = _reference_op(node.origin)
+            replaced[node] = OpNode(op=op, origin=node.origin)
+            if constant is not None:
+                nice.add_edge(ConstantNode(value=constant), replaced[node])
+        elif isinstance(node, BaseTensorNode):
+            replaced[node] = TensorStubNode(tensor_id=node.tensor_id, tensor_size=node.tensor_size)
+        else:
+            replaced[node] = node
+
+    nice.add_nodes_from(replaced.values())
+    nice.add_edges_from((replaced[u], replaced[v]) for u, v in g.edges)
+    return nice
+
+
+def _describe_graph(g: nx.DiGraph):
+    """ Describes the nodes and edges of a graph independently of node ids. """
+    def key(node):
+        if isinstance(node, BaseTensorNode):
+            return 'tensor', node.tensor_id.ordinal, tuple(node.tensor_size)
+        if isinstance(node, ConstantNode):
+            return ('constant', node.value) + tuple(key(succ) for succ in g.successors(node))
+        return 'op', int(node.op), node.origin.index
+
+    return sorted(map(key, g.nodes)), sorted((key(u), key(v)) for u, v in g.edges)
+
+
+def _reference_op_results(g: nx.DiGraph, ops) -> list:
+    """ Returns the ordinals of the tensors produced by ops, found by walking the networkx graph. """
+    result = []
+    for node in g.nodes:
+        if isinstance(node, OpNode) and node.op in ops:
+            succs = list(g.successors(node))
+            if len(succs) == 1 and isinstance(succs[0], TensorStubNode):
+                result.append(succs[0].tensor_id.ordinal)
+    return sorted(result)
+
+
+def _track_ffn_graph(backend) -> RawComputationGraph:
+    with fmrai(backend=backend) as fmr:
+        m = instrument_model(_TinyFFN())
+
+        with fmr.track(graph=True) as tracker:
+            with torch.no_grad():
+                m(torch.randn(2, 4, 8))
+            return RawComputationGraph(g=tracker._cg.build())
+
+
+@pytest.mark.parametrize('backend', list(InstrumentationBackend))
+def test_from_raw_matches_networkx(backend):
+    raw = _track_ffn_graph(backend)
+    nice = NiceComputationGraph.from_raw(raw)
+
+    g = nice.to_networkx()
+    assert g.number_of_nodes() == len(nice.g)
+    assert g.number_of_edges() == nice.g.number_of_edges()
+    assert _describe_graph(g) == _describe_graph(_reference_from_raw(raw))
+    assert any(isinstance(node, ConstantNode) for node in g.nodes)
+
+
+@pytest.mark.parametrize('backend', list(InstrumentationBackend))
+def test_finders_match_networkx(backend):
+    nice = NiceComputationGraph.from_raw(_track_ffn_graph(backend))
+    g = nice.to_networkx()
+
+    heads = find_multi_head_attention(nice)
+    assert sorted(head.softmax_value.tensor_id.ordinal for head in heads) == \
+        _reference_op_results(g, (TensorOp.SOFTMAX,))
+
+    linears = FindLinear(nice.g).search()
+    assert sorted(node.tensor_id.ordinal for node in linears) == \
+        _reference_op_results(g, (TensorOp.LINEAR, TensorOp.ADDMM))
+    assert len(_reference_op_results(g, (TensorOp.LINEAR, TensorOp.ADDMM))) == 2
+
+
+def test_graph_index_extents():
+    g = NiceComputationGraph.from_raw(_track_ffn_graph(InstrumentationBackend.FUNCTION_MODE)).g
+    reference = g.to_networkx()
+    index = get_graph_index(g)
+
+    nodes = list(range(len(g)))
+    descendants = [{g.index_of(node) for node in nx.descendants(reference, g.node(i))} | {i} for i in nodes]
+    for start in nodes:
+        for end in (None, nodes[-1], start):
+            expected = [v for v in nodes if v in descendants[start] and (end is None or end in descendants[v])]
+            assert index.filter_extent(nodes, start, end).tolist() == expected
+            assert sorted(index.extent_nodes(start, end).tolist()) == expected
+
+
+def test_host_storage_cache_spans():
+    base = torch.arange(64.0)
+    matrix = base.view(8, 8)
+
+    # host tensors are only copied on request
+    assert HostStorageCache().copy(matrix).untyped_storage().data_ptr() == base.untyped_storage().data_ptr()
+
+    cache = HostStorageCache(copy_host_tensors=True)
+    views = [matrix, matrix[2], matrix[1:4, 2:6], matrix.t(), base[8:40].view(4, 8)]
+    copies = [cache.copy(view) for view in views]
+
+    # one copy of the storage, every view is rebuilt on it
+    storage = copies[0].untyped_storage().data_ptr()
+    assert storage != base.untyped_storage().data_ptr()
+    for view, copy in zip(views, copies):
+        assert copy.untyped_storage().data_ptr() == storage
+        assert copy.stride() == view.stride()
+        assert torch.equal(copy, view)
+
+    # sparse views of storage that was not copied yet are copied on their own
+    sparse = HostStorageCache(copy_host_tensors=True).copy(base[::16])
+    assert sparse.untyped_storage().nbytes() == 4 * base.element_size()
+    assert torch.equal(sparse, base[::16])
+
+    # after an in-place op, the storage is copied again and earlier copies keep their values
+    matrix[2].zero_()
+    row = cache.copy(matrix[2])
+    assert row.untyped_storage().data_ptr() != storage
+    assert not row.any()
+    assert torch.equal(copies[1], torch.arange(16.0, 24.0))
+
+    # exclusive copies never share storage, with each other or with the original
+    exclusive = HostStorageCache(exclusive=True)
+    copies = [exclusive.copy(view) for view in views]
+    storages = {copy.untyped_storage().data_ptr() for copy in copies}
+    assert len(storages) == len(views) and base.untyped_storage().data_ptr() not in storages
+    for view, copy in zip(views, copies):
+        assert copy.untyped_storage().nbytes() == view.numel() * view.element_size()
+        assert torch.equal(copy, view)
+
+
+def test_pinned_buffer_pool_slicing():
+    pool = PinnedBufferPool(chunk_size=1024, alignment=64, pin_memory=False)
+
+    buffers = [
+        pool.allocate(3, torch.float32),
+        pool.allocate(10, torch.float16),
+        pool.allocate(300, torch.uint8),
+        pool.allocate(60, torch.float32),
+        pool.allocate(64, torch.float32),
+        pool.allocate(64, torch.float32),
+        pool.allocate(64, torch.float32),
+    ]
+    assert [(b.numel(), b.dtype) for b in buffers] == [
+        (3, torch.float32), (10, torch.float16), (300, torch.uint8),
+        (60, torch.float32), (64, torch.float32), (64, torch.float32), (64, torch.float32),
+    ]
+
+    # small buffers are aligned slices of a chunk, large ones (over a quarter chunk) get their own memory
+    chunk = buffers[0].untyped_storage().data_ptr()
+    storages = [b.untyped_storage().data_ptr() for b in buffers]
+    assert storages[2] != chunk
+    assert storages[:2] + storages[3:6] == [chunk] * 5
+    assert [b.storage_offset() * b.element_size() for b in buffers[:2] + buffers[3:6]] == [0, 64, 128, 384, 640]
+
+    # the last buffer no longer fits into the chunk and starts a new one
+    assert storages[6] != chunk
+    assert buffers[6].storage_offset() == 0
+
+    for i, b in enumerate(buffers):
+        b.fill_(i)
+    for i, b in enumerate(buffers):
+        assert (b == i).all()
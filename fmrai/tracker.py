@@ -1,24 +1,37 @@
+import collections
+import concurrent.futures
 import contextlib
+import functools
+import json
+import math
+import operator
 import os
 import pickle
 import threading
 import re
 import subprocess
-from dataclasses import dataclass
+import weakref
+from array import array
+import dataclasses
+from dataclasses import dataclass, field
 from enum import IntEnum, Enum, auto
-from typing import Union, Dict, Optional, Callable, Any, Iterable, List, Tuple, Iterator
+from typing import Union, Dict, Optional, Callable, Any, Iterable, List, Tuple, Iterator, FrozenSet, Set
 
 import networkx as nx
+import numpy as np
 # import reai.bert.base
 import torch
 from torch import nn, Tensor
 from torch.nn import Parameter
 
-from tqdm import tqdm
-
 from fmrai.instrument import instrumentation_scope, TensorProxy, add_new_tensor_callback, \
-    unwrap_proxy, get_current_instrumentation_state, remove_new_tensor_callback, TensorOrigin
+    unwrap_proxy, get_current_instrumentation_state, remove_new_tensor_callback, TensorOrigin, get_proxy_origin, \
+    new_origin_table, get_interned_name, OriginTable, set_module_filter, add_inplace_op_callback, \
+    remove_inplace_op_callback
 from fmrai.logging import log_model_parameters, log_tensor, get_computation_map_dir
+from fmrai.storage import StoragePolicy, StoredTensor, QuantizedTensor, MemoryBudget, TensorStore, TensorContainer, \
+    TensorIndex, apply_storage_policy, load_stored_tensor, load_resident, write_tensor_container, get_tensor_cache, \
+    dtype_name
 
 
 @dataclass(frozen=True)
@@ -42,6 +55,287 @@ class NamedTensorId(TensorId):
         return f'@{self.name}'
 
 
+@dataclass(frozen=True)
+class StructuralTensorId(TensorId):
+    """
+    Identifies a tensor by the structural key of its origin (see OriginTable).
+    Unlike ordinals, structural ids stay the same for inputs of any batch size or sequence length.
+    """
+    key: int
+
+    def __repr__(self):
+        return f'${self.key:016x}'
+
+
+def parse_tensor_id(text: str) -> TensorId:
+    """ Parses the repr of a tensor id. """
+    if text.startswith('#'):
+        return OrdinalTensorId(ordinal=int(text[1:]))
+    if text.startswith('@'):
+        return NamedTensorId(name=text[1:])
+    if text.startswith('$'):
+        return StructuralTensorId(key=int(text[1:], 16))
+
+    raise ValueError(f'Invalid tensor id: {text}')
+
+
+class Reducer:
+    """
+    Reduces a captured tensor on its original device, before it is copied off-device.
+    Only the (usually much smaller) result is kept in the computation map.
+    """
+
+    def __init__(self, fn: Callable[[Tensor], Tensor], name: Optional[str] = None):
+        self.fn = fn
+        self.name = name or getattr(fn, '__name__', 'custom')
+
+    def __call__(self, tensor: Tensor) -> Tensor:
+        return self.fn(tensor)
+
+    def __repr__(self):
+        return f'<reducer: {self.name}>'
+
+    @staticmethod
+    def max(dim: int, *, keepdim=False) -> 'Reducer':
+        return Reducer(lambda t: torch.amax(t, dim=dim, keepdim=keepdim), f'max(dim={dim})')
+
+    @staticmethod
+    def min(dim: int, *, keepdim=False) -> 'Reducer':
+        return Reducer(lambda t: torch.amin(t, dim=dim, keepdim=keepdim), f'min(dim={dim})')
+
+    @staticmethod
+    def sum(dim: int, *, keepdim=False) -> 'Reducer':
+        return Reducer(lambda t: torch.sum(t, dim=dim, keepdim=keepdim), f'sum(dim={dim})')
+
+    @staticmethod
+    def mean(dim: int, *, keepdim=False) -> 'Reducer':
+        return Reducer(lambda t: torch.mean(t, dim=dim, keepdim=keepdim), f'mean(dim={dim})')
+
+    @staticmethod
+    def select(dim: int, index: int) -> 'Reducer':
+        return Reducer(lambda t: torch.select(t, dim, index), f'select(dim={dim}, index={index})')
+
+
+TrackedTensors = Union[Iterable[TensorId], Dict[TensorId, Optional[Callable[[Tensor], Tensor]]]]
+""" Ids of tensors to track, or a dict of ids to reducers (see Reducer) or None for no reduction. """
+
+
+def _get_reducers(track_tensors: Optional[TrackedTensors]) -> Dict[TensorId, Callable[[Tensor], Tensor]]:
+    if not isinstance(track_tensors, dict):
+        return {}
+    return {tensor_id: reducer for tensor_id, reducer in track_tensors.items() if reducer is not None}
+
+
+def _make_capture_plan(track_tensors: Optional[List[TensorId]]) -> Optional[FrozenSet[int]]:
+    """
+    Returns the set of ordinals that should be captured, or None if all tensors should be captured.
+    """
+    if track_tensors is None:
+        return None
+
+    return frozenset(
+        tensor_id.ordinal
+        for tensor_id in track_tensors
+        if isinstance(tensor_id, OrdinalTensorId)
+    )
+
+
+def _make_structural_capture_plan(track_tensors: Optional[List[TensorId]]) -> FrozenSet[int]:
+    """ Returns the structural keys of the tensors that should be captured. """
+    if track_tensors is None:
+        return frozenset()
+
+    return frozenset(
+        tensor_id.key
+        for tensor_id in track_tensors
+        if isinstance(tensor_id, StructuralTensorId)
+    )
+
+
+_VIEW_OPS = frozenset([
+    'view', 'view_as', 'reshape', 'reshape_as', 'transpose', 'permute', 'contiguous', '__getitem__',
+    'squeeze', 'unsqueeze', 'flatten', 'expand', 'expand_as', 't', 'T', 'mT',
+])
+""" Ops that only change how a tensor is viewed, see elide_views of SingleComputationTracker. """
+
+
+@dataclass(frozen=True)
+class TensorAlias:
+    """
+    A tensor that was not captured, because it shares the storage of a captured (contiguous) base tensor.
+    """
+    base: TensorId
+    size: Tuple[int, ...]
+    stride: Tuple[int, ...]
+    offset: int
+    """ Storage offset relative to the base tensor. """
+
+    def materialize(self, base: Tensor) -> Tensor:
+        return base.as_strided(self.size, self.stride, base.storage_offset() + self.offset)
+
+    def to_dict(self) -> dict:
+        return {
+            'base': get_tensor_dir_name(self.base),
+            'size': list(self.size),
+            'stride': list(self.stride),
+            'offset': self.offset,
+        }
+
+
+@functools.lru_cache(maxsize=None)
+def _element_size(dtype: torch.dtype) -> int:
+    return torch.empty((), dtype=dtype).element_size()
+
+
+class PinnedBufferPool:
+    """
+    Hands out pinned host buffers for asynchronous copies. Small buffers are carved out of shared chunks,
+    so that pinned memory is not allocated per tensor. Chunks are freed once no buffer references them,
+    and torch's caching host allocator recycles them for later chunks.
+    Without pin_memory, buffers are carved out of pageable memory the same way.
+    """
+
+    def __init__(self, *, chunk_size: int = 16 << 20, alignment: int = 64, pin_memory: bool = True):
+        self._chunk_size = chunk_size
+        self._alignment = alignment
+        self._pin_memory = pin_memory
+        self._chunk: Optional[Tensor] = None
+        self._used = 0
+
+    def allocate(self, numel: int, dtype: torch.dtype) -> Tensor:
+        nbytes = numel * _element_size(dtype)
+        if nbytes > self._chunk_size // 4:
+            return torch.empty(numel, dtype=dtype, pin_memory=self._pin_memory)
+
+        if self._chunk is None or self._used + nbytes > self._chunk_size:
+            self._chunk = torch.empty(self._chunk_size, dtype=torch.uint8, pin_memory=self._pin_memory)
+            self._used = 0
+
+        buffer = self._chunk[self._used:self._used + nbytes].view(dtype)
+        self._used += -(-nbytes // self._alignment) * self._alignment
+        return buffer
+
+
+class HostStorageCache:
+    """
+    Copies tensors off-device, transferring each region of device storage only once.
+    Tensors that share storage (views, slices, in-place results) are rebuilt on the host as views
+    of one copy, as long as the storage was not modified in between (see Tensor._version).
+
+    CUDA tensors are copied into pinned buffers on a side stream without blocking the host.
+    Results must not be read before synchronize(), and fence() has to be called before
+    a tensor is modified in place (see add_inplace_op_callback). Host tensors are not copied at all,
+    unless copy_host_tensors is set, in which case they are copied like device tensors.
+    With exclusive, every tensor (host tensors too) is copied into storage of its own instead,
+    so that dropping a copy frees as many bytes as it holds (see MemoryBudget).
+    """
+
+    def __init__(
+            self,
+            *,
+            max_span_ratio: float = 2.0,
+            asynchronous: bool = True,
+            copy_host_tensors: bool = False,
+            exclusive: bool = False,
+    ):
+        # (data pointer, dtype) -> (base tensor, version, start, end, host copy of the storage region)
+        self._spans: Dict[Tuple[int, torch.dtype], Tuple[weakref.ref, int, int, int, Tensor]] = {}
+        self._max_span_ratio = max_span_ratio
+        self._asynchronous = asynchronous and torch.cuda.is_available()
+        self._copy_host_tensors = copy_host_tensors or exclusive
+        self._exclusive = exclusive
+        self._pool = PinnedBufferPool()
+        self._streams: Dict[torch.device, 'torch.cuda.Stream'] = {}
+        self._unfenced: Set[torch.device] = set()
+        self._unsynchronized: Set[torch.device] = set()
+
+    def clear(self):
+        self.synchronize()
+        self._spans.clear()
+
+    def fence(self):
+        """ Makes work queued on the current streams from now on wait for the pending copies. """
+        for device in self._unfenced:
+            torch.cuda.current_stream(device).wait_stream(self._streams[device])
+        self._unfenced.clear()
+
+    def synchronize(self):
+        """ Waits until all copies are done. """
+        for device in self._unsynchronized:
+            self._streams[device].synchronize()
+        self._unsynchronized.clear()
+        self._unfenced.clear()
+
+    def _copy_to_host(self, tensor: Tensor) -> Tensor:
+        if tensor.device.type == 'cpu':
+            return tensor.clone()
+        if not self._asynchronous or tensor.device.type != 'cuda':
+            return tensor.cpu()
+
+        device = tensor.device
+        stream = self._streams.get(device)
+        if stream is None:
+            stream = self._streams[device] = torch.cuda.Stream(device)
+
+        if self._exclusive:
+            host = torch.empty(tensor.size(), dtype=tensor.dtype, pin_memory=True)
+        else:
+            host = self._pool.allocate(tensor.numel(), tensor.dtype).view(tensor.size())
+
+        # the copy has to see all work queued so far, and the device memory must not be
+        # reused by the allocator before the copy is done
+        stream.wait_stream(torch.cuda.current_stream(device))
+        with torch.cuda.stream(stream):
+            host.copy_(tensor, non_blocking=True)
+        tensor.record_stream(stream)
+
+        self._unfenced.add(device)
+        self._unsynchronized.add(device)
+        return host
+
+    def copy(self, tensor: Tensor) -> Tensor:
+        tensor = tensor.detach()
+        if tensor.numel() == 0 or (tensor.device.type == 'cpu' and not self._copy_host_tensors):
+            # .cpu() does not copy host tensors either
+            return tensor.cpu()
+        if self._exclusive:
+            return self._copy_to_host(tensor)
+
+        size = tuple(tensor.size())
+        stride = tuple(tensor.stride())
+        start = tensor.storage_offset()
+        end = start + 1 + sum((s - 1) * st for s, st in zip(size, stride))
+
+        # views keep their base alive, so a live base means the storage was not freed and reused
+        base = tensor._base if tensor._base is not None else tensor
+        key = (tensor.untyped_storage().data_ptr(), tensor.dtype)
+        entry = self._spans.get(key)
+        if (
+                entry is None or entry[0]() is not base or entry[1] != tensor._version or
+                start < entry[2] or end > entry[3]
+        ):
+            if end - start > self._max_span_ratio * tensor.numel():
+                # sparse view of a large storage, copying the whole region is not worth it
+                return self._copy_to_host(tensor)
+
+            host = self._copy_to_host(torch.as_strided(tensor, (end - start,), (1,), start))
+            entry = (weakref.ref(base), tensor._version, start, end, host)
+            self._spans[key] = entry
+
+        host = entry[4]
+        return host.as_strided(size, stride, host.storage_offset() + start - entry[2])
+
+
+def _compact(tensor: StoredTensor) -> StoredTensor:
+    """ Returns a tensor that does not reference more storage than it needs (torch.save writes whole storages). """
+    tensor = load_resident(tensor)
+    if isinstance(tensor, QuantizedTensor):
+        return tensor.map(_compact)
+    if tensor.untyped_storage().nbytes() > tensor.numel() * tensor.element_size():
+        return tensor.clone()
+    return tensor
+
+
 def _get_raw_op_text(origin: TensorOrigin):
     return origin.op + ' ' + ','.join(str(x) for x in origin.args if isinstance(x, (int, float)))
 
@@ -59,38 +353,118 @@ class SingleComputationTracker(ComputationTracker):
     def __init__(
             self,
             *,
-            track_tensors: Optional[Iterable[TensorId]] = None,
+            track_tensors: Optional[TrackedTensors] = None,
+            graph: Optional[bool] = None,
+            include_modules: Optional[Iterable[str]] = None,
+            elide_views: bool = False,
+            storage: StoragePolicy = StoragePolicy.FULL,
+            budget: Optional[MemoryBudget] = None,
     ):
+        """
+        If track_tensors is None (or empty), all tensors are kept. If it maps tensor ids to reducers,
+        the reducers run on the device of the tensors and only their results are kept.
+        If graph is None, a computation graph is built only when track_tensors is None (i.e. probe runs).
+        If include_modules is given, only operations inside modules matching one of its globs are seen.
+        With elide_views, results of shape-only ops (view, transpose, ...) that share the storage of
+        their input are recorded as aliases of it: they get no graph nodes, are not copied off-device
+        and are only materialized when requested from the map (or listed in track_tensors).
+        storage sets the precision captured tensors are kept in, maps return them in full precision.
+        With a budget, the oldest captured tensors are spilled to disk once it is exceeded (also by built maps).
+        Captured tensors then get host storage of their own, so that spilling one frees the bytes it is counted with.
+        """
         self._next_ordinal = 0
         self._current_step = 0
         self._root_model = None
         self._tracking = True
-        self._tracked_tensors = list(track_tensors) if track_tensors is not None else None
-
-        self._cg: Optional[nx.DiGraph] = None
+        # an empty track_tensors keeps everything, same as None
+        self._tracked_tensors = list(track_tensors) if track_tensors else None
+        self._reducers = _get_reducers(track_tensors)
+        self._capture_plan = _make_capture_plan(self._tracked_tensors)
+        self._structural_capture_plan = _make_structural_capture_plan(self._tracked_tensors)
+        self._build_graph = graph if graph is not None else self._tracked_tensors is None
+        self._include_modules = list(include_modules) if include_modules is not None else None
+        self._elide_views = elide_views
+        self._storage = storage
+        self._budget = budget
+
+        self._cg: Optional[CompactGraphBuilder] = None
         self._dbg_wrote_origin = False
 
     def set_root_model(self, model):
         self._root_model = model
 
     def __enter__(self):
+        new_origin_table()
         add_new_tensor_callback(self._handle_new_tensor)
         self._grad_fn_to_tensor = {}
-        self._id_to_tensor = {}
         self._tensor_to_id = {}
+        self._host_storage = HostStorageCache(exclusive=self._budget is not None)
+        self._id_to_tensor = TensorStore(budget=self._budget, before_spill=self._host_storage.synchronize)
+        add_inplace_op_callback(self._host_storage.fence)
 
-        self._grad_fn_to_tensor_node = {}
-        self._id_to_tensor_node = {}
-        self._cg = nx.DiGraph()
+        self._cg = CompactGraphBuilder() if self._build_graph else None
         self._origin_to_tensor_node = {}
+        self._reset_trace()
+
+        if self._include_modules is not None:
+            set_module_filter(self._include_modules)
         return self
 
+    def _reset_trace(self):
+        self._structural_keys = array('q')
+        self._module_ids = array('i')
+        self._trace_signature = 0
+        self._parameter_ops: Dict[int, bool] = {}
+
+        # view elision: ordinals of origins, storage of contiguous tensors (data pointer, offset, numel, version)
+        # and aliases (base ordinal, size, stride, relative offset)
+        self._view_ops: Dict[int, bool] = {}
+        self._origin_to_ordinal: Dict[int, int] = {}
+        self._storage_info: Dict[int, Tuple[int, int, int, int]] = {}
+        self._aliases: Dict[int, Tuple[int, Tuple[int, ...], Tuple[int, ...], int]] = {}
+
+    @property
+    def builds_graph(self) -> bool:
+        return self._build_graph
+
     @property
     def num_seen_tensors(self):
-        return len(self._id_to_tensor)
+        return self._next_ordinal
+
+    @property
+    def trace_signature(self) -> int:
+        """
+        Hash of the structural keys of all tensors seen so far, in order.
+        Equal signatures mean that two forward passes ran the same ops, whatever the shape of their inputs.
+        Parameters are left out, since when they are seen depends on the backend (on access, or on first use).
+        """
+        return self._trace_signature
+
+    def structural_id(self, tensor_id: TensorId) -> Optional[StructuralTensorId]:
+        """ Returns the structural id of a tensor seen in this step, given its ordinal id. """
+        if isinstance(tensor_id, StructuralTensorId):
+            return tensor_id
+        if not isinstance(tensor_id, OrdinalTensorId) or not 0 <= tensor_id.ordinal < len(self._structural_keys):
+            return None
+
+        key = self._structural_keys[tensor_id.ordinal]
+        if key < 0:
+            return None
+        return StructuralTensorId(key=key)
+
+    def module_path(self, tensor_id: TensorId) -> Optional[str]:
+        """ Returns the path of the module a tensor seen in this step was created in, given its ordinal id. """
+        if not isinstance(tensor_id, OrdinalTensorId) or not 0 <= tensor_id.ordinal < len(self._module_ids):
+            return None
+
+        module_id = self._module_ids[tensor_id.ordinal]
+        return get_interned_name(module_id) if module_id != -1 else None
 
     def __exit__(self, exc_type, exc_val, exc_tb):
         remove_new_tensor_callback(self._handle_new_tensor)
+        remove_inplace_op_callback(self._host_storage.fence)
+        if self._include_modules is not None:
+            set_module_filter(None)
 
     # def get_last_tensor(self) -> Optional[Tuple[OrdinalTensorId, TensorProxy]]:
     #     """
@@ -118,21 +492,55 @@ class SingleComputationTracker(ComputationTracker):
         finally:
             self._tracking = prev_tracking
 
-    def _handle_new_tensor(self, tensor: TensorProxy):
+    def _handle_new_tensor(self, tensor: Union[TensorProxy, Tensor]):
+        """
+        Called for every new tensor, either a TensorProxy (proxy backend)
+        or a tagged tensor (function mode backend).
+        """
         if not self._tracking:
             return
 
         ordinal = self._next_ordinal
         self._next_ordinal += 1
 
-        tensor_id = OrdinalTensorId(ordinal=ordinal)
-        self._id_to_tensor[tensor_id] = tensor.save_proxy()
-        self._tensor_to_id[tensor._saved_id] = tensor_id
-
         unwraped = unwrap_proxy(tensor)
-        tensor_node = TensorNode(tensor=unwraped, tensor_id=tensor_id, tensor_size=unwraped.size())
-        self._id_to_tensor_node[tensor_id] = tensor_node
-        self._cg.add_node(tensor_node, label=tensor_node.label, shape='box', tensor_id=tensor_id)
+        origin: Optional[TensorOrigin] = get_proxy_origin(tensor)
+
+        structural_key = -1
+        module_id = -1
+        if origin is not None:
+            structural_key = origin.structural_key
+            module_id = origin.module_id
+
+            is_parameter = self._parameter_ops.get(origin.op_id)
+            if is_parameter is None:
+                is_parameter = origin.op.startswith('parameter=')
+                self._parameter_ops[origin.op_id] = is_parameter
+            if not is_parameter:
+                self._trace_signature = hash((self._trace_signature, structural_key))
+
+        self._structural_keys.append(structural_key)
+        self._module_ids.append(module_id)
+
+        if self._elide_views and origin is not None:
+            if self._elide_view(ordinal, origin, structural_key, unwraped):
+                return
+            self._record_storage(ordinal, origin, unwraped)
+
+        # when the tracked tensors are known in advance, only those are copied off-device.
+        # everything else just advances the ordinal counter.
+        if self._capture_plan is None or ordinal in self._capture_plan:
+            tensor_id = OrdinalTensorId(ordinal=ordinal)
+            self._id_to_tensor.put(tensor_id, self._capture(tensor_id, unwraped))
+            self._tensor_to_id[id(unwraped)] = tensor_id
+
+        if structural_key in self._structural_capture_plan:
+            tensor_id = StructuralTensorId(key=structural_key)
+            self._id_to_tensor.put(tensor_id, self._capture(tensor_id, unwraped))
+
+        if self._cg is None:
+            # map-only tracking
+            return
 
         # if ordinal < 10:
         #     print('hnt', ordinal, tensor._origin)
@@ -140,24 +548,106 @@ class SingleComputationTracker(ComputationTracker):
         #
         # use tensor origin to continue graph
         #
-        origin: Optional[TensorOrigin] = tensor._origin
-        if origin is not None:
-            op_node = RawOpNode(op=_get_raw_op_text(origin), origin=origin)
-            self._cg.add_node(op_node, label=op_node.label, style='filled', fillcolor='lightgray')
+        op_node = self._cg.add_raw_op(origin) if origin is not None else None
+
+        tensor_node = self._cg.add_tensor(ordinal, unwraped.size(), unwraped)
+
+        if op_node is not None:
             self._cg.add_edge(op_node, tensor_node)
 
-            self._origin_to_tensor_node[origin] = tensor_node
+            self._origin_to_tensor_node[origin.index] = tensor_node
 
-            prev_origins = set(filter(None, list(origin.args) + list(p[1] for p in origin.kwargs)))
-            for prev_origin in prev_origins:
-                prev_node = self._origin_to_tensor_node.get(prev_origin)
+            for prev_index in set(origin.parent_indices()):
+                prev_node = self._origin_to_tensor_node.get(prev_index)
                 if prev_node is not None:
                     self._cg.add_edge(prev_node, op_node)
 
+    def _capture(self, tensor_id: TensorId, tensor: Tensor) -> StoredTensor:
+        reducer = self._reducers.get(tensor_id)
+        if reducer is not None:
+            with torch.no_grad():
+                tensor = reducer(tensor.detach())
+
+        # reduce precision on the device, so less data is transferred as well
+        with torch.no_grad():
+            stored = apply_storage_policy(tensor.detach(), self._storage)
+        if isinstance(stored, QuantizedTensor):
+            return stored.map(self._host_storage.copy)
+        return self._host_storage.copy(stored)
+
+    def _elide_view(self, ordinal: int, origin: TensorOrigin, structural_key: int, tensor: Tensor) -> bool:
+        """ Records a tensor as an alias of its input if possible, see elide_views. """
+        is_view = self._view_ops.get(origin.op_id)
+        if is_view is None:
+            is_view = origin.op in _VIEW_OPS
+            self._view_ops[origin.op_id] = is_view
+        if not is_view:
+            return False
+
+        # explicitly requested tensors are always captured
+        if self._capture_plan is not None and ordinal in self._capture_plan:
+            return False
+        if structural_key in self._structural_capture_plan:
+            return False
+
+        parents = origin.parent_indices()
+        if not parents:
+            return False
+        parent = self._origin_to_ordinal.get(parents[0])
+        if parent is None:
+            return False
+
+        parent_alias = self._aliases.get(parent)
+        base = parent_alias[0] if parent_alias is not None else parent
+        storage_info = self._storage_info.get(base)
+        if storage_info is None:
+            return False
+
+        data_ptr, base_offset, numel, version = storage_info
+        if tensor.untyped_storage().data_ptr() != data_ptr:
+            return False
+        if tensor._version != version:
+            # modified in place since the base was captured, the alias would show the old values
+            return False
+
+        size = tuple(tensor.size())
+        stride = tuple(tensor.stride())
+        offset = tensor.storage_offset() - base_offset
+        extent = sum((s - 1) * st for s, st in zip(size, stride)) if all(size) else 0
+        if offset < 0 or offset + extent >= max(numel, 1):
+            return False
+
+        self._aliases[ordinal] = (base, size, stride, offset)
+        self._origin_to_ordinal[origin.index] = ordinal
+
+        # consumers of the alias are connected to the node of its input instead
+        if self._cg is not None:
+            parent_node = self._origin_to_tensor_node.get(parents[0])
+            if parent_node is not None:
+                self._origin_to_tensor_node[origin.index] = parent_node
+
+        return True
+
+    def _record_storage(self, ordinal: int, origin: TensorOrigin, tensor: Tensor):
+        self._origin_to_ordinal[origin.index] = ordinal
+        if tensor.is_contiguous():
+            self._storage_info[ordinal] = (
+                tensor.untyped_storage().data_ptr(),
+                tensor.storage_offset(),
+                tensor.numel(),
+                tensor._version,
+            )
+
     def reset(self, *, inc_step=False):
         self._next_ordinal = 0
-        self._id_to_tensor.clear()
         self._tensor_to_id.clear()
+        self._host_storage.clear()
+        # a new store, since built maps may have taken over the budget of the old one
+        self._id_to_tensor = TensorStore(budget=self._budget, before_spill=self._host_storage.synchronize)
+        self._reset_trace()
+
+        # let origins of previous steps be freed once they are no longer referenced
+        new_origin_table()
 
         if inc_step:
             self._current_step += 1
@@ -196,7 +686,10 @@ class SingleComputationTracker(ComputationTracker):
         if y is not None:
             raise NotImplementedError('y is not supported yet')
 
-        raw_graph = RawComputationGraph(g=self._cg)
+        if self._cg is None:
+            raise Exception('Tracker does not build a computation graph (use track(graph=True))')
+
+        raw_graph = RawComputationGraph(g=self._cg.build())
 
         if limit is not None:
             raw_graph = raw_graph.make_small(limit=limit)
@@ -204,22 +697,52 @@ class SingleComputationTracker(ComputationTracker):
         return NiceComputationGraph.from_raw(raw_graph, keep_tensors=keep_tensors)
 
     def build_map(self) -> 'ComputationMap':
-        if self._tracked_tensors:
-            data = {tensor_id: unwrap_proxy(self._id_to_tensor.get(tensor_id)) for tensor_id in self._tracked_tensors}
-        else:
-            data = {tensor_id: unwrap_proxy(tensor) for tensor_id, tensor in self._id_to_tensor.items()}
+        # captured tensors are copied asynchronously
+        self._host_storage.synchronize()
 
-        return EagerComputationMap(data=data)
+        if self._tracked_tensors is not None:
+            data = {tensor_id: self._id_to_tensor.get(tensor_id) for tensor_id in self._tracked_tensors}
+            aliases = {}
+        else:
+            data = dict(self._id_to_tensor)
+            aliases = {
+                OrdinalTensorId(ordinal=ordinal): TensorAlias(
+                    base=OrdinalTensorId(ordinal=base),
+                    size=size,
+                    stride=stride,
+                    offset=offset,
+                )
+                for ordinal, (base, size, stride, offset) in self._aliases.items()
+            }
+
+        cmap = EagerComputationMap(data=data, aliases=aliases)
+        if self._budget is not None:
+            # the map owns the captured tensors from now on
+            self._budget.release(self._id_to_tensor)
+            cmap.set_memory_budget(self._budget)
+        return cmap
 
 
 class BatchedComputationTracker(ComputationTracker):
     def __init__(
             self,
             *,
-            track_tensors: Optional[Iterable[TensorId]] = None,
+            track_tensors: Optional[TrackedTensors] = None,
+            graph: bool = False,
+            include_modules: Optional[Iterable[str]] = None,
+            elide_views: bool = False,
+            storage: StoragePolicy = StoragePolicy.FULL,
+            budget: Optional[MemoryBudget] = None,
     ):
-        self._tracker = SingleComputationTracker(track_tensors=track_tensors)
-        self._tracked_tensors = list(track_tensors) if track_tensors is not None else None
+        self._tracker = SingleComputationTracker(
+            track_tensors=track_tensors,
+            graph=graph,
+            include_modules=include_modules,
+            elide_views=elide_views,
+            storage=storage,
+            budget=budget,
+        )
+        self._tracked_tensors = list(track_tensors) if track_tensors else None
         self._maps = []
 
     def __enter__(self):
@@ -427,26 +950,181 @@ class ComputationMap:
     def __iter__(self) -> Iterator[TensorId]:
         raise NotImplementedError()
 
-    def save_to_dir(self, dir_path: str, time_step: int = 0):
+    def save_to_dir(self, dir_path: str, time_step: int = 0, *, container: bool = True):
+        """
+        Saves the tensors of a time step into a single container file (see write_tensor_container),
+        or into a directory per tensor (written by log_tensor) if container is False.
+        """
+        raise NotImplementedError()
+
+    def get(self, tensor_id: TensorId, *, index: Optional[TensorIndex] = None) -> List[Tensor]:
+        """
+        Returns the tensors stored for an id (one per batch). If index is given, it is applied to each
+        of them and only the selected part is read (from memory, spilled or memory-mapped storage).
+        """
         raise NotImplementedError()
 
-    def get(self, tensor_id: TensorId) -> List[Tensor]:
+    def get_shapes(self, tensor_id: TensorId) -> List[Tuple[int, ...]]:
+        """ Returns the shapes of the tensors get() returns, without reading them if possible. """
+        return [tuple(tensor.shape) for tensor in self.get(tensor_id)]
+
+    def get_nbytes(self) -> int:
+        """ Returns the number of bytes the tensors of the map are stored in. """
         raise NotImplementedError()
 
+    def load(self, tensor_ids: Iterable[TensorId]) -> 'EagerComputationMap':
+        """ Returns a map of tensors read into memory, for maps that hold a single tensor per id. """
+        data = {}
+        for tensor_id in tensor_ids:
+            result = self.get(tensor_id)
+            if result:
+                data[tensor_id] = result[0]
+        return EagerComputationMap(data=data)
+
     def filter_ids(self, fn: Callable[[TensorId], bool]) -> 'ComputationMap':
         raise NotImplementedError()
 
-    def get_cat(self, tensor_id: TensorId, *, dim=0) -> Optional[Tensor]:
-        result = self.get(tensor_id)
-        if result is None:
+    def rename_ids(self, mapping: Dict[TensorId, TensorId]) -> 'ComputationMap':
+        """ Returns a map in which tensor ids are replaced according to mapping (others are kept). """
+        raise NotImplementedError()
+
+    def set_memory_budget(self, budget: MemoryBudget):
+        """ Puts the tensors held in memory by this map under a budget. """
+        pass
+
+    def get_cat(self, tensor_id: TensorId, *, dim=0, index: Optional[TensorIndex] = None) -> Optional[Tensor]:
+        """ Returns the tensors of an id concatenated along dim, index is applied to the concatenated tensor. """
+        result = self.get(tensor_id, index=index)
+        if not result:
             return None
 
         return torch.cat(result, dim=dim)
 
 
+@dataclass
+class StoredTensorInfo:
+    shape: Tuple[int, ...]
+    dtype: str
+    """ The dtype tensors are returned in (they may be stored in reduced precision). """
+    nbytes: int
+    """ Number of bytes stored, 0 for views that are stored as aliases of another tensor. """
+
+    def to_dict(self) -> dict:
+        return {'shape': list(self.shape), 'dtype': self.dtype, 'nbytes': self.nbytes}
+
+    @staticmethod
+    def from_dict(value: dict) -> 'StoredTensorInfo':
+        return StoredTensorInfo(shape=tuple(value['shape']), dtype=value['dtype'], nbytes=value['nbytes'])
+
+
+def _get_stored_nbytes(value) -> int:
+    """ Returns the size of a stored value, including spilled ones. """
+    if isinstance(value, QuantizedTensor):
+        return sum(_get_stored_nbytes(x) for x in (value.data, value.scale) if x is not None)
+    return math.prod(value.shape) * _element_size(value.dtype)
+
+
+_MANIFEST_NAME = 'manifest.json'
+
+
+def _read_manifest(root_dir: str) -> Optional[dict]:
+    manifest_path = os.path.join(root_dir, _MANIFEST_NAME)
+    if not os.path.isfile(manifest_path):
+        return None
+    with open(manifest_path, 'r') as f:
+        return json.load(f)
+
+
+def _update_manifest(root_dir: str, update: Callable[[dict], None]):
+    """ Updates the manifest of a saved map, which lists what is stored without reading any tensors. """
+    os.makedirs(root_dir, exist_ok=True)
+    manifest = _read_manifest(root_dir) or {}
+    update(manifest)
+
+    manifest_path = os.path.join(root_dir, _MANIFEST_NAME)
+    tmp_path = manifest_path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(manifest, f)
+    os.replace(tmp_path, manifest_path)
+
+
+_IO_EXECUTOR: Optional[concurrent.futures.ThreadPoolExecutor] = None
+_IO_EXECUTOR_LOCK = threading.Lock()
+
+
+def _get_io_executor() -> concurrent.futures.ThreadPoolExecutor:
+    """ Returns the thread pool that stored maps are read on (torch releases the GIL while reading). """
+    global _IO_EXECUTOR
+    with _IO_EXECUTOR_LOCK:
+        if _IO_EXECUTOR is None:
+            _IO_EXECUTOR = concurrent.futures.ThreadPoolExecutor(thread_name_prefix='fmrai-io')
+        return _IO_EXECUTOR
+
+
+def _get_container_path(root_dir: str, time_step: int) -> str:
+    return os.path.join(root_dir, f't{time_step}.fmrmap')
+
+
+def _parse_time_step(file_name: str, suffix: str) -> Optional[int]:
+    """ Returns the time step of a file saved as t{time_step}{suffix}, or None for other files. """
+    match = re.fullmatch(r't(\d+)' + re.escape(suffix), file_name)
+    return int(match.group(1)) if match is not None else None
+
+
+def _get_file_cache_key(root_dir: str, time_step: int, path: str) -> Optional[Tuple]:
+    """
+    Returns the key for tensors read from a file of a saved map (see get_tensor_cache), or None if it does not exist.
+    The key changes when the file is rewritten (also by other processes), so stale tensors are not read from the cache.
+    """
+    try:
+        stat = os.stat(path)
+    except FileNotFoundError:
+        return None
+    return os.path.abspath(root_dir), time_step, stat.st_ino, stat.st_size, stat.st_mtime_ns
+
+
+def _invalidate_cached_reads(root_dir: str, time_step: int):
+    """ Drops cached tensors of a saved time step, since timestamps may be too coarse to tell rewrites apart. """
+    prefix = (os.path.abspath(root_dir), time_step)
+    get_tensor_cache().invalidate(lambda key: key[:2] == prefix)
+
+
+def get_tensor_dir_name(tensor_id: TensorId) -> str:
+    """
+    Names tensors in saved maps. Ordinal and structural ids keep their prefix, so that they can be told apart
+    from named ids, which are saved under their plain name unless it starts with a prefix itself.
+    """
+    tensor_name = repr(tensor_id)
+    assert tensor_name[0] in ('@', '#', '$')
+    if tensor_name[0] == '@' and tensor_name[1:2] not in ('@', '#', '$', ''):
+        return tensor_name[1:]
+    return tensor_name
+
+
+def _get_legacy_tensor_dir_name(tensor_id: TensorId) -> Optional[str]:
+    """ Directory name of an ordinal tensor in maps saved before ordinals kept their prefix. """
+    if isinstance(tensor_id, OrdinalTensorId):
+        return str(tensor_id.ordinal)
+    return None
+
+
+def _parse_tensor_dir_name(name: str) -> TensorId:
+    """ Inverse of get_tensor_dir_name. """
+    if name[:1] in ('@', '#', '$'):
+        return parse_tensor_id(name)
+    return NamedTensorId(name=name)
+
+
+class MapNotFoundError(Exception):
+    """ Raised when a directory holds no saved tensors for the time step of a map. """
+
+
 @dataclass
 class EagerComputationMap(ComputationMap):
-    data: Dict[TensorId, Tensor]
+    data: Dict[TensorId, StoredTensor]
+    """ Captured tensors, possibly in reduced precision (see StoragePolicy). """
+    aliases: Dict[TensorId, TensorAlias] = field(default_factory=dict)
+    """ Elided views of tensors in data, materialized by get(). """
 
     def __len__(self):
         return len(self.data)
@@ -454,62 +1132,364 @@ class EagerComputationMap(ComputationMap):
     def __iter__(self) -> Iterator[TensorId]:
         return iter(self.data.keys())
 
+    def _materialize(self, tensor_id: TensorId) -> Optional[Tensor]:
+        alias = self.aliases.get(tensor_id)
+        if alias is None:
+            return None
+        base = self.data.get(alias.base)
+        if base is None:
+            return None
+        self._record_access(base)
+        return alias.materialize(load_stored_tensor(base))
+
+    def _record_access(self, value: StoredTensor):
+        if isinstance(self.data, TensorStore) and self.data.budget is not None:
+            self.data.budget.record_access(value)
+
     def filter_ids(self, fn: Callable[[TensorId], bool]) -> 'ComputationMap':
+        data = {tensor_id: tensor for tensor_id, tensor in self.data.items() if fn(tensor_id)}
+        aliases = {}
+        for tensor_id, alias in self.aliases.items():
+            if not fn(tensor_id):
+                continue
+            if alias.base in data:
+                aliases[tensor_id] = alias
+            elif alias.base in self.data:
+                # the base is dropped, keep a copy of just the alias
+                data[tensor_id] = self._materialize(tensor_id).clone()
+
+        return EagerComputationMap(data=data, aliases=aliases)
+
+    def rename_ids(self, mapping: Dict[TensorId, TensorId]) -> 'ComputationMap':
         return EagerComputationMap(
-            data={tensor_id: tensor for tensor_id, tensor in self.data.items() if fn(tensor_id)}
+            data={mapping.get(tensor_id, tensor_id): tensor for tensor_id, tensor in self.data.items()},
+            aliases={
+                mapping.get(tensor_id, tensor_id): dataclasses.replace(alias, base=mapping.get(alias.base, alias.base))
+                for tensor_id, alias in self.aliases.items()
+            },
         )
 
-    def get(self, tensor_id: TensorId) -> List[Tensor]:
+    def get(self, tensor_id: TensorId, *, index: Optional[TensorIndex] = None) -> List[Tensor]:
         tensor = self.data.get(tensor_id)
+        if tensor is None:
+            tensor = self._materialize(tensor_id)
+        else:
+            self._record_access(tensor)
         if tensor is not None:
-            return [tensor]
+            return [load_stored_tensor(tensor, index)]
+        return []
+
+    def get_shapes(self, tensor_id: TensorId) -> List[Tuple[int, ...]]:
+        tensor = self.data.get(tensor_id)
+        if tensor is not None:
+            return [tuple(tensor.shape)]
+        alias = self.aliases.get(tensor_id)
+        if alias is not None and self.data.get(alias.base) is not None:
+            return [tuple(alias.size)]
         return []
 
-    def save_to_dir(self, root_dir: str, time_step: int = 0):
+    def set_memory_budget(self, budget: MemoryBudget):
+        if isinstance(self.data, TensorStore) and self.data.budget is not None:
+            self.data.budget.release(self.data)
+        self.data = budget.manage(self.data)
+
+    def get_nbytes(self) -> int:
+        return sum(_get_stored_nbytes(tensor) for tensor in self.data.values() if tensor is not None)
+
+    def _get_manifest_entries(self, *, container: bool) -> Dict[str, dict]:
+        entries = {}
         for tensor_id, tensor in self.data.items():
-            tensor_name = repr(tensor_id)
-            assert tensor_name.startswith('@') or tensor_name.startswith('#')
+            if tensor is not None:
+                entries[repr(tensor_id)] = StoredTensorInfo(
+                    shape=tuple(tensor.shape),
+                    dtype=dtype_name(tensor.dtype),
+                    nbytes=_get_stored_nbytes(tensor),
+                ).to_dict()
+
+        for tensor_id, alias in self.aliases.items():
+            base = self.data.get(alias.base)
+            if base is not None:
+                entries[repr(tensor_id)] = StoredTensorInfo(
+                    shape=tuple(alias.size),
+                    dtype=dtype_name(base.dtype),
+                    nbytes=0 if container else math.prod(alias.size) * _element_size(base.dtype),
+                ).to_dict()
+
+        return entries
+
+    def save_to_dir(self, root_dir: str, time_step: int = 0, *, container: bool = True):
+        os.makedirs(root_dir, exist_ok=True)
+        entries = self._get_manifest_entries(container=container)
+
+        if container:
+            write_tensor_container(
+                _get_container_path(root_dir, time_step),
+                {
+                    get_tensor_dir_name(tensor_id): tensor
+                    for tensor_id, tensor in self.data.items()
+                    if tensor is not None
+                },
+                aliases={
+                    get_tensor_dir_name(tensor_id): alias.to_dict()
+                    for tensor_id, alias in self.aliases.items()
+                    if self.data.get(alias.base) is not None
+                },
+            )
+        else:
+            for tensor_id, tensor in self.data.items():
+                if tensor is not None:
+                    log_tensor(_compact(tensor), get_tensor_dir_name(tensor_id), time_step=time_step, root_dir=root_dir)
 
-            log_tensor(tensor, tensor_name[1:], time_step=time_step, root_dir=root_dir)
+            for tensor_id in self.aliases:
+                tensor = self._materialize(tensor_id)
+                if tensor is not None:
+                    log_tensor(_compact(tensor), get_tensor_dir_name(tensor_id), time_step=time_step, root_dir=root_dir)
+
+        # written last, so that it only lists tensors that were saved
+        _update_manifest(root_dir, lambda manifest: manifest.setdefault('time_steps', {}).update({
+            str(time_step): entries,
+        }))
+        _invalidate_cached_reads(root_dir, time_step)
 
     def __repr__(self):
         return f'<eager map: {len(self.data)} tensors>'
 
 
 class LazyComputationMap(ComputationMap):
-    def __init__(self, root_dir: str, time_step: int):
+    def __init__(self, root_dir: str, time_step: int, *, tensor_ids: Optional[FrozenSet[TensorId]] = None):
+        """ If tensor_ids is given, the map only contains those tensors (see filter_ids). """
         self._root_dir = root_dir
         self._time_step = time_step
-        self._data = {}
+        self._tensor_ids = tensor_ids
+        self._container: Optional[TensorContainer] = None
+        self._container_cache_key: Optional[Tuple] = None
+        self._manifest: Optional[Dict[TensorId, StoredTensorInfo]] = None
+
+    def _get_manifest(self) -> Optional[Dict[TensorId, StoredTensorInfo]]:
+        """ Returns what the manifest lists for the time step, or None for maps saved without one. """
+        if self._manifest is None:
+            manifest = _read_manifest(self._root_dir)
+            if manifest is None or str(self._time_step) not in manifest.get('time_steps', {}):
+                return None
+
+            self._manifest = {
+                parse_tensor_id(tensor_id): StoredTensorInfo.from_dict(info)
+                for tensor_id, info in manifest['time_steps'][str(self._time_step)].items()
+            }
+            if self._tensor_ids is not None:
+                self._manifest = {
+                    tensor_id: info for tensor_id, info in self._manifest.items() if tensor_id in self._tensor_ids
+                }
+        return self._manifest
+
+    def _require_manifest(self) -> Dict[TensorId, StoredTensorInfo]:
+        """
+        Returns what the manifest lists for the time step. For maps saved without one, it is rebuilt
+        from the index of the container, or by reading every tensor of a directory per tensor.
+        """
+        manifest = self._get_manifest()
+        if manifest is None:
+            container = self._get_container()
+            manifest = self._scan_container(container) if container is not None else self._scan_tensor_dirs()
+            if not manifest and not os.path.isfile(_get_container_path(self._root_dir, self._time_step)):
+                raise MapNotFoundError(f'No tensors saved for time step {self._time_step}: {self._root_dir}')
+
+            if self._tensor_ids is not None:
+                manifest = {
+                    tensor_id: info for tensor_id, info in manifest.items() if tensor_id in self._tensor_ids
+                }
+            self._manifest = manifest
+        return manifest
+
+    @staticmethod
+    def _scan_container(container: TensorContainer) -> Dict[TensorId, StoredTensorInfo]:
+        manifest = {
+            _parse_tensor_dir_name(name): StoredTensorInfo(
+                shape=container.shape(name),
+                dtype=container.dtype(name),
+                nbytes=container.nbytes(name),
+            )
+            for name in container.keys()
+        }
+        for name, alias in container.aliases.items():
+            manifest[_parse_tensor_dir_name(name)] = StoredTensorInfo(
+                shape=tuple(alias['size']),
+                dtype=container.dtype(alias['base']),
+                nbytes=0,
+            )
+        return manifest
+
+    def _iter_tensor_dirs(self) -> Iterator[os.DirEntry]:
+        """ Yields the directories holding a tensor of the time step, for maps saved with a directory per tensor. """
+        with os.scandir(self._root_dir) as entries:
+            for entry in entries:
+                if entry.is_dir() and os.path.isfile(os.path.join(entry.path, f't{self._time_step}.pt')):
+                    yield entry
+
+    def _scan_tensor_dirs(self) -> Dict[TensorId, StoredTensorInfo]:
+        manifest = {}
+        for entry in self._iter_tensor_dirs():
+            with open(os.path.join(entry.path, f't{self._time_step}.pt'), 'rb') as f:
+                stored = torch.load(f)
+            if isinstance(stored, dict) and stored.get('quantized'):
+                stored = QuantizedTensor.from_dict(stored)
+            manifest[_parse_tensor_dir_name(entry.name)] = StoredTensorInfo(
+                shape=tuple(stored.shape),
+                dtype=dtype_name(stored.dtype),
+                nbytes=_get_stored_nbytes(stored),
+            )
+        return manifest
+
+    @staticmethod
+    def get_time_steps(path: str) -> List[int]:
+        """
+        Returns the time steps saved in a directory, according to its manifest.
+        For maps saved without one, they are listed from the containers and tensor files in the directory.
+        """
+        manifest = _read_manifest(path)
+        if manifest is not None:
+            return sorted(int(time_step) for time_step in manifest.get('time_steps', {}))
+        if not os.path.isdir(path):
+            return []
+
+        time_steps = set()
+        with os.scandir(path) as entries:
+            for entry in entries:
+                if entry.is_dir():
+                    with os.scandir(entry.path) as files:
+                        time_steps.update(_parse_time_step(file.name, '.pt') for file in files)
+                else:
+                    time_steps.add(_parse_time_step(entry.name, '.fmrmap'))
+        time_steps.discard(None)
+        return sorted(time_steps)
+
+    def _get_container(self) -> Optional[TensorContainer]:
+        """ Returns the container of the time step, or None for maps saved with a directory per tensor. """
+        if self._container is None:
+            container_path = _get_container_path(self._root_dir, self._time_step)
+            if os.path.isfile(container_path):
+                self._container_cache_key = _get_file_cache_key(self._root_dir, self._time_step, container_path)
+                self._container = TensorContainer(container_path)
+        return self._container
 
     def __len__(self):
-        # TODO
-        raise NotImplementedError()
+        return len(self._require_manifest())
+
+    def __iter__(self) -> Iterator[TensorId]:
+        return iter(self._require_manifest())
+
+    def get_info(self, tensor_id: TensorId) -> Optional[StoredTensorInfo]:
+        return self._require_manifest().get(tensor_id)
+
+    def get_nbytes(self) -> int:
+        return sum(info.nbytes for info in self._require_manifest().values())
+
+    def filter_ids(self, fn: Callable[[TensorId], bool]) -> 'ComputationMap':
+        return LazyComputationMap(
+            self._root_dir,
+            self._time_step,
+            tensor_ids=frozenset(tensor_id for tensor_id in self._require_manifest() if fn(tensor_id)),
+        )
 
     @staticmethod
     def load_from(path: str, time_step: int = 0) -> 'LazyComputationMap':
         assert os.path.isdir(path)
         return LazyComputationMap(path, time_step)
 
-    def get(self, tensor_id: TensorId) -> List[Tensor]:
-        existing = self._data.get(tensor_id)
-        if existing is not None:
-            return [existing]
-
-        tensor_name = repr(tensor_id)
-        assert tensor_name.startswith('@') or tensor_name.startswith('#')
+    def get(self, tensor_id: TensorId, *, index: Optional[TensorIndex] = None) -> List[Tensor]:
+        if self._tensor_ids is not None and tensor_id not in self._tensor_ids:
+            return []
+
+        name = get_tensor_dir_name(tensor_id)
+        cache = get_tensor_cache()
+
+        container = self._get_container()
+        if container is not None:
+            # tensors are views of the memory-mapped container (only indexed pages are read),
+            # so only those that have to be dequantized are cached
+            cached = index is None and container.is_quantized(name)
+            cache_key = self._container_cache_key + (tensor_id,)
+            tensor = cache.get(cache_key) if cached else None
+            if tensor is None:
+                tensor = self._load_from_container(container, name, index)
+                if tensor is None:
+                    return []
+                if cached:
+                    cache.put(cache_key, tensor)
+            return [tensor]
 
-        tensor_path = os.path.join(self._root_dir, tensor_name[1:], f't{self._time_step}.pt')
-        if os.path.isfile(tensor_path):
+        tensor_path = os.path.join(self._root_dir, name, f't{self._time_step}.pt')
+        file_cache_key = _get_file_cache_key(self._root_dir, self._time_step, tensor_path)
+        legacy_name = _get_legacy_tensor_dir_name(tensor_id)
+        if file_cache_key is None and legacy_name is not None:
+            tensor_path = os.path.join(self._root_dir, legacy_name, f't{self._time_step}.pt')
+            file_cache_key = _get_file_cache_key(self._root_dir, self._time_step, tensor_path)
+        if file_cache_key is None:
+            return []
+
+        cache_key = file_cache_key + (tensor_id,)
+        tensor = cache.get(cache_key)
+        if tensor is None:
             with open(tensor_path, 'rb') as f:
-                tensor = torch.load(f)
-                self._data[tensor_id] = tensor
-                return [tensor]
-
+                tensor = load_stored_tensor(torch.load(f))
+            cache.put(cache_key, tensor)
+
+        return [load_stored_tensor(tensor, index)]
+
+    def get_shapes(self, tensor_id: TensorId) -> List[Tuple[int, ...]]:
+        manifest = self._get_manifest()
+        if manifest is not None:
+            info = manifest.get(tensor_id)
+            return [info.shape] if info is not None else []
+
+        container = self._get_container()
+        if container is None:
+            return super().get_shapes(tensor_id)
+
+        name = get_tensor_dir_name(tensor_id)
+        shape = container.shape(name)
+        if shape is not None:
+            return [shape]
+        alias = container.aliases.get(name)
+        if alias is not None:
+            return [tuple(alias['size'])]
         return []
 
+    def load(self, tensor_ids: Iterable[TensorId]) -> 'EagerComputationMap':
+        cmap = super().load(tensor_ids)
+        container = self._get_container()
+        if container is not None:
+            # copy views out of the memory map, so that they are read now
+            for tensor_id, tensor in cmap.data.items():
+                if not container.is_quantized(get_tensor_dir_name(tensor_id)):
+                    cmap.data[tensor_id] = tensor.clone()
+        return cmap
+
+    @staticmethod
+    def _load_from_container(container: TensorContainer, name: str, index: Optional[TensorIndex]) -> Optional[Tensor]:
+        stored = container.get(name)
+        if stored is not None:
+            return load_stored_tensor(stored, index)
+
+        alias = container.aliases.get(name)
+        if alias is None:
+            return None
+        base = load_stored_tensor(container.get(alias['base']))
+        tensor = base.as_strided(alias['size'], alias['stride'], base.storage_offset() + alias['offset'])
+        return load_stored_tensor(tensor, index)
+
     def __repr__(self):
-        return f'<lazy map: ? tensors>'
+        # counted without reading any tensors, which rebuilding the manifest of a directory per tensor would do
+        manifest = self._get_manifest()
+        if manifest is not None:
+            tensor_ids = set(manifest)
+        elif self._get_container() is not None:
+            tensor_ids = set(self._scan_container(self._get_container()))
+        else:
+            tensor_ids = {_parse_tensor_dir_name(entry.name) for entry in self._iter_tensor_dirs()}
+        if self._tensor_ids is not None:
+            tensor_ids &= self._tensor_ids
+        return f'<lazy map: {len(tensor_ids)} tensors>'
 
 
 @dataclass
@@ -526,47 +1506,518 @@ class BatchedComputationMap(ComputationMap):
     def load_from(path: str, time_step: int = 0) -> 'BatchedComputationMap':
         assert os.path.isdir(path)
 
-        # find all batch directories
+        manifest = _read_manifest(path)
+        if manifest is not None and 'batches' in manifest:
+            return BatchedComputationMap(batches=[
+                LazyComputationMap(os.path.join(path, name), time_step)
+                for name in manifest['batches']
+            ])
+
+        # find all batch directories, batches are only read when their tensors are requested
         batch_dirs = []
-        for name in os.listdir(path):
-            if name.startswith('batch_'):
-                batch_dir_path = os.path.join(path, name)
-                if os.path.isdir(batch_dir_path):
-                    batch_dirs.append(batch_dir_path)
+        with os.scandir(path) as entries:
+            for entry in entries:
+                if entry.name.startswith('batch_') and entry.is_dir():
+                    batch_dirs.append((int(entry.name[len('batch_'):]), entry.path))
 
         # sort by batch number
-        batch_dirs.sort(key=lambda p: int(os.path.basename(p)[len('batch_'):]))
+        batch_dirs.sort()
 
-        # load each batch
-        batches = []
-        for batch_dir_path in tqdm(batch_dirs, desc='Loading batches'):
-            batches.append(LazyComputationMap.load_from(batch_dir_path, time_step=time_step))
+        return BatchedComputationMap(batches=[
+            LazyComputationMap(batch_dir_path, time_step)
+            for _, batch_dir_path in batch_dirs
+        ])
 
-        return BatchedComputationMap(batches=batches)
-
-    def save_to_dir(self, dir_path: str, time_step: int = 0):
+    def save_to_dir(self, dir_path: str, time_step: int = 0, *, container: bool = True):
         for i, batch in enumerate(self.batches):
             batch.save_to_dir(
                 os.path.join(dir_path, f'batch_{i}'),
                 time_step=time_step,
+                container=container,
             )
 
+        _update_manifest(dir_path, lambda manifest: manifest.update({
+            'batches': [f'batch_{i}' for i in range(len(self.batches))],
+        }))
+
     def save(self, key: str, time_step: int = 0):
         self.save_to_dir(get_computation_map_dir(key), time_step=time_step)
 
-    def get(self, tensor_id: TensorId) -> List[Tensor]:
+    def set_memory_budget(self, budget: MemoryBudget):
+        for batch in self.batches:
+            batch.set_memory_budget(budget)
+
+    def get_nbytes(self) -> int:
+        return sum(batch.get_nbytes() for batch in self.batches)
+
+    def get(self, tensor_id: TensorId, *, index: Optional[TensorIndex] = None) -> List[Tensor]:
+        if len(self.batches) > 1 and any(isinstance(batch, LazyComputationMap) for batch in self.batches):
+            # read batches from disk in parallel
+            batch_results = _get_io_executor().map(lambda batch: batch.get(tensor_id, index=index), self.batches)
+        else:
+            batch_results = (batch.get(tensor_id, index=index) for batch in self.batches)
+
+        result = []
+        for batch_result in batch_results:
+            result.extend(batch_result)
+        return result
+
+    def iter_batches(self, tensor_ids: Iterable[TensorId], *, prefetch: int = 4) -> Iterator['ComputationMap']:
+        """
+        Iterates over the batches with the given tensors read into memory (see ComputationMap.load).
+        The next prefetch batches are read in the background while the current one is processed.
+        """
+        tensor_ids = list(tensor_ids)
+        executor = _get_io_executor()
+        pending = collections.deque()
+        batches = iter(self.batches)
+
+        try:
+            for batch in batches:
+                pending.append(executor.submit(batch.load, tensor_ids))
+                if len(pending) > prefetch:
+                    yield pending.popleft().result()
+
+            while pending:
+                yield pending.popleft().result()
+        finally:
+            for future in pending:
+                future.cancel()
+
+    def get_shapes(self, tensor_id: TensorId) -> List[Tuple[int, ...]]:
         result = []
         for batch in self.batches:
-            result.extend(batch.get(tensor_id))
+            result.extend(batch.get_shapes(tensor_id))
         return result
 
+    def get_cat(self, tensor_id: TensorId, *, dim=0, index: Optional[TensorIndex] = None) -> Optional[Tensor]:
+        if index is None:
+            return super().get_cat(tensor_id, dim=dim)
+
+        index = index if isinstance(index, tuple) else (index,)
+        first, rest = _normalize_leading_index(index[0] if index else slice(None)), index[1:]
+        if dim != 0 or first is None or (isinstance(first, slice) and (first.step or 1) < 0):
+            result = super().get_cat(tensor_id, dim=dim)
+            return result[index] if result is not None else None
+
+        # split the index of the concatenated dimension into indices of the batches that it selects
+        selected = range(sum(shape[0] for shape in self.get_shapes(tensor_id)))[first]
+        parts = []
+        start = 0
+        for batch in self.batches:
+            for shape in batch.get_shapes(tensor_id):
+                end = start + shape[0]
+                if isinstance(selected, int):
+                    if start <= selected < end:
+                        return batch.get(tensor_id, index=(selected - start,) + rest)[0]
+                else:
+                    step = selected.step
+                    lo = max(0, -(-(start - selected.start) // step))
+                    hi = max(0, -(-(end - selected.start) // step))
+                    local = selected[lo:hi]
+                    if len(local) > 0:
+                        local_index = (slice(local.start - start, local.stop - start, step),) + rest
+                        parts.extend(batch.get(tensor_id, index=local_index))
+                start = end
+
+        if not parts:
+            return None
+        return torch.cat(parts, dim=0)
+
+
+def _normalize_leading_index(index) -> Union[int, slice, None]:
+    """
+    Returns the index of the concatenated dimension as an int or slice,
+    or None for indices that cannot be split across batches (Ellipsis, None, masks or lists of indices).
+    """
+    if isinstance(index, slice):
+        return index
+    if isinstance(index, bool):
+        return None
+    try:
+        return operator.index(index)
+    except TypeError:
+        return None
+
+
+class NodeKind(int, Enum):
+    TENSOR = auto()
+    RAW_OP = auto()
+    OP = auto()
+    CONSTANT = auto()
+
+
+def _make_csr(n: int, src: np.ndarray, dst: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    order = np.argsort(src, kind='stable')
+    offsets = np.zeros(n + 1, dtype=np.int64)
+    np.cumsum(np.bincount(src, minlength=n), out=offsets[1:])
+    return offsets, dst[order].astype(np.int64)
+
+
+def _gather_csr(offsets: np.ndarray, values: np.ndarray, rows: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """ Returns the CSR arrays containing only the given rows. """
+    lengths = offsets[rows + 1] - offsets[rows]
+    new_offsets = np.zeros(len(rows) + 1, dtype=np.int64)
+    np.cumsum(lengths, out=new_offsets[1:])
+
+    positions = np.arange(new_offsets[-1], dtype=np.int64)
+    positions += np.repeat(offsets[rows] - new_offsets[:-1], lengths)
+    return new_offsets, values[positions]
+
+
+class CompactGraphBuilder:
+    """
+    Accumulates the nodes and edges of a CompactGraph.
+    """
+
+    def __init__(self):
+        self.kinds = array('b')
+        self.ordinals = array('q')
+        self.ops = array('h')
+        self.shape_offsets = array('q', [0])
+        self.shape_dims = array('q')
+        self.origins: List[Optional[TensorOrigin]] = []
+        self.constants: Dict[int, Any] = {}
+        self.tensors: Dict[int, Tensor] = {}
+        self.edges_src = array('q')
+        self.edges_dst = array('q')
+
+    def __len__(self):
+        return len(self.kinds)
+
+    def _add_node(self, kind: NodeKind, *, ordinal=-1, op=0, shape=(), origin=None) -> int:
+        node = len(self.kinds)
+        self.kinds.append(kind)
+        self.ordinals.append(ordinal)
+        self.ops.append(op)
+        self.shape_dims.extend(shape)
+        self.shape_offsets.append(len(self.shape_dims))
+        self.origins.append(origin)
+        return node
+
+    def add_tensor(self, ordinal: int, size: torch.Size, tensor: Optional[Tensor] = None) -> int:
+        node = self._add_node(NodeKind.TENSOR, ordinal=ordinal, shape=size)
+        if tensor is not None:
+            self.tensors[node] = tensor
+        return node
+
+    def add_raw_op(self, origin: TensorOrigin) -> int:
+        return self._add_node(NodeKind.RAW_OP, origin=origin)
+
+    def add_op(self, op: TensorOp, origin: TensorOrigin) -> int:
+        return self._add_node(NodeKind.OP, op=op, origin=origin)
+
+    def add_constant(self, value) -> int:
+        node = self._add_node(NodeKind.CONSTANT)
+        self.constants[node] = value
+        return node
+
+    def add_edge(self, src: int, dst: int):
+        self.edges_src.append(src)
+        self.edges_dst.append(dst)
+
+    def build(self) -> 'CompactGraph':
+        return CompactGraph(
+            kinds=np.array(self.kinds, dtype=np.int8),
+            ordinals=np.array(self.ordinals, dtype=np.int64),
+            ops=np.array(self.ops, dtype=np.int16),
+            shape_offsets=np.array(self.shape_offsets, dtype=np.int64),
+            shape_dims=np.array(self.shape_dims, dtype=np.int64),
+            origins=list(self.origins),
+            constants=dict(self.constants),
+            tensors=dict(self.tensors),
+            edges_src=np.array(self.edges_src, dtype=np.int64),
+            edges_dst=np.array(self.edges_dst, dtype=np.int64),
+        )
+
+
+class CompactGraph:
+    """
+    A directed graph with integer node ids, CSR adjacency and typed node attribute arrays.
+    Node objects (TensorStubNode, OpNode, etc.) are only materialized on demand, see node().
+    """
+
+    def __init__(
+            self,
+            *,
+            kinds: np.ndarray,
+            ordinals: np.ndarray,
+            ops: np.ndarray,
+            shape_offsets: np.ndarray,
+            shape_dims: np.ndarray,
+            origins: List[Optional[TensorOrigin]],
+            constants: Dict[int, Any],
+            tensors: Dict[int, Tensor],
+            edges_src: np.ndarray,
+            edges_dst: np.ndarray,
+    ):
+        n = len(kinds)
+        self.kinds = kinds
+        self.ordinals = ordinals
+        self.ops = ops
+        self.shape_offsets = shape_offsets
+        self.shape_dims = shape_dims
+        self.origins = origins
+        self.constants = constants
+        self.tensors = tensors
+
+        # remove duplicate edges, this also sorts them by source
+        if len(edges_src) > 0:
+            keys = np.unique(edges_src * n + edges_dst)
+            edges_src, edges_dst = keys // n, keys % n
+
+        self.succ_offsets, self.succ_indices = _make_csr(n, edges_src, edges_dst)
+        self.pred_offsets, self.pred_indices = _make_csr(n, edges_dst, edges_src)
+
+        self._init_caches()
+
+    def _init_caches(self):
+        self._node_cache: Dict[int, GraphNode] = {}
+        self._node_index: Dict[int, int] = {}
+        self._ordinal_index: Optional[Dict[int, int]] = None
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        for key in ('_node_cache', '_node_index', '_ordinal_index'):
+            state.pop(key, None)
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._init_caches()
+
+    def __len__(self):
+        return len(self.kinds)
+
+    @property
+    def nodes(self) -> range:
+        return range(len(self.kinds))
+
+    def number_of_edges(self) -> int:
+        return len(self.succ_indices)
+
+    def edges(self) -> Iterator[Tuple[int, int]]:
+        src = np.repeat(np.arange(len(self), dtype=np.int64), np.diff(self.succ_offsets))
+        return zip(src.tolist(), self.succ_indices.tolist())
+
+    def successors(self, node: int) -> List[int]:
+        return self.succ_indices[self.succ_offsets[node]:self.succ_offsets[node + 1]].tolist()
+
+    def predecessors(self, node: int) -> List[int]:
+        return self.pred_indices[self.pred_offsets[node]:self.pred_offsets[node + 1]].tolist()
+
+    def kind(self, node: int) -> NodeKind:
+        return NodeKind(self.kinds[node])
+
+    def op(self, node: int) -> Optional[TensorOp]:
+        if self.kinds[node] != NodeKind.OP:
+            return None
+        return TensorOp(int(self.ops[node]))
+
+    def origin(self, node: int) -> Optional[TensorOrigin]:
+        return self.origins[node]
+
+    def constant(self, node: int):
+        return self.constants.get(node)
+
+    def tensor_id(self, node: int) -> Optional[TensorId]:
+        if self.kinds[node] != NodeKind.TENSOR:
+            return None
+        return OrdinalTensorId(ordinal=int(self.ordinals[node]))
+
+    def tensor_size(self, node: int) -> torch.Size:
+        return torch.Size(self.shape_dims[self.shape_offsets[node]:self.shape_offsets[node + 1]].tolist())
+
+    def tensor_node_index(self, tensor_id: TensorId) -> Optional[int]:
+        """ Returns the node of a tensor, or None if the tensor is not in the graph. """
+        if not isinstance(tensor_id, OrdinalTensorId):
+            return None
+
+        if self._ordinal_index is None:
+            tensor_nodes = np.nonzero(self.kinds == NodeKind.TENSOR)[0]
+            self._ordinal_index = dict(zip(self.ordinals[tensor_nodes].tolist(), tensor_nodes.tolist()))
+
+        return self._ordinal_index.get(tensor_id.ordinal)
+
+    def node(self, node: int) -> GraphNode:
+        """ Materializes the node object of a node id. """
+        node = int(node)
+        result = self._node_cache.get(node)
+        if result is not None:
+            return result
+
+        kind = self.kinds[node]
+        if kind == NodeKind.TENSOR:
+            tensor = self.tensors.get(node)
+            if tensor is not None:
+                result = TensorNode(tensor_id=self.tensor_id(node), tensor_size=self.tensor_size(node), tensor=tensor)
+            else:
+                result = TensorStubNode(tensor_id=self.tensor_id(node), tensor_size=self.tensor_size(node))
+        elif kind == NodeKind.RAW_OP:
+            result = RawOpNode(op=_get_raw_op_text(self.origins[node]), origin=self.origins[node])
+        elif kind == NodeKind.OP:
+            result = OpNode(op=self.op(node), origin=self.origins[node])
+        else:
+            result = ConstantNode(value=self.constants.get(node))
+
+        self._node_cache[node] = result
+        self._node_index[id(result)] = node
+        return result
+
+    def index_of(self, node: Union[int, GraphNode]) -> int:
+        """ Returns the node id of a node object (or of a tensor node with the same tensor id). """
+        if isinstance(node, (int, np.integer)):
+            return int(node)
+
+        index = self._node_index.get(id(node))
+        if index is not None and self._node_cache.get(index) is node:
+            return index
+
+        if isinstance(node, BaseTensorNode):
+            index = self.tensor_node_index(node.tensor_id)
+            if index is not None:
+                return index
+
+        raise KeyError(node)
+
+    def _bfs(self, source: int, offsets: np.ndarray, indices: np.ndarray) -> Dict[int, int]:
+        dist = {source: 0}
+        frontier = [source]
+        d = 0
+        while frontier:
+            d += 1
+            next_frontier = []
+            for u in frontier:
+                for v in indices[offsets[u]:offsets[u + 1]].tolist():
+                    if v not in dist:
+                        dist[v] = d
+                        next_frontier.append(v)
+            frontier = next_frontier
+        return dist
+
+    def descendants(self, node: int) -> Set[int]:
+        return set(self._bfs(node, self.succ_offsets, self.succ_indices)) - {node}
+
+    def ancestors(self, node: int) -> Set[int]:
+        return set(self._bfs(node, self.pred_offsets, self.pred_indices)) - {node}
+
+    def multi_source_bfs(self, sources: Iterable[int], *, reverse=False) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Runs a single breadth first search from all sources at once (along predecessors if reverse).
+        Returns the distance of every node to its nearest source (-1 if unreachable), and the position
+        of that source in sources. Among equally near sources, the one listed first is chosen.
+        """
+        if reverse:
+            offsets, indices = self.pred_offsets.tolist(), self.pred_indices.tolist()
+        else:
+            offsets, indices = self.succ_offsets.tolist(), self.succ_indices.tolist()
+
+        dist = [-1] * len(self)
+        nearest = [-1] * len(self)
+
+        frontier = []
+        for i, source in enumerate(sources):
+            if dist[source] < 0:
+                dist[source] = 0
+                nearest[source] = i
+                frontier.append(source)
+
+        d = 0
+        while frontier:
+            d += 1
+            next_frontier = []
+            for u in frontier:
+                label = nearest[u]
+                for i in range(offsets[u], offsets[u + 1]):
+                    v = indices[i]
+                    if dist[v] < 0:
+                        dist[v] = d
+                        nearest[v] = label
+                        next_frontier.append(v)
+                    elif dist[v] == d and label < nearest[v]:
+                        nearest[v] = label
+            frontier = next_frontier
+
+        return np.array(dist, dtype=np.int64), np.array(nearest, dtype=np.int64)
+
+    def topological_order(self) -> np.ndarray:
+        """
+        Returns all nodes in topological order.
+        Graphs created by trackers are acyclic, but should a cycle exist, its nodes are appended by id.
+        """
+        n = len(self)
+        in_degree = np.diff(self.pred_offsets).tolist()
+        succ_offsets = self.succ_offsets.tolist()
+        succ_indices = self.succ_indices.tolist()
+
+        order = []
+        ready = collections.deque(u for u in range(n) if in_degree[u] == 0)
+        while ready:
+            u = ready.popleft()
+            order.append(u)
+            for i in range(succ_offsets[u], succ_offsets[u + 1]):
+                v = succ_indices[i]
+                in_degree[v] -= 1
+                if in_degree[v] == 0:
+                    ready.append(v)
+
+        if len(order) < n:
+            seen = np.zeros(n, dtype=bool)
+            seen[order] = True
+            order.extend(np.nonzero(~seen)[0].tolist())
+
+        return np.array(order, dtype=np.int64)
+
+    def subgraph(self, nodes: np.ndarray) -> 'CompactGraph':
+        """ Returns the subgraph induced by the given (sorted) nodes. Node ids are renumbered. """
+        nodes = np.asarray(nodes, dtype=np.int64)
+        new_ids = np.full(len(self), -1, dtype=np.int64)
+        new_ids[nodes] = np.arange(len(nodes), dtype=np.int64)
+
+        shape_offsets, shape_dims = _gather_csr(self.shape_offsets, self.shape_dims, nodes)
+
+        src = np.repeat(np.arange(len(self), dtype=np.int64), np.diff(self.succ_offsets))
+        src, dst = new_ids[src], new_ids[self.succ_indices]
+        keep = (src >= 0) & (dst >= 0)
+
+        return CompactGraph(
+            kinds=self.kinds[nodes],
+            ordinals=self.ordinals[nodes],
+            ops=self.ops[nodes],
+            shape_offsets=shape_offsets,
+            shape_dims=shape_dims,
+            origins=[self.origins[i] for i in nodes.tolist()],
+            constants={int(new_ids[k]): v for k, v in self.constants.items() if new_ids[k] >= 0},
+            tensors={int(new_ids[k]): v for k, v in self.tensors.items() if new_ids[k] >= 0},
+            edges_src=src[keep],
+            edges_dst=dst[keep],
+        )
+
+    def to_networkx(self, node_attrs: Optional[Callable[[GraphNode], Dict[str, Any]]] = None) -> nx.DiGraph:
+        g = nx.DiGraph()
+        for i in self.nodes:
+            node = self.node(i)
+            g.add_node(node, **(node_attrs(node) if node_attrs is not None else {}))
+
+        for u, v in self.edges():
+            g.add_edge(self.node(u), self.node(v))
+
+        return g
+
 
 @dataclass
 class ComputationGraph:
-    g: nx.DiGraph
+    g: CompactGraph
+
+    def _dot_node_attrs(self, node: GraphNode) -> Dict[str, Any]:
+        return dict(label=node.label)
+
+    def to_networkx(self) -> nx.DiGraph:
+        """ Converts the graph into a networkx graph of node objects (for export). """
+        return self.g.to_networkx(self._dot_node_attrs)
 
     def save_dot(self, out_path: str):
-        p = nx.drawing.nx_pydot.to_pydot(self.g)
+        p = nx.drawing.nx_pydot.to_pydot(self.to_networkx())
         with open(out_path, 'w') as f:
             f.write(p.to_string())
 
@@ -585,48 +2036,33 @@ class ComputationGraph:
             return pickle.load(f)
 
 
+_CONSTANT_DOT_ATTRS = dict(shape='triangle', style='filled', fillcolor='#d9f6ff')
+
+
 @dataclass
 class RawComputationGraph(ComputationGraph):
-    g: nx.DiGraph
-
-    def make_small(self, limit: int) -> 'RawComputationGraph':
-        to_remove = []
+    g: CompactGraph
 
-        new_g = self.g.copy()
+    def _dot_node_attrs(self, node: GraphNode) -> Dict[str, Any]:
+        if isinstance(node, BaseTensorNode):
+            return dict(label=node.label, shape='box', tensor_id=node.tensor_id)
+        if isinstance(node, ConstantNode):
+            return dict(label=node.label, **_CONSTANT_DOT_ATTRS)
+        return dict(label=node.label, style='filled', fillcolor='lightgray')
 
-        # remove all TensorNode instances whose tensor id is an ordinal greater or equal to the limit.
-        for node in new_g.nodes:
-            if isinstance(node, TensorNode) and isinstance(node.tensor_id, OrdinalTensorId) and node.tensor_id.ordinal >= limit:
-                to_remove.append(node)
+    def make_small(self, limit: int) -> 'RawComputationGraph':
+        g = self.g
 
-        # now remove these nodes and all edges connected to them
-        new_g.remove_nodes_from(to_remove)
+        # remove all tensor nodes whose tensor id is an ordinal greater or equal to the limit.
+        # edges connected to them are removed along with them.
+        keep = ~((g.kinds == NodeKind.TENSOR) & (g.ordinals >= limit))
+        g = g.subgraph(np.nonzero(keep)[0])
 
         # remove nodes not connected to anything
-        to_remove = []
-        for node in new_g.nodes:
-            if not list(new_g.predecessors(node)) and not list(new_g.successors(node)):
-                to_remove.append(node)
-
-        new_g.remove_nodes_from(to_remove)
-
-        return RawComputationGraph(g=new_g)
-
-
-def _replace_graph_node(g: nx.DiGraph, old, new, **attrs):
-    g.add_node(new, **attrs)
-
-    # add edges from all predecessors to the new node
-    for pred in g.predecessors(old):
-        g.add_edge(pred, new)
-
-    # add edges from the new node to all successors
-    for succ in g.successors(old):
-        g.add_edge(new, succ)
-
-    # finally, remove old node
-    g.remove_node(old)
+        degree = np.diff(g.succ_offsets) + np.diff(g.pred_offsets)
+        g = g.subgraph(np.nonzero(degree > 0)[0])
 
+        return RawComputationGraph(g=g)
 
 
 _ONE_ARG_OPS = {
@@ -652,32 +2088,75 @@ _ANY_OPS = {
 }
 
 
-def _convert_raw_op_node(g: nx.DiGraph, node: RawOpNode):
-    op = _ONE_ARG_OPS.get(node.origin.op)
-    if op is not None and len(node.origin.args) == 1 and isinstance(node.origin.args[0], TensorOrigin):
-        return OpNode(op=op, origin=node.origin)
+class _OpArgs(int, Enum):
+    ONE_TENSOR = auto()
+    TWO_TENSORS = auto()
+    ONE_CONSTANT = auto()
+    ANY = auto()
+
+
+_OP_TABLES = (
+    (_ONE_ARG_OPS, _OpArgs.ONE_TENSOR),
+    (_TWO_ARG_OPS, _OpArgs.TWO_TENSORS),
+    (_TWO_ARG_ONE_CONST_OPS, _OpArgs.ONE_CONSTANT),
+    (_ANY_OPS, _OpArgs.ANY),
+)
 
-    op = _TWO_ARG_OPS.get(node.origin.op)
-    if op is not None and len(node.origin.args) == 2 and all(isinstance(arg, TensorOrigin) for arg in node.origin.args):
-        return OpNode(op=op, origin=node.origin)
 
-    op = _TWO_ARG_ONE_CONST_OPS.get(node.origin.op)
-    if op is not None and sum(int(isinstance(arg, (int, float))) for arg in node.origin.args) == 1:
-        arg = next(arg for arg in node.origin.args if isinstance(arg, (int, float)))
+def _lookup_op_tables(op_ids: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Looks up interned op names in the op tables.
+    Returns the op of each name and the arguments it requires (0 for names not in any table).
+    """
+    ops = np.full(len(op_ids), TensorOp.OTHER, dtype=np.int16)
+    required = np.zeros(len(op_ids), dtype=np.int8)
 
-        # add constant node to graph
-        constant_node = ConstantNode(value=arg)
-        g.add_node(constant_node, label=constant_node.label, shape='triangle', style='filled', fillcolor='#d9f6ff')
+    for i, op_id in enumerate(op_ids.tolist()):
+        name = get_interned_name(op_id)
+        for table, args in _OP_TABLES:
+            if name in table:
+                ops[i] = table[name]
+                required[i] = args
+                break
 
-        result_node = OpNode(op=op, origin=node.origin)
-        g.add_edge(constant_node, result_node)
-        return result_node
+    return ops, required
 
-    op = _ANY_OPS.get(node.origin.op)
-    if op is not None:
-        return OpNode(op=op, origin=node.origin)
 
-    return OpNode(op=TensorOp.OTHER, origin=node.origin)
+def _classify_raw_ops(table: OriginTable, rows: np.ndarray) -> Tuple[np.ndarray, np.ndarray, List[Union[int, float]]]:
+    """
+    Classifies the raw ops at some rows of an origin table.
+    Returns the op of each row, the positions (into rows) of the ops that take a constant argument,
+    and those constants.
+    """
+    n = len(table)
+
+    # each distinct op name is looked up only once
+    op_ids = np.array(table.op_ids, dtype=np.int64)[rows]
+    unique_op_ids, inverse = np.unique(op_ids, return_inverse=True)
+    unique_ops, unique_required = _lookup_op_tables(unique_op_ids)
+    ops, required = unique_ops[inverse], unique_required[inverse]
+
+    arg_rows, arg_values, is_tensor, is_number = table.positional_arg_arrays()
+    num_args = np.bincount(arg_rows, minlength=n)[rows]
+    num_tensors = np.bincount(arg_rows, weights=is_tensor, minlength=n)[rows]
+    num_numbers = np.bincount(arg_rows, weights=is_number, minlength=n)[rows]
+
+    takes_constant = (required == _OpArgs.ONE_CONSTANT) & (num_numbers == 1)
+    matches = (
+        ((required == _OpArgs.ONE_TENSOR) & (num_args == 1) & (num_tensors == 1)) |
+        ((required == _OpArgs.TWO_TENSORS) & (num_args == 2) & (num_tensors == 2)) |
+        takes_constant |
+        (required == _OpArgs.ANY)
+    )
+    ops[~matches] = TensorOp.OTHER
+
+    number_of_row = np.zeros(n, dtype=np.int64)
+    number_of_row[arg_rows[is_number]] = arg_values[is_number]
+
+    constant_positions = np.nonzero(takes_constant)[0]
+    constants = [table.decode_arg(value) for value in number_of_row[rows[constant_positions]].tolist()]
+
+    return ops, constant_positions, constants
 
 
 def _get_dot_node_attrs(node):
@@ -699,18 +2178,64 @@ def _get_dot_node_attrs(node):
 
 
 class NiceComputationGraph(ComputationGraph):
+    def _dot_node_attrs(self, node: GraphNode) -> Dict[str, Any]:
+        if isinstance(node, ConstantNode):
+            return dict(label=node.label, **_CONSTANT_DOT_ATTRS)
+        return _get_dot_node_attrs(node)
+
     @staticmethod
     def from_raw(rg: RawComputationGraph, *, keep_tensors=False):
-        g = rg.g.copy()
-
-        for node in list(g.nodes):
-            if isinstance(node, RawOpNode):
-                op_node = _convert_raw_op_node(g, node)
-                _replace_graph_node(g, node, op_node, **_get_dot_node_attrs(op_node))
-
-            elif isinstance(node, TensorNode) and not keep_tensors:
-                # replace with stubs
-                stub_node = TensorStubNode(tensor_id=node.tensor_id, tensor_size=node.tensor.size())
-                _replace_graph_node(g, node, stub_node, **_get_dot_node_attrs(stub_node))
-
-        return NiceComputationGraph(g=g)
+        """
+        Converts a raw graph in a single pass over its node arrays.
+        Node ids are kept, raw op nodes become op nodes in place and the constants
+        of ops with a constant argument are appended after the existing nodes.
+        """
+        raw = rg.g
+        n = len(raw)
+        kinds = raw.kinds.copy()
+        ops = raw.ops.copy()
+        origins = list(raw.origins)
+        constants = dict(raw.constants)
+
+        raw_op_nodes = np.nonzero(raw.kinds == NodeKind.RAW_OP)[0]
+        kinds[raw_op_nodes] = NodeKind.OP
+
+        # classify the raw ops of each origin table at once
+        raw_op_origins = [origins[i] for i in raw_op_nodes.tolist()]
+        tables = {id(origin.table): origin.table for origin in raw_op_origins}
+        origin_tables = np.array([id(origin.table) for origin in raw_op_origins], dtype=np.int64)
+        origin_rows = np.array([origin.row for origin in raw_op_origins], dtype=np.int64)
+
+        constant_src = []
+        constant_dst = []
+        for table_key, table in tables.items():
+            in_table = origin_tables == table_key
+            nodes = raw_op_nodes[in_table]
+            table_ops, constant_positions, table_constants = _classify_raw_ops(table, origin_rows[in_table])
+            ops[nodes] = table_ops
+
+            for node, constant in zip(nodes[constant_positions].tolist(), table_constants):
+                constant_node = n + len(constant_src)
+                constants[constant_node] = constant
+                constant_src.append(constant_node)
+                constant_dst.append(node)
+
+        num_constants = len(constant_src)
+        edges_src = np.repeat(np.arange(n, dtype=np.int64), np.diff(raw.succ_offsets))
+
+        return NiceComputationGraph(g=CompactGraph(
+            kinds=np.concatenate([kinds, np.full(num_constants, NodeKind.CONSTANT, dtype=kinds.dtype)]),
+            ordinals=np.concatenate([raw.ordinals, np.full(num_constants, -1, dtype=raw.ordinals.dtype)]),
+            ops=np.concatenate([ops, np.zeros(num_constants, dtype=ops.dtype)]),
+            shape_offsets=np.concatenate([
+                raw.shape_offsets,
+                np.full(num_constants, raw.shape_offsets[-1], dtype=raw.shape_offsets.dtype),
+            ]),
+            shape_dims=raw.shape_dims,
+            origins=origins + [None] * num_constants,
+            constants=constants,
+            # replace tensors with stubs, unless keeping tensors
+            tensors=dict(raw.tensors) if keep_tensors else {},
+            edges_src=np.concatenate([edges_src, np.array(constant_src, dtype=np.int64)]),
+            edges_dst=np.concatenate([raw.succ_indices, np.array(constant_dst, dtype=np.int64)]),
+        ))
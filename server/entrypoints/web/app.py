@@ -6,11 +6,17 @@ from fastapi import FastAPI, HTTPException
 from fastapi.responses import FileResponse
 
 from fmrai.logging import get_tensor_info_path
+from fmrai.storage import set_tensor_cache_size
+from fmrai.tracker import parse_tensor_id, get_tensor_dir_name
 from server.agent_comm import find_agent_host
 from server.entrypoints.web.routers.analysis import router as analysis_router
 from server.entrypoints.web.routers.projects import router as projects_router
 from server.entrypoints.web.routers.kv import router as kv_router
 
+# size of the tensor cache shared by the computation maps that are loaded
+if 'FMRAI_TENSOR_CACHE_MB' in os.environ:
+    set_tensor_cache_size(int(os.environ['FMRAI_TENSOR_CACHE_MB']) << 20)
+
 app = FastAPI()
 app.include_router(projects_router)
 app.include_router(analysis_router)
@@ -45,10 +51,7 @@ def get_model_graph():
 
 
 def _load_tensor_info(tensor_id: str, time_step: int):
-    assert tensor_id.startswith('@') or tensor_id.startswith('#')
-    tensor_id = tensor_id[1:]
-
-    info_path = get_tensor_info_path(tensor_id, time_step)
+    info_path = get_tensor_info_path(get_tensor_dir_name(parse_tensor_id(tensor_id)), time_step)
     if os.path.isfile(info_path):
         with open(info_path) as f:
             return json.load(f)
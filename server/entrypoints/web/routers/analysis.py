@@ -5,8 +5,8 @@ import requests
 from fastapi import APIRouter, HTTPException, Depends, Body
 
 from fmrai.analysis.attention import AttentionHeadClusteringResult, extract_attention_values
-from fmrai.logging import get_computation_graph_dir, get_attention_head_plots_dir
-from fmrai.tracker import LazyComputationMap, OrdinalTensorId
+from fmrai.logging import get_computation_graph_dir, get_attention_head_plots_dir, get_computation_map_dir
+from fmrai.tracker import LazyComputationMap, MapNotFoundError, parse_tensor_id
 from server.adapters.repository import get_local_project_repository
 from server.entrypoints.web import models
 
@@ -193,8 +193,7 @@ def analyze_attention_head_inputs(
     cmap = LazyComputationMap.load_from(os.path.join(plot_dir, 'tensors'))
 
     # extract attention
-    assert tensor_id.startswith('#')
-    tensor_id = OrdinalTensorId(ordinal=int(tensor_id[1:]))
+    tensor_id = parse_tensor_id(tensor_id)
     extraction = extract_attention_values(
         cmap, tensor_id, head_index=head_index, instance_range=range(limit)
     )
@@ -205,6 +204,32 @@ def analyze_attention_head_inputs(
     }
 
 
+@router.get('/analyze/computation_map/tensors')
+def list_computation_map_tensors(
+        key: str,
+        time_step: int = 0,
+        project=Depends(get_project_from_params),
+):
+    map_dir = get_computation_map_dir(key, root_dir=project.data_root_dir)
+    if not os.path.isdir(map_dir):
+        raise HTTPException(status_code=404)
+
+    # only the manifest of the map is read (or the index of its container, for maps saved without one)
+    cmap = LazyComputationMap.load_from(map_dir, time_step)
+    try:
+        items = [
+            {'tensor_id': repr(tensor_id), **cmap.get_info(tensor_id).to_dict()}
+            for tensor_id in cmap
+        ]
+    except MapNotFoundError:
+        raise HTTPException(status_code=404)
+
+    return {
+        'items': items,
+        'nbytes': sum(item['nbytes'] for item in items),
+    }
+
+
 @router.post('/analyze/text/predict')
 def analyze_text_predict(
         project=Depends(get_project_from_body),